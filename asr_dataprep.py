@@ -4,7 +4,8 @@ this file will do the dataprep for asr training'''
 import os
 import random
 from six.moves import configparser
-from nabu.processing import ark, prepare_data
+from nabu.processing import prepare_data, packed_store, feature_reader,\
+    manifest
 from nabu.processing.target_normalizers import normalizer_factory
 
 #pointers to the config files
@@ -37,33 +38,34 @@ if prepare_audio:
     audiostore_cfg.read(audio_storage_cfg_file)
     audiostore_cfg = dict(audiostore_cfg.items('features'))
 
+# read the number of parallel feature computation jobs if that is specified
+if 'num_shards' in database_cfg:
+    num_shards = int(database_cfg['num_shards'])
+else:
+    num_shards = 1
+
 # read the percentage of the labels to keep if that is specified
 if 'part_labeled' in database_cfg:
     percentage_to_keep = float(database_cfg['part_labeled'])
 else:
     percentage_to_keep = 1.0
 
-#compute the features of the training set for training
+#the per speaker cmvn statistics are not needed with online cmvn
+speaker_cmvn = feat_cfg.get('cmvn', 'speaker') == 'speaker'
+
+#compute the features of the training set for training, prepare_data also
+#writes the feature dimension
 print '------- computing training features ----------'
 prepare_data.prepare_data(
     datadir=database_cfg['train_data'],
     featdir=os.path.join(database_cfg['train_dir'], feat_cfg['name']),
-    conf=feat_cfg)
-
-print '------- computing cmvn stats ----------'
-prepare_data.compute_cmvn(
-    featdir=database_cfg['train_dir'] + '/' + feat_cfg['name'])
-
+    conf=feat_cfg,
+    num_shards=num_shards)
 
-#get the feature dim
-reader = ark.ArkReader(os.path.join(database_cfg['train_dir'],
-                                    feat_cfg['name'], 'feats.scp'))
-_, features, _ = reader.read_next_utt()
-input_dim = features.shape[1]
-
-with open(os.path.join(database_cfg['train_dir'], feat_cfg['name'], 'dim'),
-          'w') as fid:
-    fid.write(str(input_dim))
+if speaker_cmvn:
+    print '------- computing cmvn stats ----------'
+    prepare_data.compute_cmvn(
+        featdir=database_cfg['train_dir'] + '/' + feat_cfg['name'])
 
 #compute the features of the dev set
 if 'dev_data' in database_cfg:
@@ -72,36 +74,49 @@ if 'dev_data' in database_cfg:
     prepare_data.prepare_data(
         datadir=database_cfg['dev_data'],
         featdir=os.path.join(database_cfg['dev_dir'], feat_cfg['name']),
-        conf=feat_cfg)
-
-    print '------- computing cmvn stats ----------'
-    prepare_data.compute_cmvn(
-        featdir=os.path.join(database_cfg['dev_dir'], feat_cfg['name']))
+        conf=feat_cfg,
+        num_shards=num_shards)
 
-    with open(os.path.join(database_cfg['dev_dir'], feat_cfg['name'],
-                           'dim'), 'w') as fid:
-        fid.write(str(input_dim))
+    if speaker_cmvn:
+        print '------- computing cmvn stats ----------'
+        prepare_data.compute_cmvn(
+            featdir=os.path.join(database_cfg['dev_dir'], feat_cfg['name']))
 
 #compute the features of the test set for testing
 print '------- computing testing features ----------'
 prepare_data.prepare_data(
     datadir=database_cfg['test_data'],
     featdir=os.path.join(database_cfg['test_dir'], feat_cfg['name']),
-    conf=feat_cfg)
-
-print '------- computing cmvn stats ----------'
-prepare_data.compute_cmvn(
-    featdir=os.path.join(database_cfg['test_dir'], feat_cfg['name']))
+    conf=feat_cfg,
+    num_shards=num_shards)
 
-with open(os.path.join(database_cfg['test_dir'], feat_cfg['name'], 'dim'),
-          'w') as fid:
-    fid.write(str(input_dim))
+if speaker_cmvn:
+    print '------- computing cmvn stats ----------'
+    prepare_data.compute_cmvn(
+        featdir=os.path.join(database_cfg['test_dir'], feat_cfg['name']))
 
 #shuffle the training data on disk
 print '------- shuffling examples ----------'
 prepare_data.shuffle_examples(os.path.join(database_cfg['train_dir'],
                                            feat_cfg['name']))
 
+#pack the normalized features in contiguous stores that can be memory mapped,
+#the training features are packed in the shuffled order
+if database_cfg.get('packed_features', 'False') == 'True':
+    print '------- packing features ----------'
+    sets = [('train_dir', 'feats_shuffled.scp'), ('test_dir', 'feats.scp')]
+    if 'dev_data' in database_cfg:
+        sets.append(('dev_dir', 'feats.scp'))
+    for setdir, scpname in sets:
+        featdir = os.path.join(database_cfg[setdir], feat_cfg['name'])
+        packed_store.pack_features(
+            scpfile=os.path.join(featdir, scpname),
+            storedir=os.path.join(featdir, 'packed'),
+            cmvnfile=os.path.join(featdir, 'cmvn.scp'),
+            utt2spkfile=os.path.join(featdir, 'utt2spk'),
+            online_cmvn=feature_reader.online_cmvn(feat_cfg),
+            dtype=packed_store.packed_dtype(feat_cfg))
+
 #create the text normalizer
 normalizer = normalizer_factory.factory(database_cfg['normalizer'])
 
@@ -135,6 +150,8 @@ with open(sourcefile) as fid:
 
         counter = counter+1
 
+target_fid.close()
+
 #store the alphabet
 with open(os.path.join(database_cfg['train_dir'], 'alphabet'), 'w') as fid:
     fid.write(' '.join(normalizer.alphabet))
@@ -152,6 +169,8 @@ with open(sourcefile) as fid:
         normalized = normalizer(trans)
         target_fid.write('%s %s\n' % (utt_id, normalized))
 
+target_fid.close()
+
 #store the alphabet
 with open(os.path.join(database_cfg['test_dir'], 'alphabet'), 'w') as fid:
     fid.write(' '.join(normalizer.alphabet))
@@ -171,11 +190,24 @@ if 'devtext' in database_cfg:
             normalized = normalizer(trans)
             target_fid.write('%s %s\n' % (utt_id, normalized))
 
+    target_fid.close()
+
     #store the alphabet
     with open(os.path.join(database_cfg['dev_dir'], 'alphabet'),
               'w') as fid:
         fid.write(' '.join(normalizer.alphabet))
 
+#add the target lengths and labeled flags to the manifests of the features
+print '------- completing manifests -----------'
+sets = ['train_dir', 'test_dir']
+if 'dev_data' in database_cfg and 'devtext' in database_cfg:
+    sets.append('dev_dir')
+for setdir in sets:
+    featdir = os.path.join(database_cfg[setdir], feat_cfg['name'])
+    set_manifest = manifest.Manifest.read(featdir)
+    set_manifest.add_targets(os.path.join(database_cfg[setdir], 'targets'))
+    set_manifest.write(featdir)
+
 
 # when audio is needed, we also need to store the quantized audio samples
 if prepare_audio:
@@ -186,7 +218,8 @@ if prepare_audio:
         datadir=database_cfg['train_data'],
         featdir=os.path.join(database_cfg['train_dir'],
                              audiostore_cfg['name']),
-        conf=audiostore_cfg)
+        conf=audiostore_cfg,
+        num_shards=num_shards)
 
     #compute the audio samples of the dev set
     if 'dev_data' in database_cfg:
@@ -195,14 +228,16 @@ if prepare_audio:
             datadir=database_cfg['dev_data'],
             featdir=os.path.join(database_cfg['dev_dir'],
                                  audiostore_cfg['name']),
-            conf=audiostore_cfg)
+            conf=audiostore_cfg,
+            num_shards=num_shards)
 
     #compute the audio samples of the test set for testing
     print '------- computing testing audio samples ----------'
     prepare_data.prepare_data(
         datadir=database_cfg['test_data'],
         featdir=os.path.join(database_cfg['test_dir'], audiostore_cfg['name']),
-        conf=audiostore_cfg)
+        conf=audiostore_cfg,
+        num_shards=num_shards)
 
     #shuffle the samples on disk
     print '------- shuffling examples ----------'
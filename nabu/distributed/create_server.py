@@ -20,9 +20,45 @@ def create_server(clusterfile, job_name, task_index, expdir, ssh_command):
 
     Returns: a tensorflow server'''
 
-    if clusterfile is None:
+    return start_server(
+        create_cluster(clusterfile, job_name, task_index, expdir, ssh_command),
+        job_name, task_index)
+
+def start_server(tfcluster, job_name, task_index):
+    '''creates the tensorflow server of a task in a cluster, the server
+    starts its threads, so processes should be forked before it is created
+
+    Args:
+        tfcluster: the ClusterSpec created with create_cluster
+        job_name: the name of the job, ignored without distributed training
+        task_index: the task index
+
+    Returns: a tensorflow server'''
+
+    if 'local' in tfcluster.as_dict():
         #no distributed training
-        server = tf.train.Server.create_local_server()
+        return tf.train.Server(tfcluster, 'local', 0)
+
+    return tf.train.Server(tfcluster, job_name, task_index)
+
+def create_cluster(clusterfile, job_name, task_index, expdir, ssh_command):
+    '''creates the tensorflow cluster based on the clusterfile, the ssh
+    tunnels are created but no server is started
+
+    Args:
+        clusterfile: the path to the clusterfile
+        job_name: the name of the job
+        task_index: the task index
+        expdir: the experiments directory
+        ssh_command: the command to use for ssh, if 'None' no tunnel will be
+            created
+
+    Returns: a tensorflow ClusterSpec, with a single local task if there is
+        no clusterfile'''
+
+    if clusterfile is None:
+        #no distributed training, the port is chosen by the server
+        tfcluster = tf.train.ClusterSpec({'local': ['localhost:0']})
     else:
         #read the cluster file
         machines = cluster.read_cluster(clusterfile)
@@ -128,7 +164,4 @@ def create_server(clusterfile, job_name, task_index, expdir, ssh_command):
         #create the cluster
         tfcluster = tf.train.ClusterSpec(clusterdict)
 
-        #create the server for this task
-        server = tf.train.Server(tfcluster, job_name, task_index)
-
-    return server
+    return tfcluster
@@ -27,7 +27,7 @@ class BeamSearchDecoder(decoder.Decoder):
         '''
 
         #encode the inputs [batch_size x output_length x output_dim]
-        hlfeat = classifier.encoder(self.inputs, self.input_seq_length, False)
+        hlfeat = classifier.encoder(inputs, input_seq_length, False)
 
         #repeat the high level features for all beam elements
         hlfeat = tf.reshape(tf.tile(tf.expand_dims(hlfeat, 1),
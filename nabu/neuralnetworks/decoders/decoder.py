@@ -4,6 +4,7 @@ neural network decoder environment'''
 from abc import ABCMeta, abstractmethod
 import tensorflow as tf
 import numpy as np
+from nabu.processing import feature_reader
 
 class Decoder(object):
     '''the abstract class for a decoder'''
@@ -11,7 +12,7 @@ class Decoder(object):
     __metaclass__ = ABCMeta
 
     def __init__(self, conf, classifier, input_dim,
-                 max_input_length, coder, expdir):
+                 max_input_length, coder, expdir, input_lengths=None):
         '''
         Decoder constructor, creates the decoding graph
 
@@ -24,6 +25,8 @@ class Decoder(object):
             coder: a TargetCoder object
             expdir: the location where the models were saved and the results
                 will be written
+            input_lengths: the lengths of the inputs that will be decoded,
+                they are used to choose the buckets of input lengths
         '''
 
         self.conf = conf
@@ -32,6 +35,12 @@ class Decoder(object):
         self.coder = coder
         self.batch_size = int(conf['batch_size'])
 
+        #there is a decoding graph for every bucket of input lengths, a batch
+        #is padded to the smallest bucket it fits in
+        self.input_buckets = feature_reader.length_buckets(
+            input_lengths, int(conf.get('input_buckets', 1)),
+            max_input_length)
+
         # it is assumed that decoders will only be used to decode the text targets
         # we can then store the output dimension as a single element in stead of
         # what could be a tuple
@@ -43,21 +52,25 @@ class Decoder(object):
             raise Exception('The output_dim field of the classifier is in a wrong format')
 
         with tf.variable_scope(type(self).__name__):
-            #create the inputs placeholder
-            self.inputs = tf.placeholder(
-                tf.float32,
-                shape=[self.batch_size, max_input_length, input_dim],
-                name='inputs')
+            #create the inputs placeholder of every bucket
+            self.inputs = [
+                tf.placeholder(
+                    tf.float32,
+                    shape=[self.batch_size, length, input_dim],
+                    name='inputs_%d' % length)
+                for length in self.input_buckets]
 
             #create the sequence length placeholder
             self.input_seq_length = tf.placeholder(
                 tf.int32, shape=[self.batch_size], name='seq_length')
 
-            #compute the outputs
-            self.outputs = self.get_outputs(
-                inputs=self.inputs,
-                input_seq_length=self.input_seq_length,
-                classifier=classifier)
+            #compute the outputs of every bucket
+            self.outputs = []
+            for inputs in self.inputs:
+                self.outputs.append(self.get_outputs(
+                    inputs=inputs,
+                    input_seq_length=self.input_seq_length,
+                    classifier=classifier))
 
     @abstractmethod
     def get_outputs(self, inputs, input_seq_length, classifier):
@@ -118,21 +131,24 @@ class Decoder(object):
                     break
 
             #add empty elements to the inputs to get a full batch
-            feat_dim = inputs[0].shape[1]
-            inputs += [np.zeros([0, feat_dim])]*(self.batch_size-len(inputs))
+            frame_shape = list(inputs[0].shape[1:])
+            inputs += [np.zeros([0] + frame_shape)]*(
+                self.batch_size-len(inputs))
 
             #get the sequence length
             input_seq_length = [inp.shape[0] for inp in inputs]
 
-            #pad the inputs and put them in a tensor
-            input_tensor = np.array([np.append(
-                inp, np.zeros([self.max_input_length-inp.shape[0],
-                               inp.shape[1]]), 0) for inp in inputs])
+            #pad the inputs untill the length of their bucket and put them
+            #in a tensor
+            bucket = feature_reader.bucket_index(self.input_buckets,
+                                                 max(input_seq_length))
+            input_tensor = feature_reader.collate(
+                inputs, self.input_buckets[bucket])
 
             #pylint: disable=E1101
             output = sess.run(
-                self.outputs,
-                feed_dict={self.inputs:input_tensor,
+                self.outputs[bucket],
+                feed_dict={self.inputs[bucket]:input_tensor,
                            self.input_seq_length:input_seq_length})
 
             #convert the label sequence into a sequence of characers
@@ -158,21 +174,17 @@ class Decoder(object):
         #get the sequecnce length
         input_seq_length = features.shape[0]
 
-        #pad the features
-        inputs = np.append(
-            features,
-            np.zeros([self.max_input_length-features.shape[0],
-                      features.shape[1]]),
-            0)
-
-        #put the inputs in the correct shape
-        inputs = inputs[np.newaxis, :, :]
+        #pad the features and put the inputs in the correct shape
+        bucket = feature_reader.bucket_index(self.input_buckets,
+                                             input_seq_length)
+        inputs = feature_reader.collate([features],
+                                        self.input_buckets[bucket])
         input_seq_length = np.array([input_seq_length])
 
         #decode the utterance
         output = sess.run(
-            self.outputs,
-            feed_dict={self.inputs:inputs,
+            self.outputs[bucket],
+            feed_dict={self.inputs[bucket]:inputs,
                        self.input_seq_length:input_seq_length})
 
         #get the scores of the beam elements
@@ -11,7 +11,8 @@ def factory(conf,
             input_dim,
             max_input_length,
             coder,
-            expdir):
+            expdir,
+            input_lengths=None):
     '''
     creates a decoder object
 
@@ -23,6 +24,8 @@ def factory(conf,
         coder: a TargetCoder object
         expdir: the location where the models were saved and the results
             will be written
+        input_lengths: the lengths of the inputs that will be decoded, they
+            are used to choose the buckets of input lengths
     '''
 
     if conf['decoder'] == 'ctcdecoder':
@@ -41,4 +44,5 @@ def factory(conf,
                          input_dim,
                          max_input_length,
                          coder,
-                         expdir)
+                         expdir,
+                         input_lengths)
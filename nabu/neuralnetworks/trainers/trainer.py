@@ -2,10 +2,22 @@
 neural network trainer environment'''
 
 import os
+import glob
+import json
 from abc import ABCMeta, abstractmethod
-from time import time, sleep
+from time import time
 import tensorflow as tf
 import numpy as np
+from nabu.processing import prefetcher, loader, feature_reader
+from nabu.distributed import create_server
+
+#the interval in seconds at which the chief saves a checkpoint
+CHECKPOINT_SECS = 600
+
+#the workers that are not the chief do not know when a checkpoint is saved,
+#they store their sampling state at this interval in seconds. After a
+#restore they read at most this much of their data again
+DATA_STATE_SECS = 60
 
 class Trainer(object):
     '''General class outlining the training environment of a classifier.'''
@@ -21,7 +33,7 @@ class Trainer(object):
                  val_reader,
                  val_targets,
                  expdir,
-                 server,
+                 cluster,
                  task_index):
         '''
         NnetTrainer constructor, creates the training graph
@@ -38,7 +50,9 @@ class Trainer(object):
             val_targets: a dictionary containing the targets of the validation
                 set
             expdir: directory where the summaries will be written
-            server: optional server to be used for distributed training
+            cluster: the ClusterSpec of the training, the server of the task
+                is only started in train, after the data loader workers are
+                forked
             task_index: optional index of the worker task in the cluster
         '''
 
@@ -48,16 +62,37 @@ class Trainer(object):
                              /max(1, int(conf['numbatches_to_aggregate'])))
         self.val_reader = val_reader
         self.val_targets = val_targets
+        self.input_dim = input_dim
+        self.reconstruction_dim = reconstruction_dim
 
         self.expdir = expdir
-        self.server = server
-        cluster = tf.train.ClusterSpec(server.server_def.cluster)
+        self.cluster = cluster
 
         #save the max lengths
         self.max_target_length1, self.max_target_length2 =\
             dispenser.max_target_length
         self.max_input_length = dispenser.max_input_length
 
+        #there is a graph for every bucket of input lengths, they share the
+        #variables. A batch is padded to the smallest bucket it fits in, so
+        #the cost of a batch depends on its own longest utterance. The
+        #gradients of synchronous training can only be aggregated for a
+        #single graph
+        if int(conf['numbatches_to_aggregate']) > 0:
+            num_buckets = 1
+        else:
+            num_buckets = int(conf.get('input_buckets', 1))
+        self.input_buckets = feature_reader.length_buckets(
+            dispenser.input_lengths, num_buckets, self.max_input_length)
+
+        #the reconstruction targets (audio samples or input features) are
+        #as long as the inputs, so they are bucketed in proportion, which
+        #keeps the ratio of their lengths that the reconstructors rely on
+        self.target_buckets = [
+            int(np.ceil(self.max_target_length2*float(length)
+                        /max(self.max_input_length, 1)))
+            for length in self.input_buckets]
+
         # save the boolean that holds if doing learning rate adaptation
         if 'learning_rate_adaptation' in conf:
             if conf['learning_rate_adaptation'] == 'True':
@@ -80,6 +115,13 @@ class Trainer(object):
             #distributed training
             num_replicas = len(cluster.as_dict()['worker'])
 
+        #every worker takes its batches from its own interleaved shard of the
+        #data, so the workers do not share any reading state. The number of
+        #steps is counted over all the workers
+        if num_replicas > 1:
+            self.dispenser = dispenser.shard(num_replicas, task_index)
+
+        self.task_index = task_index
         self.is_chief = task_index == 0
         device = tf.train.replica_device_setter(
             cluster=cluster,
@@ -90,12 +132,13 @@ class Trainer(object):
 
             with tf.device(device):
 
-                #create the inputs placeholder
-                self.inputs = tf.placeholder(
-                    dtype=tf.float32,
-                    shape=[dispenser.size, self.max_input_length,
-                           input_dim],
-                    name='inputs')
+                #create the inputs placeholder of every bucket
+                self.inputs = [
+                    tf.placeholder(
+                        dtype=tf.float32,
+                        shape=[dispenser.size, length, input_dim],
+                        name='inputs_%d' % length)
+                    for length in self.input_buckets]
 
                 #the first part of the tupple of targets (text targets)
                 targets1 = tf.placeholder(
@@ -104,15 +147,17 @@ class Trainer(object):
                     name='targets1')
 
                 #second part of the tupple of targets
-                #(audio samples or input features)
-                targets2 = tf.placeholder(
-                    dtype=tf.float32,
-                    shape=[dispenser.size, self.max_target_length2,
-                           reconstruction_dim],
-                    name='targets2')
+                #(audio samples or input features) for every bucket
+                targets2 = [
+                    tf.placeholder(
+                        dtype=tf.float32,
+                        shape=[dispenser.size, length, reconstruction_dim],
+                        name='targets2_%d' % length)
+                    for length in self.target_buckets]
 
-                # the targets are passed together as a tupple
-                self.targets = (targets1, targets2)
+                # the targets of a bucket are passed together as a tupple
+                self.targets = [(targets1, bucket_targets2)
+                                for bucket_targets2 in targets2]
 
                 #the length of all the input sequences
                 self.input_seq_length = tf.placeholder(
@@ -136,39 +181,50 @@ class Trainer(object):
                 self.target_seq_length = \
                     (target_seq_length1, target_seq_length2)
 
-                #a placeholder to set the position
-                self.pos_in = tf.placeholder(
-                    dtype=tf.int32,
-                    shape=[],
-                    name='pos_in')
-
                 self.val_loss_in = tf.placeholder(
                     dtype=tf.float32,
                     shape=[],
                     name='val_loss_in')
 
-                #compute the training outputs of the classifier
-                trainlogits, logit_seq_length = classifier(
-                    inputs=self.inputs,
-                    input_seq_length=self.input_seq_length,
-                    targets=self.targets,
-                    target_seq_length=self.target_seq_length,
-                    is_training=True)
+                #the sampling state of the dispenser as JSON
+                self.data_state_in = tf.placeholder(
+                    dtype=tf.string,
+                    shape=[],
+                    name='data_state_in')
+
+                #compute the training outputs of the classifier for every
+                #bucket, the update operations of a bucket (e.g. batch
+                #normalization) are only run with that bucket
+                trainlogits = []
+                bucket_update_ops = []
+                for inputs, targets in zip(self.inputs, self.targets):
+                    num_update_ops = len(
+                        tf.get_collection(tf.GraphKeys.UPDATE_OPS))
+                    trainlogits.append(classifier(
+                        inputs=inputs,
+                        input_seq_length=self.input_seq_length,
+                        targets=targets,
+                        target_seq_length=self.target_seq_length,
+                        is_training=True))
+                    bucket_update_ops.append(tf.get_collection(
+                        tf.GraphKeys.UPDATE_OPS)[num_update_ops:])
 
                 #create a decoder object for validation
                 if self.conf['validation_mode'] == 'decode':
                     self.decoder = decoder()
                 elif self.conf['validation_mode'] == 'loss':
-                    vallogits, val_logit_seq_length = classifier(
-                        inputs=self.inputs,
-                        input_seq_length=self.input_seq_length,
-                        targets=self.targets,
-                        target_seq_length=self.target_seq_length,
-                        is_training=False)
-
-                    self.decoder_loss = self.compute_loss(
-                        self.targets, vallogits, val_logit_seq_length,
-                        self.target_seq_length)
+                    self.decoder_loss = []
+                    for inputs, targets in zip(self.inputs, self.targets):
+                        vallogits, val_logit_seq_length = classifier(
+                            inputs=inputs,
+                            input_seq_length=self.input_seq_length,
+                            targets=targets,
+                            target_seq_length=self.target_seq_length,
+                            is_training=False)
+
+                        self.decoder_loss.append(self.compute_loss(
+                            targets, vallogits, val_logit_seq_length,
+                            self.target_seq_length))
                 else:
                     raise Exception('unknown validation mode %s' %
                                     self.conf['validation_mode'])
@@ -184,22 +240,6 @@ class Trainer(object):
 
                 with tf.variable_scope('train'):
 
-                    #a variable that indicates if features are being read
-                    self.reading = tf.get_variable(
-                        name='reading',
-                        shape=[],
-                        dtype=tf.bool,
-                        initializer=tf.constant_initializer(False),
-                        trainable=False)
-
-                    #the position in the feature reader
-                    self.pos = tf.get_variable(
-                        name='position',
-                        shape=[],
-                        dtype=tf.int32,
-                        initializer=tf.constant_initializer(0),
-                        trainable=False)
-
                     #the current validation loss
                     self.val_loss = tf.get_variable(
                         name='validation_loss',
@@ -217,15 +257,6 @@ class Trainer(object):
                             -int(conf['valid_frequency'])),
                         trainable=False)
 
-                    #operation to start reading
-                    self.block_reader = self.reading.assign(True).op
-
-                    #operation to release the reader
-                    self.release_reader = self.reading.assign(False).op
-
-                    #operation to set the position
-                    self.set_pos = self.pos.assign(self.pos_in).op
-
                     #operation to update the validated steps
                     self.set_val_step = self.validated_step.assign(
                         self.global_step).op
@@ -234,6 +265,29 @@ class Trainer(object):
                     self.set_val_loss = self.val_loss.assign(
                         self.val_loss_in).op
 
+                    #the sampling states of the dispensers of the workers,
+                    #the chief writes them next to every checkpoint so every
+                    #worker can continue with the batches of its shard that
+                    #followed the restored checkpoint. They are in no
+                    #collection, so the checkpoints do not contain them and
+                    #they are only initialized when a worker sets its state
+                    self.data_states = [
+                        tf.get_variable(
+                            name='data_state_%d' % worker,
+                            shape=[],
+                            dtype=tf.string,
+                            initializer=tf.constant_initializer(''),
+                            trainable=False,
+                            collections=[])
+                        for worker in range(num_replicas)]
+                    self.data_states_set = [
+                        tf.is_variable_initialized(data_state)
+                        for data_state in self.data_states]
+
+                    #operation to set the sampling state of this worker
+                    self.set_data_state = self.data_states[
+                        task_index].assign(self.data_state_in).op
+
                     #a variable to scale the learning rate (used to reduce the
                     #learning rate in case validation performance drops)
                     learning_rate_fact = tf.get_variable(
@@ -261,7 +315,15 @@ class Trainer(object):
                         zeros = tf.zeros(dispenser.size)
                         binary = tf.where(empty_targets, zeros, ones)
                         how_many_not_empty = tf.reduce_sum(binary)
-                        empty_factor_new = how_many_not_empty/dispenser.size
+
+                        #a batch that was filled up to a budget is padded
+                        #with empty utterances without inputs, they do not
+                        #count
+                        real = tf.where(tf.equal(self.input_seq_length, 0),
+                                        zeros, ones)
+                        empty_factor_new = (how_many_not_empty
+                                            /tf.maximum(tf.reduce_sum(real),
+                                                        1))
 
                         self.update_emptyfactor_op = empty_factor.assign(
                             empty_factor_new).op
@@ -312,33 +374,37 @@ class Trainer(object):
                             total_num_replicas=num_replicas)
 
 
-                    #compute the loss
-                    self.loss = self.compute_loss(
-                        self.targets, trainlogits, logit_seq_length,
-                        self.target_seq_length)
+                    self.loss = []
+                    self.update_op = []
+                    for targets, outputs, update_ops in zip(
+                            self.targets, trainlogits, bucket_update_ops):
+                        logits, logit_seq_length = outputs
 
-                    #compute the gradients
-                    grads = optimizer.compute_gradients(self.loss)
+                        #compute the loss
+                        loss = self.compute_loss(
+                            targets, logits, logit_seq_length,
+                            self.target_seq_length)
 
-                    with tf.variable_scope('clip'):
-                        #clip the gradients
-                        grads = [(tf.clip_by_value(grad, -1., 1.), var)
-                                 for grad, var in grads]
+                        #compute the gradients
+                        grads = optimizer.compute_gradients(loss)
 
-                    #opperation to apply the gradients
-                    apply_gradients_op = optimizer.apply_gradients(
-                        grads_and_vars=grads,
-                        global_step=self.global_step,
-                        name='apply_gradients')
+                        with tf.variable_scope('clip'):
+                            #clip the gradients
+                            grads = [(tf.clip_by_value(grad, -1., 1.), var)
+                                     for grad, var in grads]
 
-                    #all remaining operations with the UPDATE_OPS GraphKeys
-                    update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+                        #opperation to apply the gradients
+                        apply_gradients_op = optimizer.apply_gradients(
+                            grads_and_vars=grads,
+                            global_step=self.global_step,
+                            name='apply_gradients')
 
-                    #create an operation to update the gradients, the batch_loss
-                    #and do all other update ops
-                    self.update_op = tf.group(
-                        *([apply_gradients_op] + update_ops),
-                        name='update')
+                        #create an operation to update the gradients, the
+                        #batch_loss and do all other update ops
+                        self.loss.append(loss)
+                        self.update_op.append(tf.group(
+                            *([apply_gradients_op] + update_ops),
+                            name='update'))
 
                 #create the summaries for visualisation
                 tf.summary.scalar('validation loss', self.val_loss)
@@ -382,9 +448,6 @@ class Trainer(object):
     def train(self):
         '''train the model'''
 
-        #look for the master if distributed training is done
-        master = self.server.target
-
         #start the session and standart servises
         config = tf.ConfigProto()
         config.gpu_options.allow_growth = True
@@ -395,17 +458,98 @@ class Trainer(object):
         save_hook = SaveAtEnd(os.path.join(self.expdir, 'model',
                                            'network.ckpt'))
 
+        checkpoint_dir = os.path.join(self.expdir, 'logdir')
+
+        #when training is resumed the worker continues with the sampling
+        #state of the checkpoint the session will restore
+        state = checkpoint_data_state(checkpoint_dir, self.task_index)
+        if state is not None:
+            current = self.dispenser.state()
+            changed = [key for key in self.dispenser.sampling_settings
+                       if state.get(key) != current.get(key)]
+            if changed:
+                print ('WARNING: the sampling settings of the checkpoint are '
+                       'used instead of the ones in the config: %s' %
+                       ', '.join('%s=%s' % (key, state.get(key))
+                                 for key in changed))
+            try:
+                self.dispenser.restore(state)
+            except Exception as e: #pylint: disable=W0703
+                print ('WARNING: the data state of the checkpoint can not be '
+                       'restored, the data is read from the start: %s' % e)
+
+        #read and pad the batches in the background while the model is
+        #updated, in worker processes that write the batches in shared memory
+        #or in threads of this process. The worker processes are forked
+        #before the server and the session start their threads
+        if int(self.conf.get('loader_workers', 0)) > 0:
+            batch_prefetcher = loader.BatchLoader(
+                dispenser=self.dispenser,
+                prepare=self.collate_batch,
+                layout=self.batch_layout(),
+                num_workers=int(self.conf['loader_workers']),
+                depth=int(self.conf.get('prefetch_depth', 0)))
+            batch_prefetcher.start()
+        else:
+            batch_prefetcher = prefetcher.BatchPrefetcher(
+                dispenser=self.dispenser,
+                prepare=self.collate_batch,
+                depth=int(self.conf.get('prefetch_depth', 0)),
+                num_threads=int(self.conf.get('prefetch_threads', 1)))
+
+        #the background readers are stopped however training ends
+        try:
+            #start the server of this task, its target is the master of the
+            #session
+            server = create_server.start_server(self.cluster, 'worker',
+                                                self.task_index)
+
+            self._train_loop(server.target, config, save_hook,
+                             checkpoint_dir, batch_prefetcher)
+        finally:
+            batch_prefetcher.close()
+
+    def _train_loop(self, master, config, save_hook, checkpoint_dir,
+                    batch_prefetcher):
+        '''
+        run the training session until the last step
+
+        Args:
+            master: the target of the session
+            config: the session ConfigProto
+            save_hook: the hook that saves the final model
+            checkpoint_dir: the checkpoint directory of the session
+            batch_prefetcher: the BatchPrefetcher or BatchLoader the batches
+                are taken from
+        '''
+
+        def data_state():
+            '''the sampling state of this worker after the last prepared
+            batch as JSON'''
+
+            return json.dumps(self.dispenser.state(batch_prefetcher.pos))
+
         with self.graph.as_default():
+
+            #the chief writes the sampling states of all the workers when it
+            #saves a checkpoint
+            checkpoint_hook = tf.train.CheckpointSaverHook(
+                checkpoint_dir=checkpoint_dir,
+                save_secs=CHECKPOINT_SECS,
+                scaffold=self.scaffold,
+                listeners=[DataStateSaver(self, data_state, checkpoint_dir)])
+
             with tf.train.MonitoredTrainingSession(
                 master=master,
                 is_chief=self.is_chief,
-                checkpoint_dir=os.path.join(self.expdir, 'logdir'),
+                checkpoint_dir=checkpoint_dir,
                 scaffold=self.scaffold,
-                chief_only_hooks=[save_hook],
+                chief_only_hooks=[save_hook, checkpoint_hook],
+                save_checkpoint_secs=0,
                 config=config) as sess:
 
-                #set the reading flag to false
-                sess.run(self.release_reader)
+                #the time the sampling state was last stored
+                stored = 0
 
                 #start the training loop
                 #pylint: disable=E1101
@@ -423,45 +567,52 @@ class Trainer(object):
                     #start time
                     start = time()
 
-                    #wait until the reader is free
-                    #pylint: disable=E1101
-                    while self.reading.eval(sess):
-                        sleep(1)
-
-                    #block the reader
-                    sess.run(self.block_reader)
-
-                    #read a batch of data
-                    #batch_target_tupples is a list of tupples
-                    #pylint: disable=E1101
-                    batch_data, batch_labels = self.dispenser.get_batch(
-                        self.pos.eval(sess))
-
-                    #update the position
-                    self.set_pos.run(
-                        session=sess,
-                        feed_dict={self.pos_in:self.dispenser.pos})
-
-                    #release the reader
-                    sess.run(self.release_reader)
+                    #get the prepared batch of data from the shard of this
+                    #worker
+                    batch = self.feed_batch(*batch_prefetcher.get_batch())
 
                     #update the model
-                    loss, lr = self.update(batch_data, batch_labels, sess)
+                    loss, lr = self.update(batch, sess)
 
+                    #the chief stores its sampling state when it saves a
+                    #checkpoint, the other workers do it at an interval
+                    if (not self.is_chief
+                            and time() - stored > DATA_STATE_SECS):
+                        sess.run(self.set_data_state,
+                                 feed_dict={self.data_state_in: data_state()})
+                        stored = time()
 
+                    step = self.global_step.eval(sess)
                     print(('step %d/%d loss: %f, learning rate: %f, '
                            'time elapsed: %f sec')
-                          %(self.global_step.eval(sess), self.num_steps,
-                            loss, lr, time()-start))
+                          %(step, self.num_steps, loss, lr, time()-start))
 
                 #the chief will create the final model
                 if self.is_chief:
                     if not os.path.isdir(os.path.join(self.expdir, 'model')):
                         os.mkdir(os.path.join(self.expdir, 'model'))
 
-    def update(self, inputs, targets, sess):
+    def prepare_batch(self, inputs, targets):
         '''
-        update the neural model with a batch or training data
+        pad a batch of training data and put it in a feed dictionary
+
+        Args:
+            inputs: the inputs to the neural net, see collate_batch
+            targets: the targets for neural net, see collate_batch
+
+        Returns:
+            a pair containing the bucket of the batch and a feed dictionary
+            for the training placeholders
+        '''
+
+        return self.feed_batch(*self.collate_batch(inputs, targets))
+
+    def collate_batch(self, inputs, targets):
+        '''
+        pad a batch of training data
+
+        This does not use the session or the graph, so it can be done in the
+        background or in another process while the model is updated.
 
         Args:
             inputs: the inputs to the neural net, this should be a list
@@ -470,49 +621,135 @@ class Trainer(object):
             targets: the targets for neural net, should be a list of tuples,
                 each tuple containing two N-dimensional vectors for one
                 utterance
-            sess: the session
 
         Returns:
-            a pair containing:
-                - the loss at this step
-                - the learning rate used at this step
+            a pair containing the bucket of the batch and a list with the
+            padded inputs, text targets and reconstruction targets and the
+            input, text target and reconstruction target lengths as numpy
+            arrays, their maximal shapes are given by batch_layout
         '''
 
         # go from a list of tupples to two seperate lists
         targets1 = [t[0] for t in targets]
         targets2 = [t[1] for t in targets]
 
-        #get a list of sequence lengths
-        input_seq_length = [i.shape[0] for i in inputs]
-        target_seq_length1 = [t1.shape[0] for t1 in targets1]
-        target_seq_length2 = [t2.shape[0] for t2 in targets2]
+        #a batch that was filled up to a budget of frames can contain less
+        #utterances than the batch size, the remaining places get empty
+        #utterances
+        num_missing = self.dispenser.size - len(inputs)
+        if num_missing > 0:
+            inputs = inputs + [inputs[0][:0]]*num_missing
+            targets1 += [targets1[0][:0]]*num_missing
+            targets2 += [targets2[0][:0]]*num_missing
+
+        #get the sequence lengths
+        input_seq_length = np.array([i.shape[0] for i in inputs],
+                                    dtype=np.int32)
+        target_seq_length1 = np.array([t1.shape[0] for t1 in targets1],
+                                      dtype=np.int32)
+        target_seq_length2 = np.array([t2.shape[0] for t2 in targets2],
+                                      dtype=np.int32)
+
+        #pad the inputs and the reconstruction targets untill the lengths of
+        #their bucket and the text targets untill the maximum length, spliced
+        #features are materialized here
+        bucket = self.bucket(input_seq_length, target_seq_length2)
+        padded_inputs = feature_reader.collate(inputs,
+                                               self.input_buckets[bucket])
+        padded_targets1 = np.array(pad(targets1, self.max_target_length1),
+                                   dtype=np.int32)
+        padded_targets2 = feature_reader.collate(targets2,
+                                                 self.target_buckets[bucket])
+
+        return bucket, [padded_inputs, padded_targets1, padded_targets2,
+                        input_seq_length, target_seq_length1,
+                        target_seq_length2]
+
+    def batch_layout(self):
+        '''
+        the maximal shapes and the data types of the arrays of a batch as
+        returned by collate_batch
+
+        Returns:
+            a list containing a pair with the shape and the dtype of every
+            array
+        '''
+
+        size = self.dispenser.size
+
+        return [([size, self.input_buckets[-1], self.input_dim], np.float32),
+                ([size, self.max_target_length1], np.int32),
+                ([size, self.target_buckets[-1], self.reconstruction_dim],
+                 np.float32),
+                ([size], np.int32),
+                ([size], np.int32),
+                ([size], np.int32)]
+
+    def feed_batch(self, bucket, arrays):
+        '''
+        put a padded batch in a feed dictionary
+
+        Args:
+            bucket: the bucket of the batch
+            arrays: the arrays of the batch as returned by collate_batch
+
+        Returns:
+            a pair containing the bucket of the batch and a feed dictionary
+            for the training placeholders
+        '''
+
+        return bucket, dict(zip(
+            [self.inputs[bucket], self.targets[bucket][0],
+             self.targets[bucket][1], self.input_seq_length,
+             self.target_seq_length[0], self.target_seq_length[1]],
+            arrays))
+
+    def bucket(self, input_seq_length, target_seq_length2):
+        '''
+        get the smallest bucket a batch fits in
+
+        Args:
+            input_seq_length: the lengths of the inputs in the batch
+            target_seq_length2: the lengths of the reconstruction targets in
+                the batch
+
+        Returns:
+            the index of the bucket
+        '''
+
+        return max(
+            feature_reader.bucket_index(self.input_buckets,
+                                        max(input_seq_length)),
+            feature_reader.bucket_index(self.target_buckets,
+                                        max(target_seq_length2)))
+
+    def update(self, batch, sess):
+        '''
+        update the neural model with a batch or training data
+
+        Args:
+            batch: the batch as prepared by prepare_batch
+            sess: the session
+
+        Returns:
+            a pair containing:
+                - the loss at this step
+                - the learning rate used at this step
+        '''
 
-        #pad the inputs and targets untill the maximum lengths
-        padded_inputs = np.array(pad(inputs, self.max_input_length))
-        padded_targets1 = np.array(pad(targets1, self.max_target_length1))
-        padded_targets2 = np.array(pad(targets2, self.max_target_length2))
+        bucket, feed_dict = batch
 
         # first do an update of the emptyness factor
         if self.learning_rate_adaptation:
             _ = sess.run(
                 fetches=[self.update_emptyfactor_op],
-                feed_dict={self.inputs:padded_inputs,
-                           self.targets[0]:padded_targets1,
-                           self.targets[1]:padded_targets2,
-                           self.input_seq_length:input_seq_length,
-                           self.target_seq_length[0]:target_seq_length1,
-                           self.target_seq_length[1]:target_seq_length2})
+                feed_dict=feed_dict)
 
         _, loss, lr = sess.run(
-            fetches=[self.update_op,
-                     self.loss,
+            fetches=[self.update_op[bucket],
+                     self.loss[bucket],
                      self.learning_rate],
-            feed_dict={self.inputs:padded_inputs,
-                       self.targets[0]:padded_targets1,
-                       self.targets[1]:padded_targets2,
-                       self.input_seq_length:input_seq_length,
-                       self.target_seq_length[0]:target_seq_length1,
-                       self.target_seq_length[1]:target_seq_length2})
+            feed_dict=feed_dict)
 
         return loss, lr
 
@@ -597,14 +834,14 @@ class Trainer(object):
             num_elements = len(inputs)
 
             #add empty elements to the inputs to get a full batch
-            feat_dim = inputs[0].shape[1]
+            frame_shape = list(inputs[0].shape[1:])
             if labels[0][1] is not None:
                 rec_dim = labels[0][1].shape[1]
             else:
                 rec_dim = 1
-            inputs += [np.zeros([0, feat_dim])]*(
+            inputs += [np.zeros([0] + frame_shape)]*(
                 self.dispenser.size-len(inputs))
-            labels += [np.zeros([0]), np.zeros([0, rec_dim])]*(
+            labels += [(np.zeros([0]), np.zeros([0, rec_dim]))]*(
                 self.dispenser.size-len(labels))
 
             #get the sequence length
@@ -613,28 +850,26 @@ class Trainer(object):
             label_seq_length2 = [lab[1].shape[0] if lab[1] is not None \
                 else 0 for lab in labels]
             #pad and put in a tensor
-            input_tensor = np.array([np.append(
-                inp, np.zeros([self.max_input_length-inp.shape[0],
-                               inp.shape[1]]), 0) for inp in inputs])
+            bucket = self.bucket(input_seq_length, label_seq_length2)
+            input_tensor = feature_reader.collate(
+                inputs, self.input_buckets[bucket])
             label_tensor1 = np.array([np.append(
                 lab[0], np.zeros([self.max_target_length1-lab[0].shape[0]]), 0)
                                       for lab in labels])
             if labels[0][1] is not None:
-                label_tensor2 = np.array([np.append(
-                    lab[1], np.zeros([self.max_target_length2-lab[1].shape[0],
-                                      lab[1].shape[1]]), 0)
-                                          for lab in labels])
+                label_tensor2 = feature_reader.collate(
+                    [lab[1] for lab in labels], self.target_buckets[bucket])
             else:
                 label_tensor2 = np.zeros([self.dispenser.size, 1, 1])
             print 'Doing validation, step %d/%d' %(step, total_steps)
 
             loss = sess.run(
-                self.decoder_loss,
-                feed_dict={self.inputs:input_tensor,
+                self.decoder_loss[bucket],
+                feed_dict={self.inputs[bucket]:input_tensor,
                            self.input_seq_length:input_seq_length,
-                           self.targets[0]:label_tensor1,
+                           self.targets[bucket][0]:label_tensor1,
                            self.target_seq_length[0]:label_seq_length1,
-                           self.targets[1]:label_tensor2,
+                           self.targets[bucket][1]:label_tensor2,
                            self.target_seq_length[1]:label_seq_length2})
 
             avrg_loss = ((total_elements*avrg_loss + num_elements*loss)/
@@ -685,3 +920,98 @@ class SaveAtEnd(tf.train.SessionRunHook):
         '''this will be run at session closing'''
 
         self._saver.save(session, self.filename)
+
+class DataStateSaver(tf.train.CheckpointSaverListener):
+    '''a checkpoint listener that writes the sampling states of the workers
+    next to every checkpoint'''
+
+    def __init__(self, trainer, data_state, checkpoint_dir):
+        '''listener constructor
+
+        Args:
+            trainer: the Trainer of the chief
+            data_state: a callable that returns the current sampling state of
+                the chief as JSON
+            checkpoint_dir: the checkpoint directory'''
+
+        self.trainer = trainer
+        self.data_state = data_state
+        self.checkpoint_dir = checkpoint_dir
+
+    def before_save(self, session, global_step_value):
+        '''this will be run before a checkpoint is saved, the chief stores
+        its own state'''
+
+        session.run(self.trainer.set_data_state,
+                    feed_dict={self.trainer.data_state_in: self.data_state()})
+
+    def after_save(self, session, global_step_value):
+        '''this will be run after a checkpoint is saved, the states of the
+        workers that have stored one are written for the step of the
+        checkpoint'''
+
+        stored = session.run(self.trainer.data_states_set)
+        states = session.run([data_state for data_state, is_set
+                              in zip(self.trainer.data_states, stored)
+                              if is_set])
+        workers = [worker for worker, is_set in enumerate(stored) if is_set]
+
+        filename = data_state_file(self.checkpoint_dir, global_step_value)
+        with open(filename + '.tmp', 'w') as fid:
+            json.dump({str(worker): json.loads(state)
+                       for worker, state in zip(workers, states)}, fid)
+        os.rename(filename + '.tmp', filename)
+
+        #remove the states of the checkpoints that were removed
+        checkpoint = tf.train.get_checkpoint_state(self.checkpoint_dir)
+        if checkpoint is not None:
+            kept = set(data_state_file(self.checkpoint_dir, path)
+                       for path in checkpoint.all_model_checkpoint_paths)
+            kept.add(filename)
+            for old in glob.glob(data_state_file(self.checkpoint_dir, '*')):
+                if old not in kept:
+                    os.remove(old)
+
+def data_state_file(checkpoint_dir, step):
+    '''
+    the file containing the sampling states of a checkpoint
+
+    Args:
+        checkpoint_dir: the checkpoint directory
+        step: the global step of the checkpoint or the checkpoint path
+
+    Returns:
+        the path of the file
+    '''
+
+    if isinstance(step, basestring) and step != '*':
+        step = step.split('-')[-1]
+
+    return os.path.join(checkpoint_dir, 'data_state-%s.json' % step)
+
+def checkpoint_data_state(checkpoint_dir, task_index):
+    '''
+    get the sampling state of a worker at the latest checkpoint
+
+    Args:
+        checkpoint_dir: the checkpoint directory
+        task_index: the index of the worker task in the cluster
+
+    Returns:
+        the state dictionary or None if there is no checkpoint or no state
+        of the worker for it, e.g. for checkpoints of older versions or of
+        training with less workers
+    '''
+
+    checkpoint = tf.train.latest_checkpoint(checkpoint_dir)
+    if checkpoint is None:
+        return None
+
+    filename = data_state_file(checkpoint_dir, checkpoint)
+    if not os.path.isfile(filename):
+        return None
+
+    with open(filename) as fid:
+        states = json.load(fid)
+
+    return states.get(str(task_index))
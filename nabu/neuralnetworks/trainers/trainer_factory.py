@@ -17,7 +17,7 @@ def factory(conf,
             val_reader,
             val_targets,
             expdir,
-            server,
+            cluster,
             task_index):
     '''Create a Trainer object
 
@@ -33,8 +33,8 @@ def factory(conf,
             validation will not be used
         val_targets: a dictionary containing the targets of the validation set
         logdir: directory where the summaries will be written
-        server: optional server to be used for distributed training
-        cluster: optional cluster to be used for distributed training
+        cluster: the ClusterSpec of the training, the server of the task is
+            started by the trainer
         task_index: optional index of the worker task in the cluster
 
     Returns: a Trainer object
@@ -64,5 +64,5 @@ def factory(conf,
                          val_reader,
                          val_targets,
                          expdir,
-                         server,
+                         cluster,
                          task_index)
@@ -6,5 +6,6 @@ This package contains all the functionality for data processing:
 '''
 
 from . import ark, batchdispenser, feature_reader, prepare_data,\
-readfiles, score, target_coder, target_normalizers, feature_computers,\
-text_reader
+feature_cache, index_cache, loader, manifest, packed_store, prefetcher,\
+readfiles, sampler, score, scp_index, target_coder, target_normalizers,\
+target_store, feature_computers, text_reader
@@ -3,36 +3,61 @@ contains io functionality for Kaldi ark format'''
 
 import struct
 import copy
-from collections import OrderedDict
+import mmap
 import numpy as np
+from nabu.processing import scp_index
 
 np.set_printoptions(threshold=np.nan)
 np.set_printoptions(linewidth=np.nan)
 
+#the tokens of the Kaldi compressed matrix formats
+COMPRESSED_TOKENS = ['CM', 'CM2', 'CM3']
+
+#the tokens of the uncompressed matrix types, FM and DM are the Kaldi float
+#matrices, the others are compact nabu types that Kaldi can not read
+MATRIX_TYPES = {'FM': np.dtype(np.float32),
+                'DM': np.dtype(np.float64),
+                'HM': np.dtype(np.float16),
+                'U8M': np.dtype(np.uint8),
+                'U16M': np.dtype(np.uint16)}
+MATRIX_TOKENS = {dtype: token for token, dtype in MATRIX_TYPES.items()}
+
+#the number of bytes that is read to know the size of a matrix, the marker,
+#the token and the largest header fit in it
+HEADER_SIZE = 32
+
+#records that are less than MAX_READ_GAP bytes apart in an archive are read
+#together, in reads of at most MAX_READ_SIZE bytes. Skipping a gap of this
+#size costs about as much as a seek on a spinning disk
+MAX_READ_GAP = 1048576
+MAX_READ_SIZE = 67108864
+
 class ArkReader(object):
     '''
     Class to read Kaldi ark format.
+
+    The reader keeps one open handle per archive for its whole lifetime. In
+    mmap mode every archive is memory mapped once and the float matrices are
+    returned as zero-copy, read-only views on the mapping.
     '''
 
-    def __init__(self, scp_path):
+    def __init__(self, scp_path, use_mmap=True):
         '''
         ArkReader constructor
 
         Args:
             scp_path: path to the .scp file
+            use_mmap: if True the archives are memory mapped, otherwise they
+                are read through a pool of open file handles
         '''
 
         self.scp_position = 0
-        fin = open(scp_path, "r")
-        self.scp_data = OrderedDict()
-        line = fin.readline()
-        while line != '' and line != None:
-            utt_id, path_pos = line.replace('\n', '').split(' ')
-            path, pos = path_pos.split(':')
-            self.scp_data[utt_id] = (path, pos)
-            line = fin.readline()
+        self.use_mmap = use_mmap
+        self.scp_index = scp_index.ScpIndex.read(scp_path)
 
-        fin.close()
+        #the open file handles and memory maps, one per archive
+        self._handles = {}
+        self._maps = {}
 
     def read_utt_data(self, utt_id):
         '''
@@ -45,31 +70,196 @@ class ArkReader(object):
             a numpy array containing the data from the utterance
         '''
 
-        ark_read_buffer = open(self.scp_data[utt_id][0], 'rb')
-        ark_read_buffer.seek(int(self.scp_data[utt_id][1]), 0)
-        header = struct.unpack('<xcccc', ark_read_buffer.read(5))
-        if header[0] != "B":
-            print "Input .ark file is not binary"
-            exit(1)
-        if header[1] == "C":
-            print "Input .ark file is compressed"
-            exit(1)
+        return self.read_utt_at(self.scp_index.position(utt_id))
+
+    def read_utt_at(self, pos):
+        '''
+        read the data of the utterance at a position in the scp file
+
+        Args:
+            pos: the position of the utterance in the scp file
+
+        Returns:
+            a numpy array containing the data from the utterance, compact
+            matrix types are returned in their stored data type
+        '''
+
+        path, offset = self.scp_index.location(pos)
+
+        if self.use_mmap:
+            return read_matrix(self._map(path), offset)
+
+        #read the header to know the size of the matrix and read it at once
+        size = matrix_size(self._read(path, offset, HEADER_SIZE), 0)
+
+        return read_matrix(self._read(path, offset, size), 0)
+
+    def read_shape_at(self, pos):
+        '''
+        read the shape of the utterance at a position in the scp file, only
+        the header of the matrix is read
+
+        Args:
+            pos: the position of the utterance in the scp file
+
+        Returns:
+            the number of rows and columns of the matrix
+        '''
+
+        path, offset = self.scp_index.location(pos)
+
+        if self.use_mmap:
+            return matrix_shape(self._map(path), offset)
+
+        return matrix_shape(self._read(path, offset, HEADER_SIZE), 0)
+
+    def read_utts_at(self, positions, max_gap=MAX_READ_GAP,
+                     max_read=MAX_READ_SIZE):
+        '''
+        read the data of a number of utterances at once
+
+        The reads are planned: the utterances are read sorted by archive and
+        offset, and records that are close to each other in an archive are
+        read with a single sequential read. This turns the random seeks of a
+        shuffled scp file into near sequential reads. The sizes of the
+        records follow from the shapes in the index, only old scp files
+        without shapes need a header read per record. In mmap mode the
+        records are copied out of the mapping in archive order. The matrices
+        are returned in the order of the positions.
+
+        Args:
+            positions: the positions of the utterances in the scp file
+            max_gap: the maximal number of unused bytes between two records
+                that are read together
+            max_read: the maximal size of a single read in bytes
+
+        Returns:
+            a list containing a numpy array with the data of every utterance
+        '''
+
+        positions = np.asarray(positions, dtype=np.int64)
+        path_ids = self.scp_index.path_ids[positions]
+        offsets = self.scp_index.offsets[positions]
+        order = np.lexsort((offsets, path_ids))
+        utt_mats = [None]*len(positions)
+
+        if self.use_mmap:
+            #the views on the mapping would only be read when the batch is
+            #normalized or padded, in the order of the batch. The records are
+            #copied here in archive order, so the pages are faulted in
+            #sequentially and the kernel can read ahead
+            for i in order:
+                utt_mat = read_matrix(
+                    self._map(self.scp_index.paths[path_ids[i]]),
+                    int(offsets[i]))
+                utt_mats[i] = (utt_mat if utt_mat.flags.owndata
+                               else np.array(utt_mat))
+            return utt_mats
+
+        ends = np.zeros(len(positions), dtype=np.int64)
+        if (self.scp_index.num_frames is not None
+                and self.scp_index.dims is not None):
+            #the index knows the shapes, the type of the records is read from
+            #the header of one record per archive. A record of another type
+            #is read again on its own below
+            num_frames = self.scp_index.num_frames[positions]
+            dims = self.scp_index.dims[positions]
+            tokens = {}
+            for i in order:
+                if path_ids[i] not in tokens:
+                    header = self._read(self.scp_index.paths[path_ids[i]],
+                                        int(offsets[i]), HEADER_SIZE)
+                    tokens[path_ids[i]] = _read_token(header, 0)[0]
+                ends[i] = offsets[i] + record_size(
+                    tokens[path_ids[i]], int(num_frames[i]), int(dims[i]))
+        else:
+            #read the headers in archive order to know where every record
+            #ends
+            for i in order:
+                header = self._read(self.scp_index.paths[path_ids[i]],
+                                    int(offsets[i]), HEADER_SIZE)
+                ends[i] = offsets[i] + matrix_size(header, 0)
+
+        #read every group of records with one read
+        for first, last in plan_reads(path_ids[order], offsets[order],
+                                      ends[order], max_gap, max_read):
+            group = order[first:last]
+            start = int(offsets[group[0]])
+            data = self._read(self.scp_index.paths[path_ids[group[0]]],
+                              start, int(np.max(ends[group])) - start)
+            for i in group:
+                offset = int(offsets[i]) - start
+                if matrix_size(data, offset) != ends[i] - offsets[i]:
+                    utt_mats[i] = self.read_utt_at(int(positions[i]))
+                else:
+                    utt_mats[i] = read_matrix(data, offset)
+
+        return utt_mats
+
+    def _handle(self, path):
+        '''get the open file handle of an archive
+
+        Args:
+            path: path to the .ark file
+
+        Returns:
+            the file object of the archive, it is opened on first use'''
+
+        if path not in self._handles:
+            self._handles[path] = open(path, 'rb')
+
+        return self._handles[path]
+
+    def _map(self, path):
+        '''get the memory map of an archive
+
+        Args:
+            path: path to the .ark file
+
+        Returns:
+            a read-only mmap of the archive, it is created on first use'''
+
+        if path not in self._maps:
+            self._maps[path] = mmap.mmap(self._handle(path).fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+
+        return self._maps[path]
+
+    def _read(self, path, offset, size):
+        '''read a number of bytes from an archive
+
+        Args:
+            path: path to the .ark file
+            offset: the position in the archive in bytes
+            size: the number of bytes to read
+
+        Returns:
+            the read bytes as a string'''
+
+        if self.use_mmap:
+            return self._map(path)[offset:offset + size]
+
+        handle = self._handle(path)
+        handle.seek(offset, 0)
+        return handle.read(size)
 
-        _, rows = struct.unpack('<bi', ark_read_buffer.read(5))
-        _, cols = struct.unpack('<bi', ark_read_buffer.read(5))
+    def close(self):
+        '''release all memory maps and file handles of the reader'''
 
-        if header[1] == "F":
-            tmp_mat = np.frombuffer(ark_read_buffer.read(rows * cols * 4),
-                                    dtype=np.float32)
-        elif header[1] == "D":
-            tmp_mat = np.frombuffer(ark_read_buffer.read(rows * cols * 8),
-                                    dtype=np.float64)
+        self._maps = {}
+        for handle in self._handles.values():
+            handle.close()
+        self._handles = {}
 
-        utt_mat = np.reshape(tmp_mat, (rows, cols))
+    def __getstate__(self):
+        '''the state used when copying or pickling the reader, the open
+        handles are not part of it and are reopened when needed'''
 
-        ark_read_buffer.close()
+        state = self.__dict__.copy()
+        state['_handles'] = {}
+        state['_maps'] = {}
 
-        return utt_mat
+        return state
 
     def read_next_utt(self):
         '''
@@ -80,13 +270,13 @@ class ArkReader(object):
             bool that is true if the read utterance was the last one in the file
         '''
 
-        utt_id = self.scp_data.keys()[self.scp_position]
-        utt_data = self.read_utt_data(utt_id)
+        utt_id = self.scp_index.utt_id(self.scp_position)
+        utt_data = self.read_utt_at(self.scp_position)
 
         self.scp_position += 1
 
         #if at end of file loop around
-        if self.scp_position >= len(self.scp_data):
+        if self.scp_position >= len(self.scp_index):
             looped = True
             self.scp_position = 0
         else:
@@ -94,6 +284,26 @@ class ArkReader(object):
 
         return (utt_id, utt_data, looped)
 
+    def view(self, key):
+        '''create a reader for a part of the utterances of this reader
+
+        The new reader shares the index arrays and reads the same archives,
+        nothing is copied.
+
+        Args:
+            key: a slice or an array of positions in this reader
+
+        Returns:
+            an ark reader containing the selected utterances'''
+
+        reader = copy.copy(self)
+        reader.scp_index = self.scp_index[key]
+        reader.scp_position = 0
+        reader._handles = {}
+        reader._maps = {}
+
+        return reader
+
     def split(self, num_utt):
         '''take a number of utterances from the ark reader to make a new one
 
@@ -103,25 +313,271 @@ class ArkReader(object):
         Returns:
             an ark reader with the requested number of utterances'''
 
-        reader = copy.deepcopy(self)
-        keys = reader.scp_data.keys()[:num_utt]
-        reader.scp_data = {key: reader.scp_data[key] for key in keys}
-        keys = self.scp_data.keys()[num_utt:]
-        self.scp_data = {key: self.scp_data[key] for key in keys}
+        reader = self.view(slice(None, num_utt))
+        self.scp_index = self.scp_index[num_utt:]
 
         return reader
 
+    def shard(self, num_shards, shard_index):
+        '''create a reader for one of a number of interleaved shards
+
+        Args:
+            num_shards: the total number of shards
+            shard_index: the index of the shard
+
+        Returns:
+            an ark reader containing every num_shards'th utterance, starting
+            at shard_index'''
+
+        return self.view(slice(shard_index, None, num_shards))
+
     @property
     def num_utt(self):
         '''the number of utterances in the reader'''
-        return len(self.scp_data)
+        return len(self.scp_index)
+
+def read_matrix(data, offset):
+    '''
+    read a matrix from a buffer containing (a part of) an archive
+
+    Args:
+        data: the buffer, a string or an mmap
+        offset: the position of the binary marker of the matrix in the buffer
+
+    Returns:
+        the matrix as a numpy array, uncompressed matrices are read-only views
+        on the buffer in their stored data type and compressed matrices are
+        decompressed to float32
+    '''
+
+    token, offset = _read_token(data, offset)
+
+    if token in COMPRESSED_TOKENS:
+        min_value, value_range, rows, cols = struct.unpack(
+            '<ffii', data[offset:offset + 16])
+        offset += 16
+
+        if token == 'CM':
+            #one byte per value, quantized between per column percentiles
+            col_headers = np.frombuffer(data, dtype=np.uint16, count=4*cols,
+                                        offset=offset)
+            values = np.frombuffer(data, dtype=np.uint8, count=rows*cols,
+                                   offset=offset + 8*cols)
+            return decompress_col_headers(
+                min_value, value_range, col_headers.reshape(cols, 4),
+                values.reshape(cols, rows))
+
+        if token == 'CM2':
+            #two bytes per value, linearly quantized over the global range
+            values = np.frombuffer(data, dtype=np.uint16, count=rows*cols,
+                                   offset=offset)
+            increment = value_range/65535.0
+        else:
+            #one byte per value, linearly quantized over the global range
+            values = np.frombuffer(data, dtype=np.uint8, count=rows*cols,
+                                   offset=offset)
+            increment = value_range/255.0
+
+        utt_mat = values.astype(np.float32)
+        utt_mat *= np.float32(increment)
+        utt_mat += np.float32(min_value)
+
+        return utt_mat.reshape(rows, cols)
+
+    _, rows, _, cols = struct.unpack('<bibi', data[offset:offset + 10])
+
+    tmp_mat = np.frombuffer(data, dtype=MATRIX_TYPES[token], count=rows*cols,
+                            offset=offset + 10)
+
+    return np.reshape(tmp_mat, (rows, cols))
+
+def matrix_size(data, offset):
+    '''
+    compute the size of a matrix in an archive from its header
+
+    Args:
+        data: a buffer containing at least the first HEADER_SIZE bytes of the
+            matrix
+        offset: the position of the binary marker of the matrix in the buffer
+
+    Returns:
+        the size of the matrix in bytes, starting from the binary marker
+    '''
+
+    token, _ = _read_token(data, offset)
+    rows, cols = matrix_shape(data, offset)
+
+    return record_size(token, rows, cols)
+
+def record_size(token, rows, cols):
+    '''
+    compute the size of a matrix in an archive from its type and shape
+
+    Args:
+        token: the matrix type token
+        rows: the number of rows of the matrix
+        cols: the number of columns of the matrix
+
+    Returns:
+        the size of the matrix in bytes, starting from the binary marker
+    '''
+
+    size = 3 + len(token)
+
+    if token in COMPRESSED_TOKENS:
+        size += 16
+        if token == 'CM':
+            return size + 8*cols + rows*cols
+        if token == 'CM2':
+            return size + 2*rows*cols
+        return size + rows*cols
+
+    return size + 10 + rows*cols*MATRIX_TYPES[token].itemsize
+
+def matrix_shape(data, offset):
+    '''
+    read the shape of a matrix in an archive from its header
+
+    Args:
+        data: a buffer containing at least the first HEADER_SIZE bytes of the
+            matrix
+        offset: the position of the binary marker of the matrix in the buffer
+
+    Returns:
+        the number of rows and columns of the matrix
+    '''
+
+    token, header_end = _read_token(data, offset)
+
+    if token in COMPRESSED_TOKENS:
+        return struct.unpack('<ii', data[header_end + 8:header_end + 16])
+
+    _, rows, _, cols = struct.unpack('<bibi', data[header_end:header_end + 10])
+
+    return rows, cols
+
+def _read_token(data, offset):
+    '''
+    read the binary marker and the matrix type token
+
+    Args:
+        data: the buffer containing the matrix
+        offset: the position of the binary marker in the buffer
+
+    Returns:
+        the token and the position of the data that follows it
+    '''
+
+    #the binary marker is followed by a token describing the matrix type
+    header = data[offset:offset + 8]
+    if header[:2] != "\0B":
+        print "Input .ark file is not binary"
+        exit(1)
+    token = header[2:].split(' ')[0]
+
+    if token not in COMPRESSED_TOKENS and token not in MATRIX_TYPES:
+        print "Unknown matrix type %s in .ark file" % token
+        exit(1)
+
+    return token, offset + 3 + len(token)
+
+def plan_reads(path_ids, starts, ends, max_gap, max_read):
+    '''
+    group records that are sorted by archive and offset in reads
+
+    Args:
+        path_ids: the archive index of every record
+        starts: the position of every record in its archive
+        ends: the end position of every record in its archive
+        max_gap: the maximal number of unused bytes between two records in
+            the same read
+        max_read: the maximal size of a read in bytes, a larger record is
+            read on its own
+
+    Returns:
+        a list of (first, last) pairs, every read contains the records
+        first up to (not including) last
+    '''
+
+    reads = []
+    first = 0
+    read_end = 0
+
+    for i in range(len(starts)):
+        if (i == first
+                or path_ids[i] != path_ids[first]
+                or starts[i] - read_end > max_gap
+                or ends[i] - starts[first] > max_read):
+            if i > first:
+                reads.append((first, i))
+            first = i
+            read_end = ends[i]
+        else:
+            read_end = max(read_end, ends[i])
+
+    if len(starts):
+        reads.append((first, len(starts)))
+
+    return reads
+
+def decompress_col_headers(min_value, value_range, col_headers, data):
+    '''
+    decompress a Kaldi matrix in the compressed format with column headers (CM)
+
+    Every column stores the 0th, 25th, 75th and 100th percentile as a uint16
+    in the global range and every value as a byte that is interpolated
+    piecewise linearly between the percentiles of its column.
+
+    Args:
+        min_value: the minimum of the global range
+        value_range: the size of the global range
+        col_headers: a [cols x 4] uint16 numpy array containing the
+            quantized percentiles of every column
+        data: a [cols x rows] uint8 numpy array containing the quantized
+            values in column major order
+
+    Returns:
+        the decompressed [rows x cols] float32 matrix
+    '''
+
+    cols = col_headers.shape[0]
+
+    #the percentiles of every column as floats
+    percentiles = (np.float32(min_value) + np.float32(value_range)
+                   * np.float32(1.52590218966964e-05)
+                   * col_headers.astype(np.float32))
+    p0, p25, p75, p100 = [percentiles[:, i:i+1] for i in range(4)]
+
+    #create a lookup table with the value of all 256 bytes for every column
+    values = np.arange(256, dtype=np.float32)
+    table = np.where(
+        values <= 64,
+        p0 + (p25 - p0)*values*np.float32(1/64.0),
+        np.where(values <= 192,
+                 p25 + (p75 - p25)*(values - 64)*np.float32(1/128.0),
+                 p75 + (p100 - p75)*(values - 192)*np.float32(1/63.0)))
+
+    #look up all the values in the table of their column
+    utt_mat = table.ravel()[data + 256*np.arange(cols)[:, np.newaxis]]
+
+    return np.ascontiguousarray(utt_mat.T, dtype=np.float32)
 
 class ArkWriter(object):
     '''
     Class to write to Kaldi ark format
+
+    The archives stay open while the writer is used and all writes go through
+    large buffers. The number of frames and the dimension of every written
+    utterance are stored in the sidecar index of the .scp file when the writer
+    is closed.
+
+    The matrices are stored as float32 by default. float16 halves the size of
+    features and uint8 or uint16 can hold quantized integer data, these types
+    are only readable by the ArkReader.
     '''
 
-    def __init__(self, scp_path, default_ark):
+    def __init__(self, scp_path, default_ark, dtype=np.float32,
+                 buffer_size=4194304):
         '''
         Arkwriter constructor
 
@@ -129,12 +585,31 @@ class ArkWriter(object):
             scp_path: path to the .scp file that will be written
             default_ark: the name of the default ark file (used when not
                 specified)
+            dtype: the data type used to store the matrices, one of float32,
+                float64, float16, uint8 or uint16
+            buffer_size: the size of the write buffers in bytes
         '''
 
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in MATRIX_TOKENS:
+            raise Exception('unsupported archive data type %s' % self.dtype)
+
         self.scp_path = scp_path
-        self.scp_file_write = open(self.scp_path, 'w')
+        self.buffer_size = buffer_size
+        self.scp_file_write = open(self.scp_path, 'w', buffer_size)
         self.default_ark = default_ark
 
+        #the open archives
+        self._arks = {}
+
+        #the index of everything that was written
+        self._utt_ids = []
+        self._paths = []
+        self._path_ids = []
+        self._offsets = []
+        self._num_frames = []
+        self._dims = []
+
     def write_next_utt(self, utt_id, utt_mat, ark_path=None):
         '''
         write an utterance to the file
@@ -146,19 +621,62 @@ class ArkWriter(object):
         '''
 
         ark = ark_path or self.default_ark
-        ark_file_write = open(ark, 'ab')
-        utt_mat = np.asarray(utt_mat, dtype=np.float32)
+        if ark not in self._arks:
+            #the archives are appended to, like they always have been
+            self._arks[ark] = open(ark, 'ab', self.buffer_size)
+            self._arks[ark].seek(0, 2)
+            self._paths.append(ark)
+        ark_file_write = self._arks[ark]
+
+        if self.dtype.kind == 'u':
+            #integer data should fit in the storage type
+            info = np.iinfo(self.dtype)
+            if np.size(utt_mat) and (np.min(utt_mat) < info.min
+                                     or np.max(utt_mat) > info.max):
+                raise Exception('the data of %s does not fit in %s' %
+                                (utt_id, self.dtype))
+
+        utt_mat = np.ascontiguousarray(utt_mat, dtype=self.dtype)
         rows, cols = utt_mat.shape
-        ark_file_write.write(struct.pack('<%ds'%(len(utt_id)), utt_id))
-        pos = ark_file_write.tell()
-        ark_file_write.write(struct.pack('<xcccc', 'B', 'F', 'M', ' '))
-        ark_file_write.write(struct.pack('<bi', 4, rows))
-        ark_file_write.write(struct.pack('<bi', 4, cols))
+        token = MATRIX_TOKENS[self.dtype]
+        pos = ark_file_write.tell() + len(utt_id)
+        ark_file_write.write(struct.pack(
+            '<%dsxc%dscbibi' % (len(utt_id), len(token)), utt_id, 'B', token,
+            ' ', 4, rows, 4, cols))
         ark_file_write.write(utt_mat)
         self.scp_file_write.write('%s %s:%s\n' % (utt_id, ark, pos))
-        ark_file_write.close()
+
+        self._utt_ids.append(utt_id)
+        self._path_ids.append(self._paths.index(ark))
+        self._offsets.append(pos)
+        self._num_frames.append(rows)
+        self._dims.append(cols)
+
+    def flush(self):
+        '''flush the buffered writes to disk'''
+
+        for ark_file_write in self._arks.values():
+            ark_file_write.flush()
+        self.scp_file_write.flush()
+
+    @property
+    def index(self):
+        '''an ScpIndex of everything that was written'''
+
+        return scp_index.ScpIndex(
+            np.array(self._utt_ids, dtype=np.string_), list(self._paths),
+            np.array(self._path_ids, dtype=np.int32),
+            np.array(self._offsets, dtype=np.int64),
+            np.array(self._num_frames, dtype=np.int32),
+            np.array(self._dims, dtype=np.int32))
 
     def close(self):
         '''close the ark writer'''
 
+        for ark_file_write in self._arks.values():
+            ark_file_write.close()
+        self._arks = {}
         self.scp_file_write.close()
+
+        #store the index with the lengths next to the scp file
+        self.index.save(self.scp_path)
@@ -6,7 +6,7 @@
 
 from abc import ABCMeta, abstractmethod, abstractproperty
 import copy
-from nabu.processing import text_reader
+from nabu.processing import text_reader, target_store, sampler
 import numpy as np
 
 ## Class that dispenses batches of data for mini-batch training
@@ -15,6 +15,10 @@ class BatchDispenser(object):
     child classes.'''
     __metaclass__ = ABCMeta
 
+    #the keys of the state that hold sampling settings, they are taken from
+    #the state when it is restored
+    sampling_settings = ()
+
     def __init__(self, size):
         '''
         batchDispenser constructor
@@ -59,6 +63,60 @@ class BatchDispenser(object):
 
         return batch_inputs, batch_targets
 
+    def skip_batch(self):
+        '''move the position past the next batch, the batch is read when
+        there is no cheaper way to know where it ends'''
+
+        self.get_batch()
+
+    def state(self, pos=None):
+        '''
+        the sampling state of the batchdispenser, it can be stored as JSON and
+        restored with restore to continue with exactly the same batches
+
+        Args:
+            pos: the position that is stored instead of the current position,
+                e.g. the position of a prefetcher that reads ahead
+
+        Returns:
+            a dictionary containing the state
+        '''
+
+        return {'dispenser': type(self).__name__,
+                'num_utt': int(self.num_utt),
+                'size': int(self.size),
+                'pos': int(self.pos if pos is None else pos)}
+
+    def restore(self, state):
+        '''
+        restore a sampling state that was returned by state, the data must be
+        the same
+
+        Args:
+            state: the state dictionary
+        '''
+
+        differences = [key for key, value in self.state().items()
+                       if key != 'pos' and key not in self.sampling_settings
+                       and state.get(key) != value]
+        if differences:
+            raise Exception(
+                'the data state was stored for other data, %s differ' %
+                ', '.join(sorted(differences)))
+
+        self._restore_settings(state)
+        self.pos = state['pos']
+
+    def _restore_settings(self, state):
+        '''
+        take the sampling settings from a state that is restored
+
+        Args:
+            state: the state dictionary
+        '''
+
+        pass
+
     @abstractmethod
     def split(self, num_utt):
         '''take a number of utterances from the batchdispenser to make a new one
@@ -69,6 +127,18 @@ class BatchDispenser(object):
         Returns:
             a batch dispenser with the requested number of utterances'''
 
+    @abstractmethod
+    def shard(self, num_shards, shard_index):
+        '''create a batchdispenser for one of a number of interleaved shards
+        of the data
+
+        Args:
+            num_shards: the total number of shards
+            shard_index: the index of the shard
+
+        Returns:
+            a batch dispenser for the shard'''
+
     @abstractmethod
     def get_pair(self):
         '''get the next input-target pair'''
@@ -99,6 +169,12 @@ class BatchDispenser(object):
     def max_target_length(self):
         '''the maximal length of the targets'''
 
+    @property
+    def input_lengths(self):
+        '''the lengths of the inputs, None if they are not known'''
+
+        return None
+
     #pylint: disable=E0202
     @abstractproperty
     def pos(self):
@@ -109,8 +185,19 @@ class BatchDispenser(object):
     def pos(self, pos):
         '''setter for the current position in the data'''
 
-class AsrTextBatchDispenser(BatchDispenser):
-    '''a batch dispenser, used for ASR training'''
+class AsrBatchDispenser(BatchDispenser):
+    '''the common part of the batch dispensers used for ASR training, the
+    inputs are read with a feature reader and the text targets come from a
+    targets file
+
+    A sampler chooses the utterances of every batch before anything is read,
+    the utterances of a batch are then read together so the reads can be
+    planned. The position of the dispenser is the position of the sampler.'''
+
+    __metaclass__ = ABCMeta
+
+    sampling_settings = ('shuffle_seed', 'shuffle_block', 'bucket_boundaries',
+                         'max_batch_frames', 'max_batch_tokens')
 
     def __init__(self, feature_reader, target_coder, size, target_path):
         '''
@@ -125,375 +212,347 @@ class AsrTextBatchDispenser(BatchDispenser):
             target_path: path to the file containing the targets
         '''
 
-        #store the feature reader
+        #store the feature reader, it reads the utterances of a batch
+        #together so the reads can be planned
         self.feature_reader = feature_reader
+        self.feature_reader.read_ahead = size
 
         #save the target coder
         self.target_coder = target_coder
 
-        #get a dictionary connecting training utterances and targets.
-        self.target_dict = {}
+        #encode all the targets once, the store is shared by the views on
+        #this batchdispenser
+        self.targets = target_store.TargetStore(target_path, target_coder)
 
-        with open(target_path, 'r') as fid:
-            for line in fid:
-                splitline = line.strip().split(' ')
-                self.target_dict[splitline[0]] = ' '.join(splitline[1:])
+        super(AsrBatchDispenser, self).__init__(size)
 
-        super(AsrTextBatchDispenser, self).__init__(size)
-
-    def split(self, num_utt):
-        '''take a number of utterances from the batchdispenser to make a new one
+        #the utterances are taken in order until shuffle is called
+        self.shuffle_seed = None
+        self.shuffle_block = 0
 
-        Args:
-            num_utt: the number of utterances in the new batchdispenser
+        #the batches have a fixed number of utterances until set_budget is
+        #called
+        self.max_batch_frames = 0
+        self.max_batch_tokens = 0
 
-        Returns:
-            a batch dispenser with the requested number of utterances'''
+        #the batches are not bucketed until set_buckets is called
+        self.bucket_boundaries = None
 
-        #create a copy of self
-        dispenser = copy.deepcopy(self)
+        #create the sampler that chooses the utterances of the batches
+        self.sampler = self._make_sampler()
 
-        #split of a part of the feature reader
-        dispenser.feature_reader = self.feature_reader.split(num_utt)
+    def shuffle(self, seed, block_size=0):
+        '''
+        take the utterances in a different random order every epoch, the
+        order only depends on the seed and the epoch, so the position can
+        still be used to resume. The position is reset.
 
-        #get a list of keys in the featutre readers
-        dispenser_ids = dispenser.feature_reader.reader.scp_data.keys()
-        self_ids = self.feature_reader.reader.scp_data.keys()
+        Args:
+            seed: the seed of the shuffling
+            block_size: if larger than 0 only blocks of block_size consecutive
+                utterances are shuffled, so the reads stay mostly sequential
+        '''
 
-        #split the target dicts
-        dispenser.target_dict = {key: dispenser.target_dict[key] for key in
-                                 dispenser_ids}
-        self.target_dict = {key: self.target_dict[key] for key in self_ids}
+        self.shuffle_seed = seed
+        self.shuffle_block = block_size
+        self.sampler = self._make_sampler()
 
-        return dispenser
+    def set_budget(self, max_frames, max_tokens=0):
+        '''
+        fill the batches up to a budget of padded frames and target tokens
+        instead of a fixed number of utterances. A batch contains the
+        following utterances as long as their number times the longest input
+        and target sequence fits in the budget, with at most size utterances.
+        The remaining places of the batch are left empty. The position is
+        reset.
 
-    def get_pair(self):
-        '''get the next input-target pair'''
+        Args:
+            max_frames: the maximal number of padded input frames in a batch,
+                0 for no limit
+            max_tokens: the maximal number of padded target tokens in a
+                batch, 0 for no limit
+        '''
 
-        utt_id, inputs, _ = self.feature_reader.get_utt()
+        if max_frames > 0 and self.input_lengths is None:
+            raise Exception(
+                'the frame budget needs the lengths of the utterances, they '
+                'come from the manifest of the data')
 
-        if utt_id in self.target_dict and self.target_dict[utt_id] != '':
-            texttargets = self.target_coder.encode(self.target_dict[utt_id])
-        else:
-        # when doing supervised training on a dataset where a lot of the
-        # utterances have no labels, we cant do anything with these utterances
-    #        print 'WARNING no targets for %s' % utt_id
-            texttargets = None
-            inputs = None
+        self.max_batch_frames = max_frames
+        self.max_batch_tokens = max_tokens
+        self.sampler = self._make_sampler()
 
-        return inputs, (texttargets, np.zeros([1, 1]))
+    def set_buckets(self, boundaries):
+        '''
+        take every batch from a single bucket of utterances with similar
+        input lengths, the batches of all buckets are taken in a different
+        random order every epoch. The position is reset.
 
-    @property
-    def num_utt(self):
-        '''The number of utterances in the given data
-        (returns only the one where text targets are available)
+        Args:
+            boundaries: the sorted maximal input lengths of the buckets, the
+                longer utterances go in the last bucket
         '''
-        utterances_with_text_targets = [utt for utt in self.target_dict\
-                                        if self.target_dict[utt] != '']
-        return len(utterances_with_text_targets)
 
-    @property
-    def num_labels(self):
-        '''the number of output labels'''
+        if self.input_lengths is None:
+            raise Exception(
+                'bucketing needs the lengths of the utterances, they come '
+                'from the manifest of the data')
 
-        return self.target_coder.num_labels
+        self.bucket_boundaries = boundaries
+        self.sampler = self._make_sampler()
 
-    @property
-    def max_input_length(self):
-        '''the maximal sequence length of the features'''
+    def state(self, pos=None):
+        '''
+        the sampling state of the batchdispenser, it can be stored as JSON and
+        restored with restore to continue with exactly the same batches
 
-        return self.feature_reader.max_length
+        The batches only depend on the shuffling, buckets and budget and on
+        the position of the sampler, the epoch and the order of the
+        utterances in it follow from the position.
 
-    @property
-    def max_target_length(self):
-        '''the maximal length of the targets'''
-        part1 = max([len(targets.split(' '))
-                     for targets in self.target_dict.values()])
-        return(part1, 1)
+        Args:
+            pos: the position that is stored instead of the current position,
+                e.g. the position of a prefetcher that reads ahead
 
+        Returns:
+            a dictionary containing the state
+        '''
 
-    @property
-    def pos(self):
-        '''the current position in the data'''
+        state = super(AsrBatchDispenser, self).state(pos)
 
-        return self.feature_reader.pos
+        boundaries = self.bucket_boundaries
+        if boundaries is not None:
+            boundaries = [int(boundary) for boundary in boundaries]
 
-    @pos.setter
-    def pos(self, pos):
-        '''setter for the current position in the data'''
+        state.update(
+            strata=self.strata_sizes,
+            shuffle_seed=self.shuffle_seed,
+            shuffle_block=int(self.shuffle_block),
+            bucket_boundaries=boundaries,
+            max_batch_frames=int(self.max_batch_frames),
+            max_batch_tokens=int(self.max_batch_tokens))
 
-        self.feature_reader.pos = pos
+        return state
 
+    def _restore_settings(self, state):
+        '''
+        take the shuffling, buckets and budget from a state that is restored
 
-class AsrTextBatchDispenserAlt(BatchDispenser):
-    '''a batch dispenser, used for ASR training'''
+        Args:
+            state: the state dictionary
+        '''
 
-    def __init__(self, feature_reader, target_coder, size, target_path):
+        self.shuffle_seed = state['shuffle_seed']
+        self.shuffle_block = state['shuffle_block']
+        self.bucket_boundaries = state['bucket_boundaries']
+        self.max_batch_frames = state['max_batch_frames']
+        self.max_batch_tokens = state['max_batch_tokens']
+        self.sampler = self._make_sampler()
+
+    def get_batch(self, pos=None):
         '''
-        batchDispenser constructor
+        Get a batch of features and targets.
 
         Args:
-            feature_reader: Kaldi ark-file feature reader instance.
-            target_coder: a TargetCoder object to encode and decode the target
-                sequences
-            size: Specifies how many utterances should be contained
-                  in each batch.
-            target_path: path to the file containing the targets
-        '''
+            pos: position in the sampler, if None will remain unchanged
 
-        #store the feature reader
-        self.feature_reader = feature_reader
+        Returns:
+            A pair containing:
+                - The features: a list of feature matrices
+                - The targets: a list of target tupples(!), where the second
+                    element of each tupple can be used for varying reasons
+                        example: quantized audio samples
+        '''
 
-        #save the target coder
-        self.target_coder = target_coder
+        if pos is not None:
+            self.pos = pos
 
-        #get a dictionary connecting training utterances and targets.
-        self.target_dict = {}
+        return self._get_batch_at(self.sampler.next_batch())
 
-        with open(target_path, 'r') as fid:
-            for line in fid:
-                splitline = line.strip().split(' ')
-                self.target_dict[splitline[0]] = ' '.join(splitline[1:])
+    def skip_batch(self):
+        '''move the position past the next batch without reading it'''
 
-        super(AsrTextBatchDispenserAlt, self).__init__(size)
+        self.sampler.next_batch()
 
-    def split(self, num_utt):
-        '''take a number of utterances from the batchdispenser to make a new one
+    def _get_batch_at(self, positions):
+        '''
+        read the utterances at a number of positions in the feature reader
+        and create their input-target pairs
 
         Args:
-            num_utt: the number of utterances in the new batchdispenser
+            positions: the positions of the utterances in the feature reader
 
         Returns:
-            a batch dispenser with the requested number of utterances'''
-
-        #create a copy of self
-        dispenser = copy.deepcopy(self)
-
-        #split of a part of the feature reader
-        dispenser.feature_reader = self.feature_reader.split(num_utt)
+            the inputs and the targets of the batch as returned by get_batch
+        '''
 
-        #get a list of keys in the featutre readers
-        dispenser_ids = dispenser.feature_reader.reader.scp_data.keys()
-        self_ids = self.feature_reader.reader.scp_data.keys()
+        batch_inputs = []
+        batch_targets = []
 
-        #split the target dicts
-        dispenser.target_dict = {key: dispenser.target_dict[key] for key in
-                                 dispenser_ids}
-        self.target_dict = {key: self.target_dict[key] for key in self_ids}
+        for utt_id, inputs in self.feature_reader.get_utts_at(positions):
+            inputs, targets = self._get_pair(utt_id, inputs)
+            batch_inputs.append(inputs)
+            batch_targets.append(targets)
 
-        return dispenser
+        return batch_inputs, batch_targets
 
     def get_pair(self):
-        '''get the next input-target pair'''
+        '''get the next input-target pair from the feature reader'''
 
         utt_id, inputs, _ = self.feature_reader.get_utt()
 
-        if utt_id in self.target_dict and self.target_dict[utt_id] != '':
-            texttargets = self.target_coder.encode(self.target_dict[utt_id])
-        else:
-            texttargets = self.target_coder.encode('')
-
-        return inputs, (texttargets, np.zeros([1, 1]))
+        return self._get_pair(utt_id, inputs)
 
-    @property
-    def num_utt(self):
-        '''The number of utterances in the given data
+    @abstractmethod
+    def _get_pair(self, utt_id, inputs):
         '''
-        return len(self.target_dict)
-
-    @property
-    def num_labels(self):
-        '''the number of output labels'''
-
-        return self.target_coder.num_labels
-
-    @property
-    def max_input_length(self):
-        '''the maximal sequence length of the features'''
-
-        return self.feature_reader.max_length
+        create the input-target pair of an utterance
 
-    @property
-    def max_target_length(self):
-        '''the maximal length of the targets'''
-        part1 = max([len(targets.split(' '))
-                     for targets in self.target_dict.values()])
-        return(part1, 1)
+        Args:
+            utt_id: the ID of the utterance
+            inputs: the features of the utterance
 
+        Returns:
+            the inputs and the targets tupple
+        '''
 
-    @property
-    def pos(self):
-        '''the current position in the data'''
+    def _strata(self):
+        '''the strata the utterances of a batch are taken from, as a list of
+        pairs containing the positions in the feature reader of the
+        utterances of the stratum and their number in a batch. By default
+        all utterances are taken'''
 
-        return self.feature_reader.pos
+        return [(np.arange(self.feature_reader.num_utt), self.size)]
 
-    @pos.setter
-    def pos(self, pos):
-        '''setter for the current position in the data'''
+    def _create_sampler(self):
+        '''create the sampler that chooses the utterances of the batches
+        from the strata'''
 
-        self.feature_reader.pos = pos
+        strata = self._strata()
 
-class AsrTextBatchDispenserAltFixRatio(BatchDispenser):
-    '''a batch dispenser, used for ASR training'''
+        #the number of utterances of every stratum and their number in a
+        #batch are part of the sampling state
+        self.strata_sizes = [[len(positions), int(count)]
+                             for positions, count in strata]
 
-    def __init__(self, feature_reader, target_coder, size, target_path,
-                 percentage_unlabeled):
-        '''
-        batchDispenser constructor
+        if self.bucket_boundaries is not None:
+            return sampler.BucketSampler(
+                strata, self.input_lengths, self.bucket_boundaries,
+                self.shuffle_seed, self.shuffle_block)
 
-        Args:
-            feature_reader: Kaldi ark-file feature reader instance.
-            target_coder: a TargetCoder object to encode and decode the target
-                sequences
-            size: Specifies how many utterances should be contained
-                  in each batch.
-            target_path: path to the file containing the targets
-        '''
+        if len(strata) == 1:
+            return sampler.SequentialSampler(
+                strata[0][0], self.size, self.shuffle_seed,
+                self.shuffle_block)
 
-        #store the feature reader
-        self.feature_reader = feature_reader
+        return sampler.StratifiedSampler(strata, self.shuffle_seed,
+                                         self.shuffle_block)
 
-        #save the target coder
-        self.target_coder = target_coder
+    def _make_sampler(self):
+        '''create the sampler of the batches, limited to the budget of
+        padded frames and tokens if there is one'''
 
-        #get a dictionary connecting training utterances and targets.
-        self.target_dict = {}
+        batch_sampler = self._create_sampler()
 
-        # store the percentage to be unlabeled
-        self.percentage_unlabeled = percentage_unlabeled
+        if self.max_batch_frames <= 0 and self.max_batch_tokens <= 0:
+            return batch_sampler
 
-        # create buffers
-        self.buffer_lab = []
-        self.buffer_unlab = []
+        if not isinstance(batch_sampler, sampler.SequentialSampler):
+            raise Exception(
+                'batches with a budget of frames and tokens can not be used '
+                'together with a fixed ratio of unlabeled utterances or '
+                'with buckets')
 
-        with open(target_path, 'r') as fid:
-            for line in fid:
-                splitline = line.strip().split(' ')
-                self.target_dict[splitline[0]] = ' '.join(splitline[1:])
+        return sampler.BudgetSampler(
+            batch_sampler, self.input_lengths, self.target_lengths,
+            self.max_batch_frames, self.max_batch_tokens)
 
-        super(AsrTextBatchDispenserAltFixRatio, self).__init__(size)
+    def split(self, num_utt):
+        '''take a number of utterances from the batchdispenser to make a new one
 
-    def get_batch(self, pos=None):
-        '''
-        Get a batch of features and targets.
+        The new batchdispenser is a view on the same data, the targets are
+        shared and nothing is copied.
 
         Args:
-            pos: position in the reader, if None will remain unchanged
+            num_utt: the number of utterances in the new batchdispenser
 
         Returns:
-            A pair containing:
-                - The features: a list of feature matrices
-                - The targets: a list of target tupples(!), where the second
-                    element of each tupple can be used for varying reasons
-                        example: quantized audio samples
-        '''
-
-        #set up the data lists.
-        batch_inputs = []
-        batch_targets = []
+            a batch dispenser with the requested number of utterances'''
 
-        #calculate the number of examples we want to be unlabeled
-        nbr_unlabeled = int(self.size*self.percentage_unlabeled)
-        nbr_labeled = self.size - nbr_unlabeled
+        dispenser = self._view(self.feature_reader.split(num_utt))
 
-        #hold two counters
-        counter_unlab = 0
-        counter_lab = 0
+        #the utterances of the new batchdispenser are taken from this one
+        self.sampler = self._make_sampler()
 
-        if pos is not None:
-            self.pos = pos
+        return dispenser
 
-        while len(batch_inputs) < self.size:
-            # if we still need unlabeled examples, take out buffer if possible
-            if counter_unlab < nbr_unlabeled and len(self.buffer_unlab) > 0:
-                new_pair = self.buffer_unlab.pop(0)
-                counter_unlab = counter_unlab + 1
+    def shard(self, num_shards, shard_index):
+        '''create a batchdispenser for one of a number of interleaved shards
+        of the data, nothing is copied
 
-            # if we still need labeled examples, take out buffer if possible
-            elif counter_lab < nbr_labeled and len(self.buffer_lab) > 0:
-                new_pair = self.buffer_lab.pop(0)
-                counter_lab = counter_lab + 1
+        Args:
+            num_shards: the total number of shards
+            shard_index: the index of the shard
 
-            # if in none above cases, get a new candidate pair out of data
-            #read the next pair
-            else:
-                inputs_cand, targets_cand = self.get_pair()
-
-                if targets_cand[0] is not None:
-                    # if this candidate is unlabeled
-                    if len(targets_cand[0]) == 0:
-                        # add to batch when still needed
-                        if counter_unlab < nbr_unlabeled:
-                            new_pair = (inputs_cand, targets_cand)
-                            counter_unlab = counter_unlab + 1
-                        # if not needed, store in buffer
-                        else:
-                            new_pair = None
-                            self.buffer_unlab.append(
-                                (inputs_cand, targets_cand))
-                    # if this candidate is labeled
-                    else:
-                        # add to batch when still needed
-                        if counter_lab < nbr_labeled:
-                            new_pair = (inputs_cand, targets_cand)
-                            counter_lab = counter_lab + 1
-                        # if not needed, store in buffer
-                        else:
-                            new_pair = None
-                            self.buffer_lab.append((inputs_cand, targets_cand))
-                else:
-                    new_pair = None
-
-            # if a new pair was found, add it to the batch_inputs
-            if new_pair is not None:
-                batch_inputs.append(new_pair[0])
-                batch_targets.append(new_pair[1])
-        return batch_inputs, batch_targets
+        Returns:
+            a batch dispenser containing every num_shards'th utterance,
+            starting at shard_index'''
 
+        return self._view(self.feature_reader.shard(num_shards, shard_index))
 
-    def split(self, num_utt):
-        '''take a number of utterances from the batchdispenser to make a new one
+    def _view(self, feature_reader):
+        '''create a batchdispenser that reads from another feature reader and
+        shares everything else with this one
 
         Args:
-            num_utt: the number of utterances in the new batchdispenser
+            feature_reader: the feature reader of the new batchdispenser
 
         Returns:
-            a batch dispenser with the requested number of utterances'''
+            the new batch dispenser'''
 
-        #create a copy of self
-        dispenser = copy.deepcopy(self)
+        dispenser = copy.copy(self)
+        dispenser.feature_reader = feature_reader
+        dispenser.sampler = dispenser._make_sampler()
 
-        #split of a part of the feature reader
-        dispenser.feature_reader = self.feature_reader.split(num_utt)
-
-        #get a list of keys in the featutre readers
-        dispenser_ids = dispenser.feature_reader.reader.scp_data.keys()
-        self_ids = self.feature_reader.reader.scp_data.keys()
+        return dispenser
 
-        #split the target dicts
-        dispenser.target_dict = {key: dispenser.target_dict[key] for key in
-                                 dispenser_ids}
-        self.target_dict = {key: self.target_dict[key] for key in self_ids}
+    def _labeled(self):
+        '''whether or not the utterances in the feature reader are labeled,
+        as a boolean numpy array in reading order'''
 
-        return dispenser
+        positions = self._manifest_positions()
+        if positions is not None:
+            return self.feature_reader.manifest.labeled[positions]
 
-    def get_pair(self):
-        '''get the next input-target pair'''
+        return self.target_lengths > 0
 
-        utt_id, inputs, _ = self.feature_reader.get_utt()
+    def _manifest_positions(self):
+        '''the positions of the utterances of the feature reader in its
+        manifest, in reading order, or None if the reader has no manifest
+        with target statistics'''
 
-        if utt_id in self.target_dict and self.target_dict[utt_id] != '':
-            texttargets = self.target_coder.encode(self.target_dict[utt_id])
-        else:
-            texttargets = self.target_coder.encode('')
+        feature_manifest = getattr(self.feature_reader, 'manifest', None)
+        if feature_manifest is None or feature_manifest.target_lengths is None:
+            return None
 
-        return inputs, (texttargets, np.zeros([1, 1]))
+        return feature_manifest.positions(self.feature_reader.utt_ids)
 
     @property
     def num_utt(self):
-        '''The number of utterances in the given data
+        '''The number of utterances in the given data'''
+
+        return self.feature_reader.num_utt
+
+    @property
+    def num_batches(self):
         '''
-        return len(self.target_dict)
+        The number of batches in the given data.
+
+        The number of batches is not necessarily a whole number, with a
+        budget it is the number of batches in the first epoch
+        '''
+
+        return self.sampler.num_batches
 
     @property
     def num_labels(self):
@@ -508,149 +567,180 @@ class AsrTextBatchDispenserAltFixRatio(BatchDispenser):
         return self.feature_reader.max_length
 
     @property
-    def max_target_length(self):
-        '''the maximal length of the targets'''
-        part1 = max([len(targets.split(' '))
-                     for targets in self.target_dict.values()])
-        return(part1, 1)
+    def input_lengths(self):
+        '''the lengths of the inputs in reading order, they come from the
+        manifest or the index of the feature reader without reading the
+        features, None if they are not known'''
+
+        return self.feature_reader.lengths
 
+    @property
+    def target_lengths(self):
+        '''the lengths of the text targets in reading order, they come from
+        the manifest if it has them'''
+
+        positions = self._manifest_positions()
+        if positions is not None:
+            return self.feature_reader.manifest.target_lengths[positions]
+
+        return self.targets.lengths_of(self.feature_reader.utt_ids.tolist())
 
     @property
     def pos(self):
         '''the current position in the data'''
 
-        return self.feature_reader.pos
+        return self.sampler.pos
 
     @pos.setter
     def pos(self, pos):
         '''setter for the current position in the data'''
 
-        self.feature_reader.pos = pos
+        self.sampler.pos = pos
 
-class LmBatchDispenser(BatchDispenser):
-    '''a batch dispenser, used for language model training'''
+class AsrTextBatchDispenser(AsrBatchDispenser):
+    '''a batch dispenser, used for ASR training, only the labeled utterances
+    are used'''
 
-    def __init__(self, target_coder, size, textfile, max_length,
-                 num_utt):
+    def __init__(self, feature_reader, target_coder, size, target_path):
         '''
-        BatchDispenser constructor
+        batchDispenser constructor
 
         Args:
+            feature_reader: Kaldi ark-file feature reader instance.
+            target_coder: a TargetCoder object to encode and decode the target
+                sequences
             size: Specifies how many utterances should be contained
                   in each batch.
-            textfile: path to the file containing the text
-            max_length: the maximum length of the text sequences
-            num_utt: number of lines in the textfile
+            target_path: path to the file containing the targets
         '''
 
-        #create a text reader object
-        self.textreader = text_reader.TextReader(textfile, max_length,
-                                                 target_coder)
+        super(AsrTextBatchDispenser, self).__init__(
+            feature_reader, target_coder, size, target_path)
 
-        #the total number of utterances
-        self._num_utt = num_utt
+    def _strata(self):
+        '''only the labeled utterances are sampled, so the unlabeled ones
+        are never read'''
 
-        super(LmBatchDispenser, self).__init__(size)
+        return [(np.flatnonzero(self._labeled()), self.size)]
 
-    def split(self, num_utt):
-        '''take a number of utterances from the batchdispenser to make a new one
+    def _get_pair(self, utt_id, inputs):
+        '''create the input-target pair of an utterance'''
 
-        Args:
-            num_utt: the number of utterances in the new batchdispenser
+        if self.targets.is_labeled(utt_id):
+            texttargets = self.targets.get(utt_id)
+        else:
+        # when doing supervised training on a dataset where a lot of the
+        # utterances have no labels, we cant do anything with these utterances
+            texttargets = None
+            inputs = None
 
-        Returns:
-            a batch dispenser with the requested number of utterances'''
+        return inputs, (texttargets, np.zeros([1, 1]))
 
-        #create a copy of self
-        dispenser = copy.deepcopy(self)
+    @property
+    def num_utt(self):
+        '''The number of utterances in the given data
+        (returns only the one where text targets are available)
+        '''
+        return self.sampler.num_utt
 
-        #split the textreader
-        dispenser.textreader = self.textreader.split(num_utt)
-        dispenser.unm_utt = num_utt
-        self._num_utt -= num_utt
+    @property
+    def max_target_length(self):
+        '''the maximal length of the targets'''
+        part1 = self.targets.max_length
+        return(part1, 1)
 
-        return dispenser
 
-    def get_pair(self):
-        '''get the next input-target pair'''
+class AsrTextBatchDispenserAlt(AsrBatchDispenser):
+    '''a batch dispenser, used for ASR training'''
 
-        _, targets, _ = self.textreader.get_utt()
+    def __init__(self, feature_reader, target_coder, size, target_path):
+        '''
+        batchDispenser constructor
 
-        return targets, (targets[:, 0], np.zeros(1))
+        Args:
+            feature_reader: Kaldi ark-file feature reader instance.
+            target_coder: a TargetCoder object to encode and decode the target
+                sequences
+            size: Specifies how many utterances should be contained
+                  in each batch.
+            target_path: path to the file containing the targets
+        '''
 
-    @property
-    def num_labels(self):
-        '''the number of output labels'''
+        super(AsrTextBatchDispenserAlt, self).__init__(
+            feature_reader, target_coder, size, target_path)
 
-        return self.textreader.coder.num_labels
+    def _get_pair(self, utt_id, inputs):
+        '''create the input-target pair of an utterance'''
 
-    @property
-    def max_input_length(self):
-        '''the maximal sequence length of the features'''
+        texttargets = self.targets.get(utt_id)
+        if texttargets is None:
+            texttargets = self.targets.empty
 
-        return self.textreader.max_length
+        return inputs, (texttargets, np.zeros([1, 1]))
 
     @property
     def max_target_length(self):
         '''the maximal length of the targets'''
+        part1 = self.targets.max_length
+        return(part1, 1)
 
-        return (self.textreader.max_length, 1)
-
-    @property
-    def num_utt(self):
-        '''The number of utterances in the given data'''
-
-        return self._num_utt
-
-    @property
-    def pos(self):
-        '''the current position in the data'''
-
-        return self.textreader.pos
-
-    @pos.setter
-    def pos(self, pos):
-        '''setter for the current position in the data'''
-
-        self.textreader.pos = pos
-
-class AsrTextAndAudioBatchDispenser(BatchDispenser):
-    '''a batch dispenser, used for ASR training, when working with
-    (partly) non-supervised data and audio samples'''
+class AsrTextBatchDispenserAltFixRatio(AsrTextBatchDispenserAlt):
+    '''a batch dispenser, used for ASR training, every batch contains a
+    fixed ratio of unlabeled utterances'''
 
-    def __init__(self, feature_reader, audio_reader, target_coder, size,
-                 target_path):
+    def __init__(self, feature_reader, target_coder, size, target_path,
+                 percentage_unlabeled):
         '''
         batchDispenser constructor
 
         Args:
             feature_reader: Kaldi ark-file feature reader instance.
-            audio_reader: Kaldi ark-file feature reader for the audio samples
             target_coder: a TargetCoder object to encode and decode the target
                 sequences
             size: Specifies how many utterances should be contained
                   in each batch.
             target_path: path to the file containing the targets
+            percentage_unlabeled: the fraction of the utterances in a batch
+                that is unlabeled
         '''
 
-        #store the feature reader
-        self.feature_reader = feature_reader
+        # store the percentage to be unlabeled
+        self.percentage_unlabeled = percentage_unlabeled
 
-        #store the audio reader
-        self.audio_reader = audio_reader
+        super(AsrTextBatchDispenserAltFixRatio, self).__init__(
+            feature_reader, target_coder, size, target_path)
 
-        #save the target coder
-        self.target_coder = target_coder
+    def _strata(self):
+        '''the labeled and unlabeled utterances of every batch are chosen
+        before they are read'''
 
-        #get a dictionary connecting training utterances and targets.
-        self.target_dict = {}
+        return fixed_ratio_strata(self._labeled(), self.size,
+                                  self.percentage_unlabeled)
 
-        with open(target_path, 'r') as fid:
-            for line in fid:
-                splitline = line.strip().split(' ')
-                self.target_dict[splitline[0]] = ' '.join(splitline[1:])
+class LmBatchDispenser(BatchDispenser):
+    '''a batch dispenser, used for language model training'''
 
-        super(AsrTextAndAudioBatchDispenser, self).__init__(size)
+    def __init__(self, target_coder, size, textfile, max_length,
+                 num_utt):
+        '''
+        BatchDispenser constructor
+
+        Args:
+            size: Specifies how many utterances should be contained
+                  in each batch.
+            textfile: path to the file containing the text
+            max_length: the maximum length of the text sequences
+            num_utt: number of lines in the textfile
+        '''
+
+        #create a text reader object
+        self.textreader = text_reader.TextReader(textfile, max_length,
+                                                 target_coder)
+
+        #the total number of utterances
+        self._num_utt = num_utt
+
+        super(LmBatchDispenser, self).__init__(size)
 
     def split(self, num_utt):
         '''take a number of utterances from the batchdispenser to make a new one
@@ -661,88 +751,91 @@ class AsrTextAndAudioBatchDispenser(BatchDispenser):
         Returns:
             a batch dispenser with the requested number of utterances'''
 
-        #create a copy of self
-        dispenser = copy.deepcopy(self)
+        #create a shallow copy of self
+        dispenser = copy.copy(self)
 
-        #split of a part of the feature reader
-        dispenser.feature_reader = self.feature_reader.split(num_utt)
+        #split the textreader
+        dispenser.textreader = self.textreader.split(num_utt)
+        dispenser._num_utt = num_utt
+        self._num_utt -= num_utt
 
-        #get a list of keys in the featutre readers
-        dispenser_ids = dispenser.feature_reader.reader.scp_data.keys()
-        self_ids = self.feature_reader.reader.scp_data.keys()
+        return dispenser
 
-        #split the target dicts
-        dispenser.target_dict = {key: dispenser.target_dict[key] for key in
-                                 dispenser_ids}
-        self.target_dict = {key: self.target_dict[key] for key in self_ids}
+    def shard(self, num_shards, shard_index):
+        '''create a batchdispenser for one of a number of interleaved shards
+        of the data, nothing is copied
 
-        return dispenser
+        Args:
+            num_shards: the total number of shards
+            shard_index: the index of the shard
 
-    def get_pair(self):
-        '''get the next input-target pair'''
+        Returns:
+            a batch dispenser containing every num_shards'th line, starting
+            at shard_index'''
 
-        utt_id, inputs, _ = self.feature_reader.get_utt()
+        #create a shallow copy of self
+        dispenser = copy.copy(self)
 
-        if utt_id in self.target_dict:
-            # normally the unlabeled data is simply encoded with '' as targets
-            text_targets = self.target_coder.encode(self.target_dict[utt_id])
-        else:
-            #When something wrong, simply take empty string as target
-            text_targets = self.target_coder.encode('')
+        dispenser.textreader = self.textreader.shard(num_shards, shard_index)
+        dispenser._num_utt = len(dispenser.textreader.next_pos)
 
-        audio_samples = self.audio_reader.get_utt_with_id(utt_id)
+        return dispenser
 
-        # the targets should be a pair of the real targets and the audio samples
-        targets = (text_targets, audio_samples)
+    def skip_batch(self):
+        '''move the position past the next batch, the lines are not
+        encoded'''
 
-        return inputs, targets
+        self.textreader.skip_lines(self.size)
 
-    @property
-    def num_utt(self):
-        '''The number of utterances in the given data'''
+    def get_pair(self):
+        '''get the next input-target pair'''
 
-        return len(self.target_dict)
+        _, targets, _ = self.textreader.get_utt()
+
+        return targets, (targets[:, 0], np.zeros(1))
 
     @property
     def num_labels(self):
         '''the number of output labels'''
 
-        return self.target_coder.num_labels
+        return self.textreader.coder.num_labels
 
     @property
     def max_input_length(self):
         '''the maximal sequence length of the features'''
 
-        return self.feature_reader.max_length
+        return self.textreader.max_length
 
     @property
     def max_target_length(self):
         '''the maximal length of the targets'''
-        part1 = max([len(targets.split(' '))
-                     for targets in self.target_dict.values()])
-        part2 = self.audio_reader.max_length
-        return(part1, part2)
 
+        return (self.textreader.max_length, 1)
+
+    @property
+    def num_utt(self):
+        '''The number of utterances in the given data'''
+
+        return self._num_utt
 
     @property
     def pos(self):
         '''the current position in the data'''
 
-        return self.feature_reader.pos
+        return self.textreader.pos
 
     @pos.setter
     def pos(self, pos):
         '''setter for the current position in the data'''
 
-        self.feature_reader.pos = pos
-
+        self.textreader.pos = pos
 
-class AsrTextAndAudioBatchDispenserFixRatio(BatchDispenser):
+class AsrTextAndAudioBatchDispenser(AsrBatchDispenser):
     '''a batch dispenser, used for ASR training, when working with
     (partly) non-supervised data and audio samples'''
 
     def __init__(self, feature_reader, audio_reader, target_coder, size,
-                 target_path, percentage_unlabeled):
+                 target_path):
         '''
         batchDispenser constructor
 
@@ -756,146 +849,20 @@ class AsrTextAndAudioBatchDispenserFixRatio(BatchDispenser):
             target_path: path to the file containing the targets
         '''
 
-        #store the feature reader
-        self.feature_reader = feature_reader
-
         #store the audio reader
         self.audio_reader = audio_reader
 
-        #save the target coder
-        self.target_coder = target_coder
-
-        #get a dictionary connecting training utterances and targets.
-        self.target_dict = {}
-
-        #set up the data lists.
-        self.buffer_lab = []
-        self.buffer_unlab = []
-
-        #save the percentage we want to be unlabeled
-        self.percentage_unlabeled = percentage_unlabeled
-
-        with open(target_path, 'r') as fid:
-            for line in fid:
-                splitline = line.strip().split(' ')
-                self.target_dict[splitline[0]] = ' '.join(splitline[1:])
-
-        super(AsrTextAndAudioBatchDispenserFixRatio, self).__init__(size)
-
-    def get_batch(self, pos=None):
-        '''
-        Get a batch of features and targets.
-
-        Args:
-            pos: position in the reader, if None will remain unchanged
-
-        Returns:
-            A pair containing:
-                - The features: a list of feature matrices
-                - The targets: a list of target tupples(!), where the second
-                    element of each tupple can be used for varying reasons
-                        example: quantized audio samples
-        '''
-
-        #set up the data lists.
-        batch_inputs = []
-        batch_targets = []
-
-        #calculate the number of examples we want to be unlabeled
-        nbr_unlabeled = int(self.size*self.percentage_unlabeled)
-        nbr_labeled = self.size - nbr_unlabeled
-
-        #hold two counters
-        counter_unlab = 0
-        counter_lab = 0
-
-        if pos is not None:
-            self.pos = pos
-
-        while len(batch_inputs) < self.size:
-            # if we still need unlabeled examples, take out buffer if possible
-            if counter_unlab < nbr_unlabeled and len(self.buffer_unlab) > 0:
-                new_pair = self.buffer_unlab.pop(0)
-                counter_unlab = counter_unlab + 1
-
-            # if we still need labeled examples, take out buffer if possible
-            elif counter_lab < nbr_labeled and len(self.buffer_lab) > 0:
-                new_pair = self.buffer_lab.pop(0)
-                counter_lab = counter_lab + 1
-
-            # if in none above cases, get a new candidate pair out of data
-            #read the next pair
-            else:
-                inputs_cand, targets_cand = self.get_pair()
-
-                if targets_cand[0] is not None:
-                    # if this candidate is unlabeled
-                    if len(targets_cand[0]) == 0:
-                        # add to batch when still needed
-                        if counter_unlab < nbr_unlabeled:
-                            new_pair = (inputs_cand, targets_cand)
-                            counter_unlab = counter_unlab + 1
-                        # if not needed, store in buffer
-                        else:
-                            new_pair = None
-                            self.buffer_unlab.append(
-                                (inputs_cand, targets_cand))
-                    # if this candidate is labeled
-                    else:
-                        # add to batch when still needed
-                        if counter_lab < nbr_labeled:
-                            new_pair = (inputs_cand, targets_cand)
-                            counter_lab = counter_lab + 1
-                        # if not needed, store in buffer
-                        else:
-                            new_pair = None
-                            self.buffer_lab.append((inputs_cand, targets_cand))
-                else:
-                    new_pair = None
-
-            # if a new pair was found, add it to the batch_inputs
-            if new_pair is not None:
-                batch_inputs.append(new_pair[0])
-                batch_targets.append(new_pair[1])
-        return batch_inputs, batch_targets
-
-    def split(self, num_utt):
-        '''take a number of utterances from the batchdispenser to make a new one
-
-        Args:
-            num_utt: the number of utterances in the new batchdispenser
-
-        Returns:
-            a batch dispenser with the requested number of utterances'''
-
-        #create a copy of self
-        dispenser = copy.deepcopy(self)
+        super(AsrTextAndAudioBatchDispenser, self).__init__(
+            feature_reader, target_coder, size, target_path)
 
-        #split of a part of the feature reader
-        dispenser.feature_reader = self.feature_reader.split(num_utt)
+    def _get_pair(self, utt_id, inputs):
+        '''create the input-target pair of an utterance'''
 
-        #get a list of keys in the featutre readers
-        dispenser_ids = dispenser.feature_reader.reader.scp_data.keys()
-        self_ids = self.feature_reader.reader.scp_data.keys()
-
-        #split the target dicts
-        dispenser.target_dict = {key: dispenser.target_dict[key] for key in
-                                 dispenser_ids}
-        self.target_dict = {key: self.target_dict[key] for key in self_ids}
-
-        return dispenser
-
-    def get_pair(self):
-        '''get the next input-target pair'''
-
-        utt_id, inputs, _ = self.feature_reader.get_utt()
-
-        if utt_id in self.target_dict:
-            # normally the unlabeled data is simply encoded with '' as targets
-            text_targets = self.target_coder.encode(self.target_dict[utt_id])
-        else:
-            #When something wrong, simply take empty string as target
-            text_targets = self.target_coder.encode('')
+        # normally the unlabeled data simply has empty targets
+        text_targets = self.targets.get(utt_id)
+        if text_targets is None:
+            #When something wrong, simply take empty targets
+            text_targets = self.targets.empty
 
         audio_samples = self.audio_reader.get_utt_with_id(utt_id)
 
@@ -904,163 +871,94 @@ class AsrTextAndAudioBatchDispenserFixRatio(BatchDispenser):
 
         return inputs, targets
 
-    @property
-    def num_utt(self):
-        '''The number of utterances in the given data'''
-
-        return len(self.target_dict)
-
-    @property
-    def num_labels(self):
-        '''the number of output labels'''
-
-        return self.target_coder.num_labels
-
-    @property
-    def max_input_length(self):
-        '''the maximal sequence length of the features'''
-
-        return self.feature_reader.max_length
-
     @property
     def max_target_length(self):
         '''the maximal length of the targets'''
-        part1 = max([len(targets.split(' '))
-                     for targets in self.target_dict.values()])
+        part1 = self.targets.max_length
         part2 = self.audio_reader.max_length
         return(part1, part2)
 
 
-    @property
-    def pos(self):
-        '''the current position in the data'''
-
-        return self.feature_reader.pos
-
-    @pos.setter
-    def pos(self, pos):
-        '''setter for the current position in the data'''
-
-        self.feature_reader.pos = pos
-
-class AsrTextAndFeatBatchDispenser(BatchDispenser):
+class AsrTextAndAudioBatchDispenserFixRatio(AsrTextAndAudioBatchDispenser):
     '''a batch dispenser, used for ASR training, when working with
-    (partly) non-supervised data'''
+    (partly) non-supervised data and audio samples, every batch contains a
+    fixed ratio of unlabeled utterances'''
 
-    def __init__(self, feature_reader, target_coder, size, target_path):
+    def __init__(self, feature_reader, audio_reader, target_coder, size,
+                 target_path, percentage_unlabeled):
         '''
         batchDispenser constructor
 
         Args:
             feature_reader: Kaldi ark-file feature reader instance.
+            audio_reader: Kaldi ark-file feature reader for the audio samples
             target_coder: a TargetCoder object to encode and decode the target
                 sequences
             size: Specifies how many utterances should be contained
                   in each batch.
             target_path: path to the file containing the targets
+            percentage_unlabeled: the fraction of the utterances in a batch
+                that is unlabeled
         '''
 
-        #store the feature reader
-        self.feature_reader = feature_reader
+        #save the percentage we want to be unlabeled
+        self.percentage_unlabeled = percentage_unlabeled
 
-        #save the target coder
-        self.target_coder = target_coder
+        super(AsrTextAndAudioBatchDispenserFixRatio, self).__init__(
+            feature_reader, audio_reader, target_coder, size, target_path)
 
-        #get a dictionary connecting training utterances and targets.
-        self.target_dict = {}
+    def _strata(self):
+        '''the labeled and unlabeled utterances of every batch are chosen
+        before they are read'''
 
-        with open(target_path, 'r') as fid:
-            for line in fid:
-                splitline = line.strip().split(' ')
-                self.target_dict[splitline[0]] = ' '.join(splitline[1:])
+        return fixed_ratio_strata(self._labeled(), self.size,
+                                  self.percentage_unlabeled)
 
-        super(AsrTextAndFeatBatchDispenser, self).__init__(size)
+class AsrTextAndFeatBatchDispenser(AsrBatchDispenser):
+    '''a batch dispenser, used for ASR training, when working with
+    (partly) non-supervised data'''
 
-    def split(self, num_utt):
-        '''take a number of utterances from the batchdispenser to make a new one
+    def __init__(self, feature_reader, target_coder, size, target_path):
+        '''
+        batchDispenser constructor
 
         Args:
-            num_utt: the number of utterances in the new batchdispenser
-
-        Returns:
-            a batch dispenser with the requested number of utterances'''
-
-        #create a copy of self
-        dispenser = copy.deepcopy(self)
-
-        #split of a part of the feature reader
-        dispenser.feature_reader = self.feature_reader.split(num_utt)
-
-        #get a list of keys in the featutre readers
-        dispenser_ids = dispenser.feature_reader.reader.scp_data.keys()
-        self_ids = self.feature_reader.reader.scp_data.keys()
-
-        #split the target dicts
-        dispenser.target_dict = {key: dispenser.target_dict[key] for key in
-                                 dispenser_ids}
-        self.target_dict = {key: self.target_dict[key] for key in self_ids}
-
-        return dispenser
+            feature_reader: Kaldi ark-file feature reader instance.
+            target_coder: a TargetCoder object to encode and decode the target
+                sequences
+            size: Specifies how many utterances should be contained
+                  in each batch.
+            target_path: path to the file containing the targets
+        '''
 
-    def get_pair(self):
-        '''get the next input-target pair'''
+        super(AsrTextAndFeatBatchDispenser, self).__init__(
+            feature_reader, target_coder, size, target_path)
 
-        utt_id, inputs, _ = self.feature_reader.get_utt()
+    def _get_pair(self, utt_id, inputs):
+        '''create the input-target pair of an utterance'''
 
-        if utt_id in self.target_dict:
-            # normally the unlabeled data is simply encoded with '' as targets
-            text_targets = self.target_coder.encode(self.target_dict[utt_id])
-        else:
-            #When something wrong, simply take empty string as target
-            text_targets = self.target_coder.encode('')
+        # normally the unlabeled data simply has empty targets
+        text_targets = self.targets.get(utt_id)
+        if text_targets is None:
+            #When something wrong, simply take empty targets
+            text_targets = self.targets.empty
 
         # targets should be a pair of the real targets and feature inputs
         targets = (text_targets, inputs)
 
         return inputs, targets
 
-    @property
-    def num_utt(self):
-        '''The number of utterances in the given data'''
-
-        return len(self.target_dict)
-
-    @property
-    def num_labels(self):
-        '''the number of output labels'''
-
-        return self.target_coder.num_labels
-
-    @property
-    def max_input_length(self):
-        '''the maximal sequence length of the features'''
-
-        return self.feature_reader.max_length
-
     @property
     def max_target_length(self):
         '''the maximal length of the targets'''
-        part1 = max([len(targets.split(' '))
-                     for targets in self.target_dict.values()])
+        part1 = self.targets.max_length
         part2 = self.feature_reader.max_length
         return(part1, part2)
 
-
-    @property
-    def pos(self):
-        '''the current position in the data'''
-
-        return self.feature_reader.pos
-
-    @pos.setter
-    def pos(self, pos):
-        '''setter for the current position in the data'''
-
-        self.feature_reader.pos = pos
-
-class AsrTextAndFeatBatchDispenserFixRatio(BatchDispenser):
+class AsrTextAndFeatBatchDispenserFixRatio(AsrTextAndFeatBatchDispenser):
     '''a batch dispenser, used for ASR training, when working with
-    (partly) non-supervised data'''
+    (partly) non-supervised data, every batch contains a fixed ratio of
+    unlabeled utterances'''
 
     def __init__(self, feature_reader, target_coder, size, target_path,
                  percentage_unlabeled):
@@ -1074,186 +972,39 @@ class AsrTextAndFeatBatchDispenserFixRatio(BatchDispenser):
             size: Specifies how many utterances should be contained
                   in each batch.
             target_path: path to the file containing the targets
+            percentage_unlabeled: the fraction of the utterances in a batch
+                that is unlabeled
         '''
 
-        #store the feature reader
-        self.feature_reader = feature_reader
-
-        #save the target coder
-        self.target_coder = target_coder
-
-        #get a dictionary connecting training utterances and targets.
-        self.target_dict = {}
-
-        #set up the data lists.
-        self.buffer_lab = []
-        self.buffer_unlab = []
-
         #save the percentage we want to be unlabeled
         self.percentage_unlabeled = percentage_unlabeled
 
-        with open(target_path, 'r') as fid:
-            for line in fid:
-                splitline = line.strip().split(' ')
-                self.target_dict[splitline[0]] = ' '.join(splitline[1:])
-
-        super(AsrTextAndFeatBatchDispenserFixRatio, self).__init__(size)
-
-    def get_batch(self, pos=None):
-        '''
-        Get a batch of features and targets.
-
-        Args:
-            pos: position in the reader, if None will remain unchanged
-
-        Returns:
-            A pair containing:
-                - The features: a list of feature matrices
-                - The targets: a list of target tupples(!), where the second
-                    element of each tupple can be used for varying reasons
-                        example: quantized audio samples
-        '''
-
-        #set up the data lists.
-        batch_inputs = []
-        batch_targets = []
-
-        #calculate the number of examples we want to be unlabeled
-        nbr_unlabeled = int(self.size*self.percentage_unlabeled)
-        nbr_labeled = self.size - nbr_unlabeled
+        super(AsrTextAndFeatBatchDispenserFixRatio, self).__init__(
+            feature_reader, target_coder, size, target_path)
 
-        #hold two counters
-        counter_unlab = 0
-        counter_lab = 0
+    def _strata(self):
+        '''the labeled and unlabeled utterances of every batch are chosen
+        before they are read'''
 
-        if pos is not None:
-            self.pos = pos
+        return fixed_ratio_strata(self._labeled(), self.size,
+                                  self.percentage_unlabeled)
 
-        while len(batch_inputs) < self.size:
-            # if we still need unlabeled examples, take out buffer if possible
-            if counter_unlab < nbr_unlabeled and len(self.buffer_unlab) > 0:
-                new_pair = self.buffer_unlab.pop(0)
-                counter_unlab = counter_unlab + 1
+def fixed_ratio_strata(labeled, size, percentage_unlabeled):
+    '''
+    get the strata of batches with a fixed ratio of unlabeled utterances
 
-            # if we still need labeled examples, take out buffer if possible
-            elif counter_lab < nbr_labeled and len(self.buffer_lab) > 0:
-                new_pair = self.buffer_lab.pop(0)
-                counter_lab = counter_lab + 1
-
-            # if in none above cases, get a new candidate pair out of data
-            #read the next pair
-            else:
-                inputs_cand, targets_cand = self.get_pair()
-
-                if targets_cand[0] is not None:
-                    # if this candidate is unlabeled
-                    if len(targets_cand[0]) == 0:
-                        # add to batch when still needed
-                        if counter_unlab < nbr_unlabeled:
-                            new_pair = (inputs_cand, targets_cand)
-                            counter_unlab = counter_unlab + 1
-                        # if not needed, store in buffer
-                        else:
-                            new_pair = None
-                            self.buffer_unlab.append(
-                                (inputs_cand, targets_cand))
-                    # if this candidate is labeled
-                    else:
-                        # add to batch when still needed
-                        if counter_lab < nbr_labeled:
-                            new_pair = (inputs_cand, targets_cand)
-                            counter_lab = counter_lab + 1
-                        # if not needed, store in buffer
-                        else:
-                            new_pair = None
-                            self.buffer_lab.append((inputs_cand, targets_cand))
-                else:
-                    new_pair = None
-
-            # if a new pair was found, add it to the batch_inputs
-            if new_pair is not None:
-                batch_inputs.append(new_pair[0])
-                batch_targets.append(new_pair[1])
-        return batch_inputs, batch_targets
-
-    def split(self, num_utt):
-        '''take a number of utterances from the batchdispenser to make a new one
-
-        Args:
-            num_utt: the number of utterances in the new batchdispenser
-
-        Returns:
-            a batch dispenser with the requested number of utterances'''
+    Args:
+        labeled: a boolean numpy array containing for every utterance whether
+            or not it is labeled
+        size: the number of utterances in a batch
+        percentage_unlabeled: the fraction of the utterances in a batch that is
+            unlabeled
 
-        #create a copy of self
-        dispenser = copy.deepcopy(self)
+    Returns:
+        the labeled and the unlabeled stratum as used by the samplers
+    '''
 
-        #split of a part of the feature reader
-        dispenser.feature_reader = self.feature_reader.split(num_utt)
-
-        #get a list of keys in the featutre readers
-        dispenser_ids = dispenser.feature_reader.reader.scp_data.keys()
-        self_ids = self.feature_reader.reader.scp_data.keys()
-
-        #split the target dicts
-        dispenser.target_dict = {key: dispenser.target_dict[key] for key in
-                                 dispenser_ids}
-        self.target_dict = {key: self.target_dict[key] for key in self_ids}
-
-        return dispenser
-
-    def get_pair(self):
-        '''get the next input-target pair'''
-
-        utt_id, inputs, _ = self.feature_reader.get_utt()
-
-        if utt_id in self.target_dict:
-            # normally the unlabeled data is simply encoded with '' as targets
-            text_targets = self.target_coder.encode(self.target_dict[utt_id])
-        else:
-            #When something wrong, simply take empty string as target
-            text_targets = self.target_coder.encode('')
-
-        # targets should be a pair of the real targets and feature inputs
-        targets = (text_targets, inputs)
-
-        return inputs, targets
-
-    @property
-    def num_utt(self):
-        '''The number of utterances in the given data'''
-
-        return len(self.target_dict)
-
-    @property
-    def num_labels(self):
-        '''the number of output labels'''
-
-        return self.target_coder.num_labels
-
-    @property
-    def max_input_length(self):
-        '''the maximal sequence length of the features'''
-
-        return self.feature_reader.max_length
-
-    @property
-    def max_target_length(self):
-        '''the maximal length of the targets'''
-        part1 = max([len(targets.split(' '))
-                     for targets in self.target_dict.values()])
-        part2 = self.feature_reader.max_length
-        return(part1, part2)
-
-
-    @property
-    def pos(self):
-        '''the current position in the data'''
-
-        return self.feature_reader.pos
-
-    @pos.setter
-    def pos(self, pos):
-        '''setter for the current position in the data'''
+    num_unlabeled = int(size*percentage_unlabeled)
 
-        self.feature_reader.pos = pos
+    return [(np.flatnonzero(labeled), size - num_unlabeled),
+            (np.flatnonzero(~labeled), num_unlabeled)]
@@ -0,0 +1,120 @@
+'''@file feature_cache.py
+contains the FeatureCache class'''
+
+import threading
+from collections import OrderedDict
+
+class FeatureCache(object):
+    '''an in memory cache of processed features with a byte budget
+
+    The least recently used utterances are evicted when the cached features
+    do not fit in the budget anymore. The cached matrices are made read-only,
+    because they are handed out every time the utterance is asked for. The
+    cache can be shared by readers in different threads.'''
+
+    def __init__(self, max_bytes):
+        '''
+        FeatureCache constructor
+
+        Args:
+            max_bytes: the maximal total size of the cached matrices in bytes
+        '''
+
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._utts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, utt_id):
+        '''
+        get the cached features of an utterance
+
+        Args:
+            utt_id: the utterance ID
+
+        Returns:
+            the cached features or None if the utterance is not cached
+        '''
+
+        with self._lock:
+            utt_mat = self._utts.pop(utt_id, None)
+            if utt_mat is None:
+                self.misses += 1
+                return None
+
+            #put the utterance back as the most recently used one
+            self._utts[utt_id] = utt_mat
+            self.hits += 1
+
+            return utt_mat
+
+    def put(self, utt_id, utt_mat):
+        '''
+        cache the features of an utterance
+
+        Args:
+            utt_id: the utterance ID
+            utt_mat: the features as a numpy array, it is made read-only
+        '''
+
+        if utt_mat.nbytes > self.max_bytes:
+            return
+
+        utt_mat.flags.writeable = False
+
+        with self._lock:
+            if utt_id in self._utts:
+                self.nbytes -= self._utts.pop(utt_id).nbytes
+
+            #evict the least recently used utterances until the new one fits
+            while self.nbytes + utt_mat.nbytes > self.max_bytes:
+                self.nbytes -= self._utts.popitem(last=False)[1].nbytes
+
+            self._utts[utt_id] = utt_mat
+            self.nbytes += utt_mat.nbytes
+
+    def clear(self):
+        '''remove all utterances from the cache'''
+
+        with self._lock:
+            self._utts = OrderedDict()
+            self.nbytes = 0
+
+    def __len__(self):
+        '''the number of cached utterances'''
+
+        return len(self._utts)
+
+    def __contains__(self, utt_id):
+        '''check if an utterance is cached, this does not count as a hit or a
+        miss'''
+
+        return utt_id in self._utts
+
+    def __str__(self):
+        '''a summary of the cache usage'''
+
+        lookups = max(self.hits + self.misses, 1)
+
+        return ('feature cache: %d utterances, %.1f/%.1f MB, %d hits, '
+                '%d misses (%.1f%% hit rate)' % (
+                    len(self), self.nbytes/1048576.0,
+                    self.max_bytes/1048576.0, self.hits, self.misses,
+                    100.0*self.hits/lookups))
+
+    def __getstate__(self):
+        '''the state used when pickling the cache, the lock is left out'''
+
+        state = self.__dict__.copy()
+        del state['_lock']
+
+        return state
+
+    def __setstate__(self, state):
+        '''restore a pickled cache with a new lock'''
+
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
@@ -36,8 +36,10 @@ class Quant_Audio(feature_computer.FeatureComputer):
         inputs = inputs / np.max(abs(inputs))
         # mu-law transformation
         transformed = np.sign(inputs)*np.log(1+mu*np.abs(inputs))/np.log(1+mu)
-        # quantization to an integer
+        # quantization to an integer, the maximal amplitude would end up one
+        # level too high
         quantized = ((transformed+1)*num_levels/2+0.5).astype(np.int32)
+        quantized = np.minimum(quantized, mu)
         # because the output is expected to be in a twodimensional matrix
         quantized = quantized.reshape(quantized.shape[0],1)
 
@@ -2,18 +2,24 @@
 reading features and applying cmvn and splicing them'''
 
 import copy
+from collections import deque
 from nabu.processing import ark
 from nabu.processing import readfiles
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from scipy.signal import lfilter
 
 class FeatureReader(object):
     '''Class that can read features from a Kaldi archive and process
     them (cmvn and splicing)'''
 
-    def __init__(self, scpfile, cmvnfile, utt2spkfile, max_length):
+    def __init__(self, scpfile, cmvnfile, utt2spkfile, max_length,
+                 read_ahead=1, online_cmvn=None, cache=None, splicer=None,
+                 manifest=None):
         '''
         create a FeatureReader object. When the cmvnfile is None, we don't
-        want to do any normalization
+        want to do any normalization. When online_cmvn is given, it is used
+        instead of the statistics in the cmvnfile
 
         Args:
             scpfile: path to the features .scp file
@@ -22,22 +28,68 @@ class FeatureReader(object):
                 ID to speaker ID
             max_length: the maximum length of all the utterances in the
                 scp file
+            read_ahead: the number of utterances get_utt reads at once, the
+                reads of these utterances are planned together
+            online_cmvn: an optional OnlineCmvn object that normalizes every
+                utterance with running statistics
+            cache: an optional FeatureCache that keeps the normalized
+                features in memory, so they only have to be read once
+            splicer: an optional Splicer that adds context to the frames and
+                subsamples them
+            manifest: an optional Manifest of the features, it gives the
+                lengths of the utterances without reading them. If
+                max_length is None it is taken from the manifest
         '''
 
         #create the feature reader
         self.reader = ark.ArkReader(scpfile)
 
-        #store the max length
+        #take the lengths from the manifest if the index does not know them,
+        #the views created by split and shard keep them
+        self.manifest = manifest
+        if manifest is not None:
+            index = self.reader.scp_index
+            if index.num_frames is None:
+                index.num_frames = manifest.num_frames[
+                    manifest.positions(index.utt_ids)]
+            if max_length is None:
+                max_length = manifest.max_length
+
+        #store the max length, after subsampling
+        self.splicer = splicer
+        if splicer is not None and max_length is not None:
+            max_length = splicer.length(max_length)
         self.max_length = max_length
 
+        #the utterances that have been read but not returned yet
+        self.read_ahead = read_ahead
+        self._utts = deque()
+
+        #the cache of normalized features
+        self.cache = cache
+
+        #the online normalization does not need any precomputed statistics
+        self.online_cmvn = online_cmvn
+        if online_cmvn is not None:
+            cmvnfile = None
+
         # some of the information is only needed when the cvmn file is not None
         if cmvnfile is not None:
-            #create a reader for the cmvn statistics
-            self.reader_cmvn = ark.ArkReader(cmvnfile)
-            #save the utterance to speaker mapping
-            self.utt2spk = readfiles.read_utt2spk(utt2spkfile)
+            #compute the normalization of all speakers once
+            self.spk_rows, self.cmvn_means, self.cmvn_inv_stds = \
+                read_cmvn(cmvnfile)
+            #save the utterance to speaker mapping, the manifest already
+            #has it
+            if manifest is not None:
+                self.utt2spk = dict(zip(
+                    manifest.utt_ids.tolist(),
+                    manifest.speakers[manifest.spk_ids].tolist()))
+            else:
+                self.utt2spk = readfiles.read_utt2spk(utt2spkfile)
         else:
-            self.reader_cmvn = None
+            self.spk_rows = None
+            self.cmvn_means = None
+            self.cmvn_inv_stds = None
             self.utt2spk = None
 
     def get_utt(self):
@@ -48,16 +100,83 @@ class FeatureReader(object):
             the normalized and spliced features
         '''
 
-        #read utterance
-        (utt_id, utt_mat, looped) = self.reader.read_next_utt()
+        #read the next utterances if there are none left
+        if not self._utts:
+            self._read_next()
 
-        #apply cmvn if this is wanted
-        if self.reader_cmvn is not None:
-            cmvn_stats = self.reader_cmvn.read_utt_data(self.utt2spk[utt_id])
-            utt_mat = apply_cmvn(utt_mat, cmvn_stats)
+        utt_id, utt_mat, looped = self._utts.popleft()
+
+        if self.splicer is not None:
+            utt_mat = self.splicer(utt_mat)
 
         return utt_id, utt_mat, looped
 
+    def _read_next(self):
+        '''read and normalize the next read_ahead utterances'''
+
+        num_utt = min(max(self.read_ahead, 1), self.num_utt)
+        positions = (self.reader.scp_position + np.arange(num_utt)) \
+            % self.num_utt
+        utt_ids, utt_mats = self._read_at(positions)
+
+        for i in range(num_utt):
+            self._utts.append((utt_ids[i], utt_mats[i],
+                               positions[i] == self.num_utt - 1))
+
+        self.reader.scp_position = int(positions[-1] + 1) % self.num_utt
+
+    def get_utts_at(self, positions):
+        '''
+        read, normalize and splice the utterances at a number of positions in
+        the reader, this does not change the position of the reader
+
+        Args:
+            positions: the positions of the utterances in the reader
+
+        Returns:
+            a list containing the utterance ID and the features of every
+            utterance, in the order of the positions
+        '''
+
+        utt_ids, utt_mats = self._read_at(np.asarray(positions,
+                                                     dtype=np.int64))
+
+        if self.splicer is not None:
+            utt_mats = [self.splicer(utt_mat) for utt_mat in utt_mats]
+
+        return zip(utt_ids, utt_mats)
+
+    def _read_at(self, positions):
+        '''
+        read and normalize the utterances at a number of positions, the ones
+        that are not cached are read with one planned read
+
+        Args:
+            positions: a numpy array containing the positions of the
+                utterances in the reader
+
+        Returns:
+            the utterance IDs and the normalized features
+        '''
+
+        num_utt = len(positions)
+        utt_ids = [self.reader.scp_index.utt_id(pos) for pos in positions]
+
+        #look up the utterances in the cache
+        if self.cache is not None:
+            utt_mats = [self.cache.get(utt_id) for utt_id in utt_ids]
+        else:
+            utt_mats = [None]*num_utt
+
+        #read the others from the archives
+        missing = [i for i in range(num_utt) if utt_mats[i] is None]
+        if missing:
+            read_mats = self.reader.read_utts_at(positions[missing])
+            for i, utt_mat in zip(missing, read_mats):
+                utt_mats[i] = self._normalize(utt_ids[i], utt_mat)
+
+        return utt_ids, utt_mats
+
     def get_utt_with_id(self, utt_id):
         '''
         read the features from archive (normalize and splice if cmvn present)
@@ -68,72 +187,451 @@ class FeatureReader(object):
         Returns:
             the features of that certain utterance
         '''
+
+        utt_mat = None
+        if self.cache is not None:
+            utt_mat = self.cache.get(utt_id)
+
         #read the utterance
-        utt_mat = self.reader.read_utt_data(utt_id)
+        if utt_mat is None:
+            utt_mat = self._normalize(utt_id,
+                                      self.reader.read_utt_data(utt_id))
+
+        if self.splicer is not None:
+            utt_mat = self.splicer(utt_mat)
+
+        return utt_mat
+
+    def _normalize(self, utt_id, utt_mat):
+        '''
+        apply the cmvn of the speaker of an utterance, if this is wanted, and
+        cache the normalized features
+
+        The features are always returned in float32 memory of their own, so
+        the cache never holds views on the archives. The normalization is done
+        in place, the data is only copied when it is read-only (a view on the
+        archive) or not float32.
+
+        Args:
+            utt_id: the ID of the utterance
+            utt_mat: the features of the utterance
+
+        Returns:
+            the normalized features
+        '''
+
+        if self.online_cmvn is not None:
+            utt_mat = self.online_cmvn.normalize(utt_mat)[0]
+
+        else:
+            if (utt_mat.dtype != np.float32 or not utt_mat.flags.writeable
+                    or not utt_mat.flags.owndata):
+                utt_mat = utt_mat.astype(np.float32)
+
+            if self.cmvn_means is not None:
+                row = self.spk_rows[self.utt2spk[utt_id]]
+                utt_mat -= self.cmvn_means[row]
+                utt_mat *= self.cmvn_inv_stds[row]
 
-        #apply cmvn is this is wanted
-        if self.reader_cmvn is not None:
-            cmvn_stats = self.reader_cmvn.read_utt_data(self.utt2spk[utt_id])
-            utt_mat = apply_cmvn(utt_mat, cmvn_stats)
+        if self.cache is not None:
+            self.cache.put(utt_id, utt_mat)
 
         return utt_mat
 
     def split(self, num_utt):
         '''take a number of utterances from the feature reader to make a new one
 
+        The new reader shares the index, the cmvn statistics and the utterance
+        to speaker mapping with this one.
+
         Args:
             num_utt: the number of utterances in the new feature reader
 
         Returns:
             a feature reader with the requested number of utterances'''
-        #create a copy of self
-        reader = copy.deepcopy(self)
+        #create a shallow copy of self
+        reader = copy.copy(self)
 
         #split of a part of the ark reader
         reader.reader = self.reader.split(num_utt)
+        reader._utts = deque()
+        self._utts.clear()
+
+        return reader
+
+    def shard(self, num_shards, shard_index):
+        '''create a feature reader for one of a number of interleaved shards
+
+        Args:
+            num_shards: the total number of shards
+            shard_index: the index of the shard
+
+        Returns:
+            a feature reader containing every num_shards'th utterance,
+            starting at shard_index'''
+
+        reader = copy.copy(self)
+        reader.reader = self.reader.shard(num_shards, shard_index)
+        reader._utts = deque()
 
         return reader
 
+    @property
+    def utt_ids(self):
+        '''the utterance IDs in the reader as a numpy array, in reading order'''
+        return self.reader.scp_index.utt_ids
+
     @property
     def num_utt(self):
         '''number of utterances in the reader'''
         return self.reader.num_utt
 
+    @property
+    def lengths(self):
+        '''the number of frames of the utterances in reading order, after
+        subsampling, or None if they are not known'''
+        num_frames = self.reader.scp_index.num_frames
+        if num_frames is None or self.splicer is None:
+            return num_frames
+        return self.splicer.length(num_frames)
+
     @property
     def pos(self):
-        '''the position in the reader'''
-        return self.reader.scp_position
+        '''the position in the reader, the utterances that were read ahead
+        are not counted'''
+        return (self.reader.scp_position - len(self._utts)) % self.num_utt
 
     @pos.setter
     def pos(self, pos):
         '''the position setter'''
+        self._utts.clear()
         self.reader.scp_position = pos
 
 
 
 
-def apply_cmvn(utt, stats):
+def read_cmvn(cmvnfile):
     '''
-    apply mean and variance normalisation
-
-    The mean and variance statistics are computed on previously seen data
+    read the cmvn statistics of all speakers and compute their normalization
 
     Args:
-        utt: the utterance feature numpy matrix
-        stats: a numpy array containing the mean and variance statistics. The
-            first row contains the sum of all the fautures and as a last element
-            the total number of features. The second row contains the squared
-            sum of the features and a zero at the end
+        cmvnfile: path to the .scp file of the cmvn statistics
 
     Returns:
-        a numpy array containing the mean and variance normalized features
+        - a dictionary mapping the speaker IDs to their row in the matrices
+        - a [num_speakers x dim] float32 matrix containing the means
+        - a [num_speakers x dim] float32 matrix containing the inverse of the
+            standard deviations
     '''
 
+    reader = ark.ArkReader(cmvnfile)
+    stats = np.array([reader.read_utt_at(pos) for pos in range(reader.num_utt)],
+                     dtype=np.float64)
+    spk_rows = {spk: row for row, spk in
+                enumerate(reader.scp_index.utt_ids.tolist())}
+    reader.close()
+
+    if not len(stats):
+        return spk_rows, np.zeros([0, 0], np.float32), \
+            np.zeros([0, 0], np.float32)
+
     #compute mean
-    mean = stats[0, :-1]/stats[0, -1]
+    counts = stats[:, 0, -1:]
+    mean = stats[:, 0, :-1]/counts
 
     #compute variance
-    variance = stats[1, :-1]/stats[0, -1] - np.square(mean)
+    variance = stats[:, 1, :-1]/counts - np.square(mean)
+
+    return (spk_rows, mean.astype(np.float32),
+            (1/np.sqrt(variance)).astype(np.float32))
+
+class OnlineCmvn(object):
+    '''mean and variance normalization with running statistics
+
+    Every frame is normalized with the statistics of the frames up to and
+    including it, so no statistics have to be computed in advance. The
+    statistics are either those of a sliding window of previous frames or
+    exponentially decaying statistics of all previous frames. The same
+    normalization is used for complete utterances, e.g. in training, and for
+    utterances that come in chunk by chunk, e.g. in a streaming decoder.'''
+
+    def __init__(self, window=600, decay=None, norm_vars=True,
+                 var_floor=1e-10):
+        '''
+        OnlineCmvn constructor
+
+        Args:
+            window: the number of frames in the sliding window
+            decay: if not None, exponentially decaying statistics with this
+                decay factor per frame are used instead of a sliding window
+            norm_vars: whether or not the variance is normalized
+            var_floor: the minimal variance, the variance of the first frames
+                of an utterance is very small
+        '''
+
+        self.window = window
+        self.decay = decay
+        self.norm_vars = norm_vars
+        self.var_floor = var_floor
+
+    def normalize(self, frames, state=None):
+        '''
+        normalize a chunk of frames
+
+        Args:
+            frames: a [num_frames x dim] numpy array
+            state: the state returned for the previous chunk of the same
+                utterance, None for the first chunk
+
+        Returns:
+            - the normalized frames as a float32 numpy array
+            - the state after this chunk
+        '''
+
+        frames = np.asarray(frames, dtype=np.float64)
+
+        if self.decay is None:
+            mean, square, state = self._window_stats(frames, state)
+        else:
+            mean, square, state = self._decayed_stats(frames, state)
+
+        normalized = frames - mean
+        if self.norm_vars:
+            normalized /= np.sqrt(np.maximum(square - np.square(mean),
+                                             self.var_floor))
+
+        return normalized.astype(np.float32), state
+
+    def _window_stats(self, frames, history):
+        '''
+        the statistics of a sliding window ending at every frame
+
+        Args:
+            frames: the [num_frames x dim] float64 frames
+            history: the last frames of the previous chunks or None
+
+        Returns:
+            - the mean of the window of every frame
+            - the mean of the squares of the window of every frame
+            - the frames the next chunk needs
+        '''
+
+        if history is None:
+            history = np.zeros([0, frames.shape[1]])
+        frames = np.concatenate([history, frames])
+
+        #the window of frame i contains the frames start[i] up to end[i]
+        end = np.arange(len(history), len(frames)) + 1
+        start = np.maximum(end - self.window, 0)
+        count = (end - start)[:, np.newaxis]
+
+        cumsum = np.cumsum(np.concatenate(
+            [np.zeros([1, frames.shape[1]]), frames]), 0)
+        cumsum2 = np.cumsum(np.concatenate(
+            [np.zeros([1, frames.shape[1]]), np.square(frames)]), 0)
+
+        mean = (cumsum[end] - cumsum[start])/count
+        square = (cumsum2[end] - cumsum2[start])/count
+
+        return mean, square, frames[max(len(frames) - self.window + 1, 0):]
+
+    def _decayed_stats(self, frames, sums):
+        '''
+        the exponentially decaying statistics at every frame
+
+        Args:
+            frames: the [num_frames x dim] float64 frames
+            sums: the decayed weight, sum and sum of squares after the
+                previous chunks or None
+
+        Returns:
+            - the decayed mean at every frame
+            - the decayed mean of the squares at every frame
+            - the decayed weight, sum and sum of squares after this chunk
+        '''
+
+        values = np.concatenate(
+            [np.ones([len(frames), 1]), frames, np.square(frames)], 1)
+
+        if sums is None:
+            sums = np.zeros(values.shape[1])
+
+        #s[t] = decay*s[t-1] + values[t]
+        decayed = lfilter([1.0], [1.0, -self.decay], values, axis=0,
+                          zi=self.decay*sums[np.newaxis])[0]
+
+        dim = frames.shape[1]
+        weight = decayed[:, :1]
+
+        return (decayed[:, 1:dim + 1]/weight, decayed[:, dim + 1:]/weight,
+                decayed[-1] if len(frames) else sums)
+
+def online_cmvn(conf):
+    '''
+    create the online normalization described in a feature configuration
+
+    Args:
+        conf: the feature configuration
+
+    Returns:
+        an OnlineCmvn object or None if the features are normalized with
+        precomputed per speaker statistics
+    '''
+
+    if conf.get('cmvn', 'speaker') == 'speaker':
+        return None
+    if conf['cmvn'] != 'online':
+        raise Exception('unknown cmvn mode %s' % conf['cmvn'])
+
+    window = int(conf.get('cmvn_window', 600))
+
+    return OnlineCmvn(
+        window=window,
+        decay=None if window > 0 else float(conf['cmvn_decay']),
+        norm_vars=conf.get('cmvn_norm_vars', 'True') == 'True')
+
+class Splicer(object):
+    '''adds the context of the neighbouring frames to every frame and
+    subsamples the frames
+
+    The spliced frames are a read-only, strided view on the features with shape
+    [num_frames x context x dim], nothing is copied for the context. The view
+    is only materialized when the batch is collated with collate.'''
+
+    def __init__(self, left=0, right=0, subsample=1):
+        '''
+        Splicer constructor
+
+        Args:
+            left: the number of frames of left context
+            right: the number of frames of right context
+            subsample: only every subsample'th frame is kept
+        '''
+
+        self.left = left
+        self.right = right
+        self.subsample = subsample
+
+    def __call__(self, utt_mat):
+        '''
+        splice and subsample the features of an utterance
+
+        Args:
+            utt_mat: the [num_frames x dim] features
+
+        Returns:
+            a [ceil(num_frames/subsample) x context x dim] read-only view,
+            the first and last frames are repeated as context at the edges
+        '''
+
+        if self.left or self.right:
+            #only the edges are copied
+            padded = np.concatenate([
+                np.repeat(utt_mat[:1], self.left, 0), utt_mat,
+                np.repeat(utt_mat[-1:], self.right, 0)])
+            frames = as_strided(
+                padded,
+                shape=(utt_mat.shape[0], self.left + 1 + self.right,
+                       utt_mat.shape[1]),
+                strides=(padded.strides[0],) + padded.strides)
+            frames.flags.writeable = False
+        else:
+            frames = utt_mat[:, np.newaxis]
+
+        return frames[::self.subsample]
+
+    def length(self, num_frames):
+        '''the number of frames after subsampling'''
+
+        return -(-num_frames//self.subsample)
+
+    def dim(self, dim):
+        '''the dimension of a spliced frame when it is materialized'''
+
+        return dim*(self.left + 1 + self.right)
+
+def splicer(conf):
+    '''
+    create the splicer described in a feature configuration
+
+    Args:
+        conf: the feature configuration
+
+    Returns:
+        a Splicer object or None if no context or subsampling is used
+    '''
+
+    left = int(conf.get('splice_left', 0))
+    right = int(conf.get('splice_right', 0))
+    subsample = int(conf.get('subsample', 1))
+
+    if left == 0 and right == 0 and subsample == 1:
+        return None
+
+    return Splicer(left, right, subsample)
+
+def collate(inputs, length):
+    '''
+    put a batch of features in a zero padded tensor
+
+    This is where spliced features are materialized, every frame is flattened
+    to a single vector.
+
+    Args:
+        inputs: a list of [num_frames x ...] numpy arrays, e.g. features or
+            spliced features
+        length: the length the features are padded to
+
+    Returns:
+        a [len(inputs) x length x frame_size] float32 numpy array
+    '''
+
+    frame_shape = inputs[0].shape[1:]
+    batch = np.zeros([len(inputs), length, int(np.prod(frame_shape))],
+                     dtype=np.float32)
+
+    for i, inp in enumerate(inputs):
+        batch[i, :inp.shape[0]].reshape((inp.shape[0],) + frame_shape)[...] = \
+            inp
+
+    return batch
+
+def length_buckets(lengths, num_buckets, max_length):
+    '''
+    choose the lengths the batches are padded to
+
+    Args:
+        lengths: the lengths of the utterances, the buckets are quantiles of
+            the lengths so they get about as many utterances. If None the
+            buckets are evenly spaced
+        num_buckets: the maximal number of buckets
+        max_length: the length of the last bucket, every utterance fits in it
+
+    Returns:
+        a sorted list of bucket lengths, the last one is max_length
+    '''
+
+    quantiles = np.arange(1, num_buckets)/float(num_buckets)
+
+    if lengths is not None and len(lengths):
+        boundaries = np.ceil(np.percentile(lengths, 100*quantiles))
+    else:
+        boundaries = np.ceil(max_length*quantiles)
+
+    boundaries = set(int(b) for b in boundaries if 0 < b < max_length)
+
+    return sorted(boundaries) + [max_length]
+
+def bucket_index(buckets, length):
+    '''
+    get the smallest bucket an utterance fits in
+
+    Args:
+        buckets: the sorted bucket lengths
+        length: the length of the utterance
+
+    Returns:
+        the index of the bucket
+    '''
 
-    #return mean and variance normalised utterance
-    return np.divide(np.subtract(utt, mean), np.sqrt(variance))
+    return int(np.searchsorted(buckets, length))
@@ -0,0 +1,119 @@
+'''@file index_cache.py
+contains functions to cache parsed text files in binary sidecar files
+
+The parsed content of a text file (an .scp file, utt2spk, targets ...) is
+stored as numpy arrays in an .npz file next to it. The cache remembers the
+modification time and size of the text file and is ignored as soon as one of
+them changes.'''
+
+import os
+import numpy as np
+
+#bump this when the content of the cache files changes
+CACHE_VERSION = 1
+
+def cache_path(path):
+    '''the path of the sidecar cache of a file'''
+
+    return path + '.npz'
+
+def load(path):
+    '''
+    load the cached content of a file
+
+    Args:
+        path: path to the text file that was cached
+
+    Returns:
+        a dictionary containing the cached numpy arrays or None if there is no
+        valid cache for the file
+    '''
+
+    cachefile = cache_path(path)
+
+    if not os.path.isfile(cachefile) or not os.path.isfile(path):
+        return None
+
+    try:
+        with np.load(cachefile) as data:
+            arrays = {key: data[key] for key in data.files}
+    except (IOError, OSError, ValueError):
+        return None
+
+    if ('_version' not in arrays
+            or int(arrays['_version']) != CACHE_VERSION
+            or tuple(arrays['_source']) != signature(path)):
+        return None
+
+    del arrays['_version']
+    del arrays['_source']
+
+    return arrays
+
+def save(path, arrays, source=None):
+    '''
+    cache the content of a file
+
+    Writing the cache is best effort, it is skipped when the directory is not
+    writable. The cache file is written under a temporary name and moved in
+    place, so concurrent readers never see a partial cache.
+
+    Args:
+        path: path to the text file that is cached
+        arrays: a dictionary containing the numpy arrays to store
+        source: the signature of the file at the time it was parsed, if
+            None it is taken now
+    '''
+
+    arrays = dict(arrays)
+    arrays['_version'] = np.array(CACHE_VERSION)
+    arrays['_source'] = np.array(source or signature(path),
+                                 dtype=np.float64)
+
+    cachefile = cache_path(path)
+    tmpfile = '%s.%d.tmp' % (cachefile, os.getpid())
+
+    try:
+        with open(tmpfile, 'wb') as fid:
+            np.savez(fid, **arrays)
+        os.rename(tmpfile, cachefile)
+    except (IOError, OSError):
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+
+def signature(path):
+    '''the modification time and size of a file, used to validate a cache'''
+
+    stat = os.stat(path)
+
+    return (float(stat.st_mtime), float(stat.st_size))
+
+def pack_strings(strings):
+    '''
+    pack a list of strings in a numpy array
+
+    Args:
+        strings: a list of strings that do not contain newlines
+
+    Returns:
+        a uint8 numpy array containing the newline separated strings
+    '''
+
+    return np.fromstring('\n'.join(strings), dtype=np.uint8)
+
+def unpack_strings(packed, num_strings):
+    '''
+    unpack strings that were packed with pack_strings
+
+    Args:
+        packed: the uint8 numpy array
+        num_strings: the number of packed strings
+
+    Returns:
+        a list of strings
+    '''
+
+    if num_strings == 0:
+        return []
+
+    return packed.tostring().split('\n')
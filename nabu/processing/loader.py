@@ -0,0 +1,260 @@
+'''@file loader.py
+contains the BatchLoader class'''
+
+import ctypes
+import traceback
+import multiprocessing
+from multiprocessing import sharedctypes
+import Queue
+import numpy as np
+
+class BatchLoader(object):
+    '''prepares the batches of a batch dispenser in a number of worker
+    processes
+
+    The workers are forked from the trainer process, so they start with a
+    copy of the dispenser. Every worker goes through the same batches as the
+    dispenser would, but it only reads and prepares every num_workers'th
+    batch: worker w owns the batches w, w + num_workers, ... The other
+    batches are only sampled, which does not read anything. The prepared
+    arrays are written in a ring of preallocated shared memory buffers of the
+    worker and get_batch returns numpy views on these buffers, so a batch is
+    never copied or pickled on its way to the trainer. Only the slot and the
+    shapes go through a queue. The archives are memory mapped, so the workers
+    share their pages.
+
+    The position works like the position of a BatchPrefetcher, the batches
+    come in the same order as they would come from the dispenser. A batch
+    stays valid until the next call of get_batch.'''
+
+    def __init__(self, dispenser, prepare, layout, num_workers=2, depth=2):
+        '''
+        BatchLoader constructor
+
+        Args:
+            dispenser: the BatchDispenser the batches are read from
+            prepare: a function that takes the inputs and targets of a batch
+                as returned by the dispenser and returns a pair containing a
+                tag (e.g. the bucket of the batch) and a list of numpy arrays
+            layout: a list containing a pair with the maximal shape and the
+                dtype of every array that prepare returns
+            num_workers: the number of worker processes
+            depth: the number of buffers of every worker
+        '''
+
+        self.dispenser = dispenser
+        self.prepare = prepare
+        self.layout = layout
+        self.num_workers = num_workers
+        self.depth = max(depth, 1)
+
+        #allocate the shared buffers before the workers are forked, the
+        #views are created once and inherited by the workers
+        self._buffers = [[[shared_array(shape, dtype)
+                           for shape, dtype in layout]
+                          for _ in range(self.depth)]
+                         for _ in range(num_workers)]
+
+        #the position of the next batch that get_batch will return and the
+        #index of that batch since the workers were started
+        self._pos = dispenser.pos
+        self._index = 0
+
+        #the running workers, they are started by start or on the first
+        #get_batch
+        self._workers = None
+        self._free = None
+        self._ready = None
+
+        #the buffer of the last returned batch
+        self._used = None
+
+    def get_batch(self, pos=None):
+        '''
+        Get a prepared batch
+
+        Args:
+            pos: position in the reader, if None will remain unchanged
+
+        Returns:
+            the tag of the batch and the list of arrays as views on the
+            shared buffers
+        '''
+
+        if pos is not None and pos != self._pos:
+            self.pos = pos
+
+        self.start()
+
+        #the last batch is not used anymore
+        if self._used is not None:
+            self._free[self._used[0]].put(self._used[1])
+            self._used = None
+
+        worker = self._index % self.num_workers
+        slot, tag, shapes, pos = self._receive(worker)
+
+        if slot is None:
+            self._stop_workers()
+            raise Exception('data loader worker %d failed:\n%s' %
+                            (worker, shapes))
+
+        self._pos = pos
+        self._index += 1
+        self._used = (worker, slot)
+
+        return tag, [buf[:int(np.prod(shape))].reshape(shape)
+                     for buf, shape in zip(self._buffers[worker][slot],
+                                           shapes)]
+
+    def _receive(self, worker):
+        '''wait for the next prepared batch of a worker, it fails when the
+        worker died'''
+
+        while True:
+            try:
+                return self._ready[worker].get(timeout=1)
+            except Queue.Empty:
+                if not self._workers[worker].is_alive():
+                    self._stop_workers()
+                    raise Exception('data loader worker %d died' % worker)
+
+    def start(self):
+        '''start the workers at the current position if they are not
+        running, the workers are forked so this is best done before other
+        threads are started'''
+
+        if self._workers is not None:
+            return
+
+        self._index = 0
+        self._free = [multiprocessing.Queue() for _ in range(self.num_workers)]
+        self._ready = [multiprocessing.Queue()
+                       for _ in range(self.num_workers)]
+
+        for free in self._free:
+            for slot in range(self.depth):
+                free.put(slot)
+
+        self._workers = [
+            multiprocessing.Process(target=self._work,
+                                    args=(worker, self._pos))
+            for worker in range(self.num_workers)]
+        for process in self._workers:
+            process.daemon = True
+            process.start()
+
+    def _work(self, worker, pos):
+        '''read and prepare the batches of a worker, runs in the worker
+        process
+
+        Args:
+            worker: the index of the worker
+            pos: the position of the first batch
+        '''
+
+        try:
+            self.dispenser.pos = pos
+            index = 0
+
+            while True:
+                if index % self.num_workers != worker:
+                    self.dispenser.skip_batch()
+                    index += 1
+                    continue
+
+                slot = self._free[worker].get()
+                tag, arrays = self.prepare(*self.dispenser.get_batch())
+
+                for buf, array in zip(self._buffers[worker][slot], arrays):
+                    if array.size > buf.size:
+                        raise Exception(
+                            'a prepared array of shape %s does not fit in '
+                            'its buffer' % (array.shape,))
+                    buf[:array.size].reshape(array.shape)[...] = array
+
+                self._ready[worker].put(
+                    (slot, tag, [array.shape for array in arrays],
+                     self.dispenser.pos))
+                index += 1
+
+        except Exception: #pylint: disable=W0703
+            self._ready[worker].put((None, None, traceback.format_exc(),
+                                     None))
+
+    def _stop_workers(self):
+        '''stop the workers and throw away the prepared batches'''
+
+        if self._workers is None:
+            return
+
+        for process in self._workers:
+            process.terminate()
+            process.join()
+
+        self._workers = None
+        self._free = None
+        self._ready = None
+        self._used = None
+
+    def close(self):
+        '''stop the workers'''
+
+        self._stop_workers()
+
+    @property
+    def pos(self):
+        '''the position of the next batch'''
+
+        return self._pos
+
+    @pos.setter
+    def pos(self, pos):
+        '''setter for the position of the next batch'''
+
+        self._stop_workers()
+        self._pos = pos
+        self.dispenser.pos = pos
+
+    @property
+    def size(self):
+        '''the number of utterances in a batch'''
+
+        return self.dispenser.size
+
+    @property
+    def num_batches(self):
+        '''the number of batches in the data'''
+
+        return self.dispenser.num_batches
+
+    @property
+    def max_input_length(self):
+        '''the maximal sequence length of the features'''
+
+        return self.dispenser.max_input_length
+
+    @property
+    def max_target_length(self):
+        '''the maximal length of the targets'''
+
+        return self.dispenser.max_target_length
+
+def shared_array(shape, dtype):
+    '''
+    allocate a flat numpy array in shared memory, it stays shared with the
+    processes that are forked afterwards
+
+    Args:
+        shape: the maximal shape of the arrays it will hold
+        dtype: the data type of the array
+
+    Returns:
+        a flat numpy array with room for an array of the shape
+    '''
+
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw = sharedctypes.RawArray(ctypes.c_byte, max(size*dtype.itemsize, 1))
+
+    return np.ctypeslib.as_array(raw).view(dtype)[:size]
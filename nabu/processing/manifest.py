@@ -0,0 +1,196 @@
+'''@file manifest.py
+contains the Manifest class
+
+A manifest is a binary table in the feature directory of a set with a row for
+every utterance: the number of frames, the speaker and, once the targets are
+prepared, the length of the target sequence and whether or not the utterance
+is labeled. Everything that needs the lengths of the utterances (sorting,
+bucketing, batching, sharding) can get them from the manifest without reading
+the features. The locations of the features in the archives are in the index
+of the scp file.'''
+
+import os
+import numpy as np
+from nabu.processing import ark, readfiles
+
+#the name of the manifest in the feature directory
+MANIFEST_NAME = 'manifest.npz'
+
+class Manifest(object):
+    '''the per utterance statistics of a feature set'''
+
+    def __init__(self, utt_ids, num_frames, speakers, spk_ids,
+                 target_lengths=None, labeled=None):
+        '''
+        Manifest constructor
+
+        Args:
+            utt_ids: a numpy string array containing the utterance IDs
+            num_frames: a numpy int32 array containing the number of frames
+                of every utterance
+            speakers: a numpy string array containing the unique speaker IDs
+            spk_ids: a numpy int32 array containing for every utterance the
+                index of its speaker in speakers
+            target_lengths: an optional numpy int32 array containing the
+                length of the target sequence of every utterance
+            labeled: an optional numpy bool array containing for every
+                utterance whether or not it has targets
+        '''
+
+        self.utt_ids = utt_ids
+        self.num_frames = num_frames
+        self.speakers = speakers
+        self.spk_ids = spk_ids
+        self.target_lengths = target_lengths
+        self.labeled = labeled
+
+        #the sort order of the utterance IDs is only computed when it is
+        #needed
+        self._sorter = None
+
+    @classmethod
+    def create(cls, scpfile, utt2spkfile):
+        '''
+        create the manifest of the features in an scp file
+
+        The number of frames are taken from the index of the scp file when
+        it was written together with the archives, otherwise only the headers
+        of the matrices are read.
+
+        Args:
+            scpfile: path to the features .scp file
+            utt2spkfile: path to the file containing the mapping from
+                utterance ID to speaker ID
+
+        Returns:
+            a Manifest object without targets
+        '''
+
+        reader = ark.ArkReader(scpfile)
+        index = reader.scp_index
+        if index.num_frames is not None:
+            num_frames = index.num_frames.astype(np.int32)
+        else:
+            num_frames = np.array(
+                [reader.read_shape_at(pos)[0] for pos in range(len(index))],
+                dtype=np.int32)
+        reader.close()
+
+        utt2spk = readfiles.read_utt2spk(utt2spkfile)
+        speakers, spk_ids = np.unique(
+            np.array([utt2spk[utt_id] for utt_id in index.utt_ids.tolist()],
+                     dtype=np.string_),
+            return_inverse=True)
+
+        return cls(index.utt_ids, num_frames, speakers,
+                   spk_ids.astype(np.int32))
+
+    @classmethod
+    def read(cls, featdir):
+        '''
+        read the manifest of a feature directory
+
+        Args:
+            featdir: the feature directory
+
+        Returns:
+            a Manifest object
+        '''
+
+        with np.load(os.path.join(featdir, MANIFEST_NAME)) as data:
+            arrays = {key: data[key] for key in data.files}
+
+        return cls(arrays['utt_ids'], arrays['num_frames'],
+                   arrays['speakers'], arrays['spk_ids'],
+                   arrays.get('target_lengths'), arrays.get('labeled'))
+
+    def write(self, featdir):
+        '''
+        write the manifest in a feature directory
+
+        Args:
+            featdir: the feature directory
+        '''
+
+        arrays = {'utt_ids': self.utt_ids,
+                  'num_frames': self.num_frames,
+                  'speakers': self.speakers,
+                  'spk_ids': self.spk_ids}
+
+        if self.target_lengths is not None:
+            arrays['target_lengths'] = self.target_lengths
+            arrays['labeled'] = self.labeled
+
+        np.savez(os.path.join(featdir, MANIFEST_NAME), **arrays)
+
+    def add_targets(self, target_path):
+        '''
+        add the target statistics of a targets file to the manifest
+
+        Args:
+            target_path: path to the file containing the normalized targets,
+                utterances that are not in it or have an empty target
+                sequence are unlabeled
+        '''
+
+        target_dict = readfiles.read_targets(target_path)
+
+        self.target_lengths = np.array(
+            [len(target_dict.get(utt_id, '').split())
+             for utt_id in self.utt_ids.tolist()],
+            dtype=np.int32)
+        self.labeled = self.target_lengths > 0
+
+    def positions(self, utt_ids):
+        '''
+        look up the positions of a number of utterances in the manifest
+
+        Args:
+            utt_ids: a list or numpy array of utterance IDs
+
+        Returns:
+            a numpy int64 array containing the positions
+        '''
+
+        if self._sorter is None:
+            self._sorter = np.argsort(self.utt_ids)
+
+        utt_ids = np.asarray(utt_ids, dtype=self.utt_ids.dtype)
+        sorted_pos = np.searchsorted(self.utt_ids, utt_ids,
+                                     sorter=self._sorter)
+        sorted_pos = np.minimum(sorted_pos, len(self) - 1)
+        positions = self._sorter[sorted_pos]
+
+        missing = self.utt_ids[positions] != utt_ids
+        if np.any(missing):
+            raise Exception('utterance %s is not in the manifest' %
+                            utt_ids[np.argmax(missing)])
+
+        return positions
+
+    @property
+    def max_length(self):
+        '''the maximal number of frames of the utterances'''
+
+        return int(np.max(self.num_frames)) if len(self) else 0
+
+    def __len__(self):
+        '''the number of utterances in the manifest'''
+
+        return len(self.utt_ids)
+
+def load(featdir):
+    '''
+    read the manifest of a feature directory if it has one
+
+    Args:
+        featdir: the feature directory
+
+    Returns:
+        a Manifest object or None if there is no manifest
+    '''
+
+    if not os.path.isfile(os.path.join(featdir, MANIFEST_NAME)):
+        return None
+
+    return Manifest.read(featdir)
@@ -0,0 +1,339 @@
+'''@file packed_store.py
+contains the functionality for packed feature stores
+
+A packed store is a directory containing all the features of a set in a
+single contiguous [total_frames x dim] matrix in data.npy and a table with
+the ID, the first row and the number of frames of every utterance in
+index.npz. The features are normalized when they are packed. Reading an
+utterance is a slice of a memory map of data.npy, so all the processes on a
+machine share the same pages of the page cache.'''
+
+import os
+import copy
+import hashlib
+import numpy as np
+from nabu.processing import feature_reader, scp_index, index_cache
+
+def pack_features(scpfile, storedir, cmvnfile=None, utt2spkfile=None,
+                  online_cmvn=None, dtype=np.float32):
+    '''
+    pack the features of an scp file in a packed store
+
+    Args:
+        scpfile: path to the features .scp file
+        storedir: the directory where the store will be written
+        cmvnfile: path to the cmvn file, if None and online_cmvn is None the
+            features are not normalized
+        utt2spkfile: path to the file containing the mapping from utterance
+            ID to speaker ID
+        online_cmvn: an optional OnlineCmvn object that is used instead of
+            the statistics in the cmvn file
+        dtype: the data type the features are stored in, float32 or float16
+    '''
+
+    if not os.path.isdir(storedir):
+        os.makedirs(storedir)
+
+    reader = feature_reader.FeatureReader(
+        scpfile=scpfile,
+        cmvnfile=cmvnfile,
+        utt2spkfile=utt2spkfile,
+        max_length=None,
+        online_cmvn=online_cmvn)
+    index = reader.reader.scp_index
+
+    #the lengths are in the index when the archives were written by nabu,
+    #otherwise they are read from the headers in the archives
+    if index.num_frames is not None and index.dims is not None:
+        lengths = index.num_frames.astype(np.int64)
+        dim = int(index.dims[0]) if len(index) else 0
+    else:
+        shapes = [reader.reader.read_shape_at(pos)
+                  for pos in range(len(index))]
+        lengths = np.array([shape[0] for shape in shapes], dtype=np.int64)
+        dim = shapes[0][1] if shapes else 0
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+
+    #write the normalized features in the contiguous matrix
+    data = np.lib.format.open_memmap(
+        os.path.join(storedir, 'data.npy'), mode='w+', dtype=np.dtype(dtype),
+        shape=(int(np.sum(lengths)), dim))
+    for pos in range(len(index)):
+        _, utt_mat, _ = reader.get_utt()
+        data[offsets[pos]:offsets[pos] + lengths[pos]] = utt_mat
+    data.flush()
+    del data
+
+    #the index is written last, a store without an index is incomplete
+    np.savez(os.path.join(storedir, 'index.npz'), utt_ids=index.utt_ids,
+             offsets=offsets, lengths=lengths,
+             signature=signature(scpfile, cmvnfile, online_cmvn, dtype))
+
+def packed_dtype(feat_cfg):
+    '''
+    the data type the features of a feature configuration are packed in
+
+    Args:
+        feat_cfg: the feature configuration
+
+    Returns:
+        float16 if the features are stored as float16, float32 otherwise
+    '''
+
+    if feat_cfg.get('storage_dtype', 'float32') == 'float16':
+        return 'float16'
+
+    return 'float32'
+
+def signature(scpfile, cmvnfile=None, online_cmvn=None, dtype=np.float32):
+    '''
+    a signature of the features a store is packed from, it changes when the
+    scp file, the cmvn file, the online normalization or the data type
+    change. The files are compared on their modification time and size,
+    like the sidecar caches
+
+    Args:
+        scpfile: path to the features .scp file
+        cmvnfile: path to the cmvn file or None
+        online_cmvn: the OnlineCmvn object or None
+        dtype: the data type the features are stored in
+
+    Returns:
+        the signature as a hexadecimal string
+    '''
+
+    files = [index_cache.signature(path)
+             if path is not None and os.path.isfile(path) else None
+             for path in (scpfile, cmvnfile)]
+
+    if online_cmvn is not None:
+        normalization = (online_cmvn.window, online_cmvn.decay,
+                         online_cmvn.norm_vars)
+    else:
+        normalization = None
+
+    return hashlib.md5(repr((files, normalization,
+                             np.dtype(dtype).name))).hexdigest()
+
+def usable(storedir, scpfile, cmvnfile=None, online_cmvn=None,
+           dtype=np.float32):
+    '''
+    check if a packed store holds the current features of an scp file, a
+    store that is incomplete or that was packed from other features or with
+    another normalization is not used
+
+    Args:
+        storedir: the directory of the packed store
+        scpfile: path to the features .scp file the store should be packed
+            from
+        cmvnfile: path to the cmvn file or None
+        online_cmvn: the OnlineCmvn object or None
+        dtype: the data type the features should be stored in
+
+    Returns:
+        whether or not the store can be used instead of the scp file
+    '''
+
+    indexfile = os.path.join(storedir, 'index.npz')
+    if not os.path.isfile(indexfile):
+        print ('WARNING: %s is not a complete packed store, the features are '
+               'read from %s' % (storedir, scpfile))
+        return False
+
+    with np.load(indexfile) as index:
+        num_utt = len(index['utt_ids'])
+        stored = (str(index['signature']) if 'signature' in index.files
+                  else None)
+
+    if (num_utt != len(scp_index.ScpIndex.read(scpfile))
+            or stored != signature(scpfile, cmvnfile, online_cmvn, dtype)):
+        print ('WARNING: the packed store %s was not packed from the current '
+               'features, the features are read from %s' % (storedir, scpfile))
+        return False
+
+    return True
+
+class PackedFeatureReader(object):
+    '''reads features from a packed store, it can be used everywhere a
+    FeatureReader is used'''
+
+    def __init__(self, storedir, max_length=None, splicer=None):
+        '''
+        create a PackedFeatureReader object
+
+        Args:
+            storedir: the directory of the packed store
+            max_length: the maximum length of all the utterances in the store,
+                if None it is taken from the index
+            splicer: an optional Splicer that adds context to the frames and
+                subsamples them
+        '''
+
+        self.storedir = storedir
+
+        with np.load(os.path.join(storedir, 'index.npz')) as index:
+            self.utt_ids = index['utt_ids']
+            self.offsets = index['offsets']
+            self.num_frames = index['lengths']
+
+        if max_length is None:
+            max_length = (int(np.max(self.num_frames))
+                          if len(self.num_frames) else 0)
+        self.splicer = splicer
+        if splicer is not None:
+            max_length = splicer.length(max_length)
+        self.max_length = max_length
+
+        #the reads are slices of the memory map, so there is nothing to
+        #gain from reading ahead, it is only kept for compatibility
+        self.read_ahead = 1
+
+        self.pos = 0
+
+        #the memory map and the ID to position mapping are created when they
+        #are needed
+        self._data = None
+        self._positions = None
+
+    def get_utt(self):
+        '''
+        read the next features from the store
+
+        Returns:
+            the utterance ID, the features as a read-only view on the store
+            and whether or not the utterance was the last one
+        '''
+
+        pos = self.pos
+        utt_id = str(self.utt_ids[pos])
+        utt_mat = self._read(pos)
+
+        self.pos += 1
+
+        #if at end of file loop around
+        looped = self.pos >= self.num_utt
+        if looped:
+            self.pos = 0
+
+        return utt_id, utt_mat, looped
+
+    def get_utts_at(self, positions):
+        '''
+        read the features of the utterances at a number of positions in the
+        reader, this does not change the position of the reader
+
+        Args:
+            positions: the positions of the utterances in the reader
+
+        Returns:
+            a list containing the utterance ID and the features of every
+            utterance, in the order of the positions
+        '''
+
+        return [(str(self.utt_ids[pos]), self._read(pos)) for pos in positions]
+
+    def get_utt_with_id(self, utt_id):
+        '''
+        read the features of the utterance with a certain ID
+
+        Args:
+            utt_id: the ID of the utterance
+
+        Returns:
+            the features as a read-only view on the store
+        '''
+
+        if self._positions is None:
+            self._positions = {
+                utt: pos for pos, utt in enumerate(self.utt_ids.tolist())}
+
+        return self._read(self._positions[utt_id])
+
+    def _read(self, pos):
+        '''get the features of the utterance at a position as a view on the
+        memory map'''
+
+        if self._data is None:
+            self._data = np.load(os.path.join(self.storedir, 'data.npy'),
+                                 mmap_mode='r')
+
+        utt_mat = self._data[self.offsets[pos]:
+                             self.offsets[pos] + self.num_frames[pos]]
+
+        if self.splicer is not None:
+            utt_mat = self.splicer(utt_mat)
+
+        return utt_mat
+
+    def _view(self, key):
+        '''create a reader for a part of the utterances of this reader, the
+        tables are shared
+
+        Args:
+            key: a slice
+
+        Returns:
+            the new reader'''
+
+        reader = copy.copy(self)
+        reader.utt_ids = self.utt_ids[key]
+        reader.offsets = self.offsets[key]
+        reader.num_frames = self.num_frames[key]
+        reader.pos = 0
+        reader._positions = None
+
+        return reader
+
+    def split(self, num_utt):
+        '''take a number of utterances from the reader to make a new one
+
+        Args:
+            num_utt: the number of utterances in the new reader
+
+        Returns:
+            a reader with the requested number of utterances'''
+
+        reader = self._view(slice(None, num_utt))
+
+        self.utt_ids = self.utt_ids[num_utt:]
+        self.offsets = self.offsets[num_utt:]
+        self.num_frames = self.num_frames[num_utt:]
+        self._positions = None
+
+        return reader
+
+    def shard(self, num_shards, shard_index):
+        '''create a reader for one of a number of interleaved shards
+
+        Args:
+            num_shards: the total number of shards
+            shard_index: the index of the shard
+
+        Returns:
+            a reader containing every num_shards'th utterance, starting at
+            shard_index'''
+
+        return self._view(slice(shard_index, None, num_shards))
+
+    @property
+    def num_utt(self):
+        '''number of utterances in the reader'''
+        return len(self.utt_ids)
+
+    @property
+    def lengths(self):
+        '''the number of frames of the utterances in reading order, after
+        subsampling'''
+        if self.splicer is None:
+            return self.num_frames
+        return self.splicer.length(self.num_frames)
+
+    def __getstate__(self):
+        '''the state used when copying or pickling the reader, the memory map
+        is not part of it and is recreated when needed'''
+
+        state = self.__dict__.copy()
+        state['_data'] = None
+        state['_positions'] = None
+
+        return state
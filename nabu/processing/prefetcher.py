@@ -0,0 +1,178 @@
+'''@file prefetcher.py
+contains the BatchPrefetcher class'''
+
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
+
+class BatchPrefetcher(object):
+    '''prepares the batches of a batch dispenser in the background
+
+    A producer thread reads the batches from the dispenser in order and hands
+    them to a pool of worker threads that prepare them (e.g. pad them) for the
+    training step. At most depth batches are prepared ahead. The position
+    works like the position of the dispenser: after get_batch it is the
+    position of the next batch, and asking for a batch at another position
+    throws the prefetched batches away and restarts the reading there.'''
+
+    def __init__(self, dispenser, prepare, depth=2, num_threads=1):
+        '''
+        BatchPrefetcher constructor
+
+        Args:
+            dispenser: the BatchDispenser the batches are read from
+            prepare: a function that takes the inputs and targets of a batch
+                as returned by the dispenser and returns the prepared batch
+            depth: the number of batches that are prepared ahead, if 0 the
+                batches are read and prepared when they are asked for
+            num_threads: the number of threads that prepare batches
+        '''
+
+        self.dispenser = dispenser
+        self.prepare = prepare
+        self.depth = depth
+        self.num_threads = num_threads
+
+        #the position of the next batch that get_batch will return
+        self._pos = dispenser.pos
+
+        #the running producer, it is started on the first get_batch
+        self._pool = None
+        self._producer = None
+        self._queue = None
+        self._stop = None
+
+    def get_batch(self, pos=None):
+        '''
+        Get a prepared batch
+
+        Args:
+            pos: position in the reader, if None will remain unchanged
+
+        Returns:
+            the batch at the position as returned by prepare
+        '''
+
+        if self.depth == 0:
+            batch = self.prepare(*self.dispenser.get_batch(pos))
+            self._pos = self.dispenser.pos
+            return batch
+
+        if pos is not None and pos != self._pos:
+            self.pos = pos
+
+        if self._producer is None:
+            self._start()
+
+        self._pos, result, error = self._queue.get()
+
+        if error is not None:
+            self._producer = None
+            raise error
+
+        return result.get()
+
+    def _start(self):
+        '''start reading and preparing batches at the current position'''
+
+        if self._pool is None:
+            self._pool = ThreadPool(self.num_threads)
+
+        self.dispenser.pos = self._pos
+        self._queue = Queue.Queue(self.depth)
+        self._stop = threading.Event()
+        self._producer = threading.Thread(
+            target=self._produce, args=(self._queue, self._stop))
+        self._producer.daemon = True
+        self._producer.start()
+
+    def _produce(self, queue, stop):
+        '''read batches and queue them for preparation, runs in the producer
+        thread
+
+        Args:
+            queue: the queue where the batches are put in order, every item
+                contains the position after the batch, the pending prepared
+                batch and an exception if reading failed
+            stop: an event that is set when the producer should stop
+        '''
+
+        while not stop.is_set():
+            try:
+                inputs, targets = self.dispenser.get_batch()
+                item = (self.dispenser.pos,
+                        self._pool.apply_async(self.prepare,
+                                               (inputs, targets)),
+                        None)
+            except Exception as error: #pylint: disable=W0703
+                item = (self.dispenser.pos, None, error)
+
+            #wait for a free spot in the queue, unless stopped
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+
+            if item[2] is not None:
+                return
+
+    def _stop_producer(self):
+        '''stop the producer and throw away the prefetched batches'''
+
+        if self._producer is None:
+            return
+
+        self._stop.set()
+        self._producer.join()
+        self._producer = None
+        self._queue = None
+
+    def close(self):
+        '''stop the producer and the worker threads'''
+
+        self._stop_producer()
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    @property
+    def pos(self):
+        '''the position of the next batch'''
+
+        return self._pos
+
+    @pos.setter
+    def pos(self, pos):
+        '''setter for the position of the next batch'''
+
+        self._stop_producer()
+        self._pos = pos
+        self.dispenser.pos = pos
+
+    @property
+    def size(self):
+        '''the number of utterances in a batch'''
+
+        return self.dispenser.size
+
+    @property
+    def num_batches(self):
+        '''the number of batches in the data'''
+
+        return self.dispenser.num_batches
+
+    @property
+    def max_input_length(self):
+        '''the maximal sequence length of the features'''
+
+        return self.dispenser.max_input_length
+
+    @property
+    def max_target_length(self):
+        '''the maximal length of the targets'''
+
+        return self.dispenser.max_target_length
@@ -2,6 +2,9 @@
 contains the functions used to prepare the data for GMM and DNN training'''
 
 import os
+import multiprocessing
+import tempfile
+from collections import OrderedDict
 from shutil import copyfile
 from random import shuffle
 import numpy as np
@@ -9,15 +12,24 @@ import scipy.io.wavfile as wav
 import feature_computers
 import readfiles
 import ark
+import scp_index
+import index_cache
+import manifest
 
-def prepare_data(datadir, featdir, conf):
+def prepare_data(datadir, featdir, conf, num_shards=1):
     '''
     compute the features of all segments and save them on disk
 
+    With more than one shard the recordings are split in contiguous shards
+    that are computed in parallel processes, every shard is written to its
+    own archive. The shards are merged in order, so the resulting feats.scp
+    is the same as the one of a serial run.
+
     Args:
         datadir: directory where the kaldi data prep has been done
         featdir: directory where the features will be put
         conf: feature configuration
+        num_shards: the number of shards that are computed in parallel
     '''
 
     if not os.path.exists(featdir):
@@ -26,53 +38,115 @@ def prepare_data(datadir, featdir, conf):
     #read the segments
     if os.path.isfile(datadir + '/segments'):
         segments = readfiles.read_segments(datadir + '/segments')
-        found_segments = True
     else:
         print '''WARNING: no segments file found, assuming each wav file is
             seperate utterance'''
-        found_segments = False
-
-    #create ark writer
-    if os.path.isfile(featdir + '/feats.ark'):
-        os.remove(featdir + '/feats.ark')
-    writer = ark.ArkWriter(featdir + '/feats.scp', featdir + '/feats.ark')
+        segments = None
 
     #read the wavfiles
     wavfiles = readfiles.read_wavfiles(datadir + '/wav.scp')
 
-    #read all the wav files
-    rate_utt = {utt: read_wav(wavfiles[utt]) for utt in wavfiles}
+    #split the recordings in contiguous shards
+    recordings = wavfiles.keys()
+    num_shards = max(1, min(num_shards, len(recordings)))
+    bounds = [i*len(recordings)/num_shards for i in range(num_shards + 1)]
+    jobs = []
+    for shard in range(num_shards):
+        shard_wavfiles = OrderedDict([
+            (utt, wavfiles[utt])
+            for utt in recordings[bounds[shard]:bounds[shard + 1]]])
+        if segments is None:
+            shard_segments = None
+        else:
+            shard_segments = {utt: segments[utt] for utt in shard_wavfiles}
+        if num_shards == 1:
+            name = featdir + '/feats'
+        else:
+            name = '%s/feats.%d' % (featdir, shard)
+        jobs.append((shard_wavfiles, shard_segments, conf, name + '.scp',
+                     name + '.ark'))
+
+    #compute all the features
+    if num_shards == 1:
+        index = compute_shard(jobs[0])
+    else:
+        pool = multiprocessing.Pool(num_shards)
+        indexes = pool.map(compute_shard, jobs)
+        pool.close()
+        pool.join()
+
+        #merge the shards
+        index = scp_index.ScpIndex.concatenate(indexes)
+        index.write(featdir + '/feats.scp')
+        for job in jobs:
+            os.remove(job[3])
+            if os.path.isfile(index_cache.cache_path(job[3])):
+                os.remove(index_cache.cache_path(job[3]))
+
+    #copy some kaldi files to features dir
+    copyfile(datadir + '/utt2spk', featdir + '/utt2spk')
+    copyfile(datadir + '/spk2utt', featdir + '/spk2utt')
+    copyfile(datadir + '/wav.scp', featdir + '/wav.scp')
+
+    #write the manifest with the lengths, speakers and locations of the
+    #utterances, the target statistics are added when the targets are
+    #prepared
+    manifest.Manifest.create(featdir + '/feats.scp',
+                             featdir + '/utt2spk').write(featdir)
+
+    #write the maximum length in a file
+    with open(featdir + '/maxlength', 'w') as fid:
+        fid.write(str(np.max(index.num_frames) if len(index) else 0))
+
+    #write the feature dimension in a file
+    if len(index):
+        with open(featdir + '/dim', 'w') as fid:
+            fid.write(str(index.dims[0]))
+
+def compute_shard(job):
+    '''
+    compute the features of a shard of the recordings and write them
+
+    Args:
+        job: a tuple containing
+            - an OrderedDict with the wavfiles of the shard as returned by
+                readfiles.read_wavfiles
+            - the segments of the recordings as returned by
+                readfiles.read_segments or None if every recording is an
+                utterance
+            - the feature configuration
+            - the path to the .scp file of the shard
+            - the path to the .ark file of the shard
+
+    Returns:
+        the ScpIndex of the written features
+    '''
+
+    wavfiles, segments, conf, scp_path, ark_path = job
+
+    #create ark writer
+    if os.path.isfile(ark_path):
+        os.remove(ark_path)
+    writer = ark.ArkWriter(scp_path, ark_path,
+                           dtype=conf.get('storage_dtype', 'float32'))
 
     #create a featureComputer
     comp = feature_computers.feature_computer_factory.factory(conf)
 
-    #compute all the features
-    max_length = 0
     for utt in wavfiles:
-        if found_segments:
+        rate, utterance = read_wav(wavfiles[utt])
+        if segments is not None:
             for seg in segments[utt]:
                 features = comp(
-                    rate_utt[utt][1][int(seg[1]*rate_utt[utt][0]):
-                                     int(seg[2]*rate_utt[utt][0])],
-                    rate_utt[utt][0])
-
-                writer.write_next_utt(featdir + '/feats.ark', seg[0], features)
-                max_length = max(max_length, features.shape[0])
+                    utterance[int(seg[1]*rate):int(seg[2]*rate)], rate)
+                writer.write_next_utt(seg[0], features)
         else:
-            features = comp(rate_utt[utt][1], rate_utt[utt][0])
+            features = comp(utterance, rate)
             writer.write_next_utt(utt, features)
-            max_length = max(max_length, features.shape[0])
 
     writer.close()
 
-    #copy some kaldi files to features dir
-    copyfile(datadir + '/utt2spk', featdir + '/utt2spk')
-    copyfile(datadir + '/spk2utt', featdir + '/spk2utt')
-    copyfile(datadir + '/wav.scp', featdir + '/wav.scp')
-
-    #write the maximum length in a file
-    with open(featdir + '/maxlength', 'w') as fid:
-        fid.write(str(max_length))
+    return writer.index
 
 def compute_cmvn(featdir):
     '''
@@ -98,8 +172,9 @@ def compute_cmvn(featdir):
 
         split = line.split(' ')
 
-        #get first speaker utterance
-        spk_data = reader.read_utt_data(split[1])
+        #get first speaker utterance, compact features are upcast before the
+        #statistics are accumulated
+        spk_data = reader.read_utt_data(split[1]).astype(np.float64)
 
         #get the rest of the utterances
         for utt_id in split[2:len(split)]:
@@ -149,12 +224,15 @@ def read_wav(wavfile):
     '''
 
     if wavfile[1]:
-        #read the audio file and temporarily copy it to tmp
-        os.system(wavfile[0] + ' tee tmp.wav > /dev/null')
+        #read the audio file and temporarily copy it to a unique file, so
+        #parallel jobs do not overwrite each others audio
+        handle, tmpfile = tempfile.mkstemp(suffix='.wav')
+        os.close(handle)
+        os.system(wavfile[0] + ' tee %s > /dev/null' % tmpfile)
         #read the created wav file
-        (rate, utterance) = wav.read('tmp.wav')
+        (rate, utterance) = wav.read(tmpfile)
         #delete the create file
-        os.remove('tmp.wav')
+        os.remove(tmpfile)
     else:
         (rate, utterance) = wav.read(wavfile[0])
 
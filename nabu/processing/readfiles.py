@@ -5,6 +5,7 @@ contains functions to read some files created by Kaldi
 import gzip
 from collections import OrderedDict
 import numpy as np
+from nabu.processing import index_cache
 
 def read_alignments(filename):
     '''
@@ -97,9 +98,60 @@ def read_utt2spk(filename):
         a dictionary containing the speaker names with the utterance IDs as keys
     '''
 
+    #use the cached content if it is still valid
+    arrays = index_cache.load(filename)
+    if arrays is not None:
+        return dict(zip(arrays['utt_ids'].tolist(),
+                        arrays['spk_ids'].tolist()))
+
+    source = index_cache.signature(filename)
+
     with open(filename) as fid:
         utt2spk = {}
         for line in fid:
             data = line.strip().split(' ')
             utt2spk[data[0]] = data[1]
+
+    index_cache.save(
+        filename,
+        {'utt_ids': np.array(utt2spk.keys(), dtype=np.string_),
+         'spk_ids': np.array(utt2spk.values(), dtype=np.string_)},
+        source)
+
     return utt2spk
+
+def read_targets(filename):
+    '''
+    Read a targets file, every line contains an utterance ID followed by the
+    space separated targets of the utterance
+
+    Args:
+        filename: path to the targets file
+
+    Returns:
+        a dictionary containing the target strings with the utterance IDs as
+        keys, utterances without targets have an empty string
+    '''
+
+    #use the cached content if it is still valid
+    arrays = index_cache.load(filename)
+    if arrays is not None:
+        utt_ids = arrays['utt_ids'].tolist()
+        targets = index_cache.unpack_strings(arrays['targets'], len(utt_ids))
+        return dict(zip(utt_ids, targets))
+
+    source = index_cache.signature(filename)
+
+    with open(filename) as fid:
+        target_dict = {}
+        for line in fid:
+            splitline = line.strip().split(' ')
+            target_dict[splitline[0]] = ' '.join(splitline[1:])
+
+    index_cache.save(
+        filename,
+        {'utt_ids': np.array(target_dict.keys(), dtype=np.string_),
+         'targets': index_cache.pack_strings(target_dict.values())},
+        source)
+
+    return target_dict
@@ -0,0 +1,470 @@
+'''@file sampler.py
+contains the samplers that choose the utterances of the batches
+
+A sampler chooses the positions (in the feature reader) of the utterances of
+every batch before anything is read, so a batch dispenser only reads the
+utterances it actually uses. The state of a sampler is a single integer
+position, so it can be stored and restored like the position of a feature
+reader.'''
+
+import numpy as np
+
+class SequentialSampler(object):
+    '''takes the utterances of the batches from a list of positions, looping
+    around at the end of every epoch
+
+    The position is the number of utterances that have been taken, over all
+    epochs. When a seed is given, the positions are taken in a different
+    random order every epoch. The order only depends on the seed and the
+    epoch, so it is found back from the position alone.'''
+
+    def __init__(self, positions, size, seed=None, block_size=0):
+        '''
+        SequentialSampler constructor
+
+        Args:
+            positions: the positions in the reader the utterances are taken
+                from
+            size: the number of utterances in a batch
+            seed: the seed of the shuffling, if None the positions are taken
+                in order
+            block_size: if larger than 0 only blocks of block_size
+                consecutive positions are shuffled, see epoch_order
+        '''
+
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.size = size
+        self.seed = seed
+        self.block_size = block_size
+        self.pos = 0
+
+        #the order of the last epoch that was used
+        self._epoch = None
+        self._order = None
+
+    def next_batch(self):
+        '''
+        choose the utterances of the next batch
+
+        Returns:
+            a numpy array containing the positions in the reader of the
+            utterances in the batch
+        '''
+
+        batch = self.take(self.pos, self.size)
+        self.pos += self.size
+
+        return batch
+
+    def take(self, pos, num_utt):
+        '''
+        get the positions in the reader of a number of consecutive utterances
+
+        Args:
+            pos: the sampler position of the first utterance
+            num_utt: the number of utterances
+
+        Returns:
+            a numpy array containing the positions in the reader
+        '''
+
+        if num_utt == 0:
+            return self.positions[:0]
+
+        if not len(self.positions):
+            raise Exception('there are no utterances to sample from')
+
+        indices = pos + np.arange(num_utt)
+
+        if self.seed is None:
+            return self.positions[indices % len(self.positions)]
+
+        #a batch can span the end of an epoch
+        epochs, indices = np.divmod(indices, len(self.positions))
+        batch = np.empty(num_utt, dtype=np.int64)
+        for epoch in np.unique(epochs):
+            selected = epochs == epoch
+            batch[selected] = self.positions[
+                self._epoch_order(int(epoch))[indices[selected]]]
+
+        return batch
+
+    def _epoch_order(self, epoch):
+        '''the order of the positions in an epoch, the order of the last
+        epoch is kept'''
+
+        if epoch != self._epoch:
+            self._order = epoch_order(len(self.positions), self.seed, epoch,
+                                      self.block_size)
+            self._epoch = epoch
+
+        return self._order
+
+    @property
+    def num_utt(self):
+        '''the number of utterances the sampler chooses from'''
+
+        return len(self.positions)
+
+    @property
+    def num_batches(self):
+        '''the number of batches in an epoch'''
+
+        return float(self.num_utt)/self.size
+
+class StratifiedSampler(object):
+    '''takes batches with a fixed number of utterances of every stratum, e.g.
+    the labeled and the unlabeled utterances
+
+    The utterances of every stratum are taken in order from their own list,
+    so every batch contains exactly the requested number of all of them and
+    no utterance is read and thrown away. The position is the number of
+    batches that have been taken.'''
+
+    def __init__(self, strata, seed=None, block_size=0):
+        '''
+        StratifiedSampler constructor
+
+        Args:
+            strata: a list of pairs containing the positions in the reader of
+                the utterances of a stratum and the number of utterances of
+                the stratum in a batch
+            seed: the seed of the shuffling, if None the utterances are taken
+                in order
+            block_size: if larger than 0 only blocks of block_size
+                consecutive utterances are shuffled
+        '''
+
+        #the strata are shuffled independently
+        self.strata = [
+            SequentialSampler(positions, count,
+                              None if seed is None else seed + i, block_size)
+            for i, (positions, count) in enumerate(strata)]
+        self.size = sum(stratum.size for stratum in self.strata)
+
+        self.pos = 0
+
+    def next_batch(self):
+        '''
+        choose the utterances of the next batch
+
+        Returns:
+            a numpy array containing the positions in the reader of the
+            utterances of every stratum, one stratum after the other
+        '''
+
+        batch = np.concatenate([
+            stratum.take(self.pos*stratum.size, stratum.size)
+            for stratum in self.strata])
+        self.pos += 1
+
+        return batch
+
+    @property
+    def num_utt(self):
+        '''the number of utterances the sampler chooses from'''
+
+        return sum(stratum.num_utt for stratum in self.strata)
+
+    @property
+    def num_batches(self):
+        '''the number of batches in an epoch'''
+
+        return float(self.num_utt)/self.size
+
+class BucketSampler(object):
+    '''takes every batch from a single bucket of utterances with similar
+    lengths
+
+    The utterances are divided in buckets on their length. The batches of a
+    bucket are taken from its strata like with a StratifiedSampler and the
+    batches of all the buckets are taken in a different random order every
+    epoch. A bucket that does not have utterances of every stratum is merged
+    with the next one, so every batch keeps the fixed number of utterances of
+    every stratum. The position is the number of batches that have been
+    taken.'''
+
+    def __init__(self, strata, lengths, boundaries, seed=None, block_size=0):
+        '''
+        BucketSampler constructor
+
+        Args:
+            strata: a list of pairs containing the positions in the reader of
+                the utterances of a stratum and the number of utterances of
+                the stratum in a batch
+            lengths: a numpy array containing the length of every utterance
+                in the reader
+            boundaries: the sorted maximal lengths of the buckets, longer
+                utterances go in the last bucket
+            seed: the seed of the shuffling, if None the utterances of a
+                bucket are taken in order, the order of the batches is
+                always random
+            block_size: if larger than 0 only blocks of block_size
+                consecutive utterances of a bucket are shuffled
+        '''
+
+        lengths = np.asarray(lengths)
+        self.seed = 0 if seed is None else seed + len(strata)
+
+        #the bucket of every utterance of every stratum
+        buckets = [np.minimum(np.searchsorted(boundaries, lengths[positions]),
+                              len(boundaries) - 1)
+                   for positions, _ in strata]
+        merged = merge_buckets(buckets, [count for _, count in strata],
+                               len(boundaries))
+        buckets = [merged[stratum_buckets] for stratum_buckets in buckets]
+
+        #the strata of every bucket
+        self.buckets = [
+            StratifiedSampler(
+                [(np.asarray(positions)[stratum_buckets == bucket], count)
+                 for (positions, count), stratum_buckets
+                 in zip(strata, buckets)],
+                seed, block_size)
+            for bucket in range(merged[-1] + 1)]
+        self.size = self.buckets[0].size
+
+        #the number of batches of every bucket in an epoch, the stratum that
+        #needs the most batches is taken once
+        self.bucket_batches = np.array(
+            [max([-(-stratum.num_utt//stratum.size)
+                  for stratum in bucket.strata if stratum.size > 0] or [0])
+             for bucket in self.buckets], dtype=np.int64)
+
+        self.pos = 0
+
+        #the order of the batches of the last epoch that was used
+        self._epoch = None
+        self._order = None
+
+    def next_batch(self):
+        '''
+        choose the utterances of the next batch
+
+        Returns:
+            a numpy array containing the positions in the reader of the
+            utterances of every stratum of the bucket, one stratum after the
+            other
+        '''
+
+        if self.num_batches == 0:
+            raise Exception('there are no utterances to sample from')
+
+        epoch, index = divmod(self.pos, self.num_batches)
+        buckets, batches = self._epoch_order(epoch)
+        bucket = self.buckets[buckets[index]]
+
+        #the batches of a bucket are taken in order over the epochs
+        bucket.pos = epoch*self.bucket_batches[buckets[index]] + batches[index]
+        batch = bucket.next_batch()
+        self.pos += 1
+
+        return batch
+
+    def _epoch_order(self, epoch):
+        '''the buckets and the indices in the bucket of the batches of an
+        epoch, the order of the last epoch is kept'''
+
+        if epoch != self._epoch:
+            buckets = np.repeat(np.arange(len(self.buckets)),
+                                self.bucket_batches)
+            batches = np.arange(len(buckets)) - np.repeat(
+                np.cumsum(self.bucket_batches) - self.bucket_batches,
+                self.bucket_batches)
+            order = epoch_order(len(buckets), self.seed, epoch)
+            self._order = buckets[order], batches[order]
+            self._epoch = epoch
+
+        return self._order
+
+    @property
+    def num_utt(self):
+        '''the number of utterances the sampler chooses from'''
+
+        return sum(bucket.num_utt for bucket in self.buckets)
+
+    @property
+    def num_batches(self):
+        '''the number of batches in an epoch'''
+
+        return int(np.sum(self.bucket_batches))
+
+class BudgetSampler(object):
+    '''takes batches that fit in a budget of padded frames and target tokens
+
+    The utterances are taken in the order of a SequentialSampler. A batch
+    gets as many of the next utterances as possible, up to the batch size,
+    as long as the number of utterances times the longest input does not
+    exceed the frame budget and the number of utterances times the longest
+    target sequence does not exceed the token budget. An utterance that does
+    not fit in the budget on its own gets a batch of its own. The position is
+    the position of the sequential sampler, so it is resumable in the same
+    way.'''
+
+    def __init__(self, sequential, input_lengths, target_lengths, max_frames,
+                 max_tokens=0):
+        '''
+        BudgetSampler constructor
+
+        Args:
+            sequential: the SequentialSampler that gives the order of the
+                utterances, its size is the maximal number of utterances in a
+                batch
+            input_lengths: a numpy array containing the input length of every
+                utterance in the reader, it is only used with a frame budget
+                and can be None without one
+            target_lengths: a numpy array containing the target length of
+                every utterance in the reader
+            max_frames: the maximal number of padded input frames in a batch,
+                0 for no limit
+            max_tokens: the maximal number of padded target tokens in a
+                batch, 0 for no limit
+        '''
+
+        if max_frames > 0 and input_lengths is None:
+            raise Exception('a frame budget needs the input lengths')
+
+        self.sequential = sequential
+        if max_frames > 0:
+            self.input_lengths = np.asarray(input_lengths, dtype=np.int64)
+        else:
+            self.input_lengths = None
+        self.target_lengths = np.asarray(target_lengths, dtype=np.int64)
+        self.max_frames = max_frames
+        self.max_tokens = max_tokens
+        self.size = sequential.size
+
+        #the number of batches is only counted when it is needed
+        self._num_batches = None
+
+    def next_batch(self):
+        '''
+        choose the utterances of the next batch
+
+        Returns:
+            a numpy array containing the positions in the reader of the
+            utterances in the batch, it contains at most size utterances
+        '''
+
+        candidates = self.sequential.take(self.pos, self.size)
+        batch = candidates[:self._fit(candidates)]
+        self.pos += len(batch)
+
+        return batch
+
+    def _fit(self, candidates):
+        '''the number of leading candidates that fit in the budget, at least
+        1'''
+
+        counts = np.arange(1, len(candidates) + 1)
+        fits = np.ones(len(candidates), dtype=np.bool_)
+
+        if self.max_frames > 0:
+            fits &= counts*np.maximum.accumulate(
+                self.input_lengths[candidates]) <= self.max_frames
+        if self.max_tokens > 0:
+            fits &= counts*np.maximum.accumulate(
+                self.target_lengths[candidates]) <= self.max_tokens
+
+        if fits.all():
+            return len(candidates)
+
+        return max(int(np.argmin(fits)), 1)
+
+    @property
+    def pos(self):
+        '''the position of the sequential sampler'''
+
+        return self.sequential.pos
+
+    @pos.setter
+    def pos(self, pos):
+        '''setter for the position'''
+
+        self.sequential.pos = pos
+
+    @property
+    def num_utt(self):
+        '''the number of utterances the sampler chooses from'''
+
+        return self.sequential.num_utt
+
+    @property
+    def num_batches(self):
+        '''the number of batches in the first epoch, the other epochs have
+        about as many if the utterances are shuffled'''
+
+        if self._num_batches is None:
+            pos = 0
+            num_batches = 0
+            while pos < self.num_utt:
+                pos += self._fit(self.sequential.take(
+                    pos, min(self.size, self.num_utt - pos)))
+                num_batches += 1
+            self._num_batches = num_batches
+
+        return self._num_batches
+
+def epoch_order(num_utt, seed, epoch, block_size=0):
+    '''
+    the random order of the utterances in an epoch
+
+    Args:
+        num_utt: the number of utterances
+        seed: the seed of the shuffling
+        epoch: the epoch, every epoch has a different order
+        block_size: if larger than 0 the utterances are divided in blocks of
+            block_size consecutive utterances. The order of the blocks and the
+            order of the utterances within every block are shuffled, but the
+            utterances of a block stay together, so the reads stay close to
+            each other in the archives
+
+    Returns:
+        a numpy array containing a permutation of range(num_utt)
+    '''
+
+    rng = np.random.RandomState([seed, epoch])
+
+    if block_size <= 0:
+        return rng.permutation(num_utt)
+
+    #sort on a random rank of the block and a random key within the block
+    blocks = np.arange(num_utt)//block_size
+    block_ranks = rng.permutation(blocks[-1] + 1 if num_utt else 0)
+
+    return np.lexsort((rng.random_sample(num_utt), block_ranks[blocks]))
+
+def merge_buckets(buckets, counts, num_buckets):
+    '''
+    merge the buckets that do not have utterances of every stratum that is
+    used with the next bucket, the last buckets are merged with the previous
+    one
+
+    Args:
+        buckets: a list containing a numpy array with the bucket of every
+            utterance of a stratum
+        counts: the number of utterances of every stratum in a batch
+        num_buckets: the number of buckets
+
+    Returns:
+        a numpy array containing the merged bucket of every bucket
+    '''
+
+    used = [np.bincount(stratum_buckets, minlength=num_buckets)
+            for stratum_buckets, count in zip(buckets, counts) if count > 0]
+
+    merged = np.zeros([num_buckets], dtype=np.int64)
+    bucket = 0
+    available = np.zeros([len(used)], dtype=np.int64)
+    for i in range(num_buckets):
+        merged[i] = bucket
+        available += [stratum_used[i] for stratum_used in used]
+        if np.all(available > 0):
+            bucket += 1
+            available[:] = 0
+
+    #the last buckets miss utterances of a stratum
+    if bucket > 0 and merged[-1] == bucket:
+        merged[merged == bucket] = bucket - 1
+
+    return merged
@@ -0,0 +1,267 @@
+'''@file scp_index.py
+contains the ScpIndex class'''
+
+import numpy as np
+from nabu.processing import index_cache
+
+class ScpIndex(object):
+    '''a compact index of a Kaldi .scp file
+
+    The utterance IDs are stored in a numpy string array, the archive of every
+    utterance as an index in a table of unique archive paths and the offsets
+    in the archives as int64. Utterances can be looked up by position and by
+    ID in constant time. When the index was written together with the
+    archives, it also knows the number of frames and the dimension of every
+    utterance.'''
+
+    def __init__(self, utt_ids, paths, path_ids, offsets, num_frames=None,
+                 dims=None):
+        '''
+        ScpIndex constructor
+
+        Args:
+            utt_ids: a numpy string array containing the utterance IDs
+            paths: a list containing all the unique archive paths
+            path_ids: a numpy int32 array containing for every utterance the
+                index of its archive in paths
+            offsets: a numpy int64 array containing for every utterance the
+                position of its data in the archive
+            num_frames: an optional numpy int32 array containing the number
+                of frames (rows) of every utterance
+            dims: an optional numpy int32 array containing the dimension
+                (columns) of every utterance
+        '''
+
+        self.utt_ids = utt_ids
+        self.paths = paths
+        self.path_ids = path_ids
+        self.offsets = offsets
+        self.num_frames = num_frames
+        self.dims = dims
+
+        #the ID to position mapping is only created when it is needed
+        self._positions = None
+
+    @classmethod
+    def read(cls, scp_path, use_cache=True):
+        '''
+        create an index for an .scp file
+
+        The parsed index is cached in a sidecar file next to the .scp file, so
+        it only has to be parsed again when the .scp file changes.
+
+        Args:
+            scp_path: path to the .scp file
+            use_cache: whether or not the sidecar cache should be used
+
+        Returns:
+            an ScpIndex object
+        '''
+
+        if use_cache:
+            arrays = index_cache.load(scp_path)
+            if arrays is not None:
+                return cls.from_arrays(arrays)
+            source = index_cache.signature(scp_path)
+
+        index = cls.parse(scp_path)
+
+        if use_cache:
+            index_cache.save(scp_path, index.to_arrays(), source)
+
+        return index
+
+    @classmethod
+    def parse(cls, scp_path):
+        '''
+        create an index by parsing an .scp file
+
+        Args:
+            scp_path: path to the .scp file
+
+        Returns:
+            an ScpIndex object
+        '''
+
+        utt_ids = []
+        path_ids = []
+        offsets = []
+        path_table = {}
+        paths = []
+
+        with open(scp_path) as fid:
+            for line in fid:
+                utt_id, path_pos = line.split()
+                path, pos = path_pos.rsplit(':', 1)
+
+                #intern the archive path
+                if path not in path_table:
+                    path_table[path] = len(paths)
+                    paths.append(path)
+
+                utt_ids.append(utt_id)
+                path_ids.append(path_table[path])
+                offsets.append(int(pos))
+
+        return cls(np.array(utt_ids, dtype=np.string_), paths,
+                   np.array(path_ids, dtype=np.int32),
+                   np.array(offsets, dtype=np.int64))
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        '''
+        create an index from the arrays created with to_arrays
+
+        Args:
+            arrays: a dictionary of numpy arrays
+
+        Returns:
+            an ScpIndex object
+        '''
+
+        return cls(arrays['utt_ids'], [str(path) for path in arrays['paths']],
+                   arrays['path_ids'], arrays['offsets'],
+                   arrays.get('num_frames'), arrays.get('dims'))
+
+    def to_arrays(self):
+        '''the content of the index as a dictionary of numpy arrays'''
+
+        arrays = {'utt_ids': self.utt_ids,
+                  'paths': np.array(self.paths, dtype=np.string_),
+                  'path_ids': self.path_ids,
+                  'offsets': self.offsets}
+
+        if self.num_frames is not None:
+            arrays['num_frames'] = self.num_frames
+        if self.dims is not None:
+            arrays['dims'] = self.dims
+
+        return arrays
+
+    @classmethod
+    def concatenate(cls, indexes):
+        '''
+        concatenate a list of indexes
+
+        Args:
+            indexes: a list of ScpIndex objects
+
+        Returns:
+            an ScpIndex containing the utterances of all indexes in order
+        '''
+
+        paths = []
+        path_ids = []
+        for index in indexes:
+            path_ids.append(index.path_ids + len(paths))
+            paths += index.paths
+
+        if all(index.num_frames is not None for index in indexes):
+            num_frames = np.concatenate([index.num_frames for index in indexes])
+        else:
+            num_frames = None
+        if all(index.dims is not None for index in indexes):
+            dims = np.concatenate([index.dims for index in indexes])
+        else:
+            dims = None
+
+        return cls(np.concatenate([index.utt_ids for index in indexes]),
+                   paths, np.concatenate(path_ids).astype(np.int32),
+                   np.concatenate([index.offsets for index in indexes]),
+                   num_frames, dims)
+
+    def write(self, scp_path):
+        '''
+        write the index as an .scp file together with its sidecar cache
+
+        Args:
+            scp_path: path to the .scp file
+        '''
+
+        with open(scp_path, 'w') as fid:
+            for pos in range(len(self)):
+                fid.write('%s %s:%d\n' % ((self.utt_id(pos),)
+                                          + self.location(pos)))
+
+        self.save(scp_path)
+
+    def save(self, scp_path):
+        '''
+        write the index as the sidecar cache of an .scp file
+
+        Args:
+            scp_path: path to the .scp file this index describes, it should be
+                completely written and closed
+        '''
+
+        index_cache.save(scp_path, self.to_arrays())
+
+    def __len__(self):
+        '''the number of utterances in the index'''
+
+        return len(self.offsets)
+
+    def __getitem__(self, key):
+        '''
+        select a part of the index
+
+        Args:
+            key: a slice or an array of positions
+
+        Returns:
+            an ScpIndex containing the selected utterances in the given
+            order, when key is a slice the arrays are views on this index
+        '''
+
+        return ScpIndex(
+            self.utt_ids[key], self.paths, self.path_ids[key],
+            self.offsets[key],
+            None if self.num_frames is None else self.num_frames[key],
+            None if self.dims is None else self.dims[key])
+
+    def __contains__(self, utt_id):
+        '''check if an utterance is in the index'''
+
+        return utt_id in self.positions
+
+    def utt_id(self, pos):
+        '''the utterance ID at a position in the index'''
+
+        return str(self.utt_ids[pos])
+
+    def location(self, pos):
+        '''
+        the location of the data of an utterance
+
+        Args:
+            pos: the position of the utterance in the index
+
+        Returns:
+            a pair containing the archive path and the offset in the archive
+        '''
+
+        return self.paths[self.path_ids[pos]], int(self.offsets[pos])
+
+    def position(self, utt_id):
+        '''the position of an utterance ID in the index'''
+
+        return self.positions[utt_id]
+
+    @property
+    def positions(self):
+        '''a dictionary mapping the utterance IDs to their positions'''
+
+        if self._positions is None:
+            self._positions = {
+                utt_id: pos for pos, utt_id in enumerate(self.utt_ids)}
+
+        return self._positions
+
+    def __getstate__(self):
+        '''the state used when copying or pickling the index, the ID mapping
+        can be recreated and is left out'''
+
+        state = self.__dict__.copy()
+        state['_positions'] = None
+
+        return state
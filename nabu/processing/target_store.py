@@ -0,0 +1,111 @@
+'''@file target_store.py
+contains the TargetStore class'''
+
+import numpy as np
+from nabu.processing import readfiles
+
+class TargetStore(object):
+    '''the encoded targets of a targets file
+
+    All the targets are encoded once when the store is created and kept in a
+    single flat label array with a table of offsets, so getting the targets of
+    an utterance is a slice of that array. The labels are stored in the
+    smallest unsigned integer type that fits the alphabet.'''
+
+    def __init__(self, target_path, target_coder):
+        '''
+        TargetStore constructor
+
+        Args:
+            target_path: path to the file containing the targets
+            target_coder: a TargetCoder object used to encode the targets
+        '''
+
+        target_dict = readfiles.read_targets(target_path)
+
+        #encode all the targets in one pass
+        lookup = target_coder.lookup
+        self.utt_ids = target_dict.keys()
+        lengths = np.zeros([len(self.utt_ids)], dtype=np.int64)
+        labels = []
+        for i, targets in enumerate(target_dict.itervalues()):
+            encoded = [lookup[target] for target in targets.split()]
+            lengths[i] = len(encoded)
+            labels.extend(encoded)
+
+        dtype = np.min_scalar_type(max(target_coder.num_labels - 1, 0))
+        self.labels = np.array(labels, dtype=dtype)
+        self.labels.flags.writeable = False
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)])
+        self.lengths = lengths
+
+        #utterances with an empty target sequence are unlabeled
+        self.labeled = lengths > 0
+
+        #the targets of the utterances that are not in the targets file
+        self.empty = self.labels[:0]
+
+        self._positions = {utt_id: pos for pos, utt_id
+                           in enumerate(self.utt_ids)}
+
+    def get(self, utt_id):
+        '''
+        get the encoded targets of an utterance
+
+        Args:
+            utt_id: the utterance ID
+
+        Returns:
+            a read-only numpy array containing the encoded targets, it is empty
+            for unlabeled utterances, or None if the utterance is not in the
+            targets file
+        '''
+
+        pos = self._positions.get(utt_id)
+        if pos is None:
+            return None
+
+        return self.labels[self.offsets[pos]:self.offsets[pos + 1]]
+
+    def is_labeled(self, utt_id):
+        '''check if an utterance has a non empty target sequence'''
+
+        pos = self._positions.get(utt_id)
+
+        return pos is not None and bool(self.labeled[pos])
+
+    def lengths_of(self, utt_ids):
+        '''
+        get the lengths of the target sequences of a number of utterances
+
+        Args:
+            utt_ids: the utterance IDs
+
+        Returns:
+            a numpy int64 array containing the lengths, 0 for the utterances
+            that are not in the store
+        '''
+
+        positions = [self._positions.get(utt_id, -1) for utt_id in utt_ids]
+        lengths = np.append(self.lengths, 0)
+
+        return lengths[positions]
+
+    @property
+    def max_length(self):
+        '''the maximal length of the target sequences, at least 1'''
+
+        if len(self.lengths) == 0:
+            return 1
+
+        return max(int(np.max(self.lengths)), 1)
+
+    def __len__(self):
+        '''the number of utterances in the store'''
+
+        return len(self.utt_ids)
+
+    def __contains__(self, utt_id):
+        '''check if an utterance is in the store'''
+
+        return utt_id in self._positions
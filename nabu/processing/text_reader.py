@@ -31,6 +31,10 @@ class TextReader(object):
         #store the scp path
         self.textfile = textfile
 
+        #the offsets of the lines of an interleaved shard mapped to the offset
+        #of the next line in the shard, None if all the lines are read
+        self.next_pos = None
+
     def get_utt(self):
         '''read the next line of data specified in the scp file
 
@@ -70,7 +74,14 @@ class TextReader(object):
         with open(self.textfile) as fid:
             fid.seek(self.pos)
             line = fid.readline().strip()
-            self.pos = fid.tell()
+            if self.next_pos is None:
+                self.pos = fid.tell()
+            else:
+                #a shard continues with its next line, after its last line
+                #it comes back to the base position
+                self.pos = self.next_pos[self.pos]
+                if self.pos == self.base_pos:
+                    self.pos = self.end_pos
 
         #if end of file is reached loop around
         if self.pos >= self.end_pos:
@@ -81,6 +92,30 @@ class TextReader(object):
 
         return line_id, line, looped
 
+    def skip_lines(self, numlines):
+        '''move the position past a number of lines without encoding them,
+        a shard does not read anything
+
+        Args:
+            numlines: the number of lines to skip
+        '''
+
+        if self.next_pos is not None:
+            for _ in range(numlines):
+                self.pos = self.next_pos[self.pos]
+            return
+
+        with open(self.textfile) as fid:
+            fid.seek(self.pos)
+            for _ in range(numlines):
+                fid.readline()
+                self.pos = fid.tell()
+
+                #if end of file is reached loop around
+                if self.pos >= self.end_pos:
+                    self.pos = self.base_pos
+                    fid.seek(self.pos)
+
     def split(self, numlines):
         '''split of a part of the textreader
 
@@ -91,6 +126,9 @@ class TextReader(object):
             a Textreader object that contains the required number of lines
         '''
 
+        if self.next_pos is not None:
+            raise Exception('a shard of a textreader can not be split')
+
         #read the requested number of lines
         self.pos = self.base_pos
         for _ in range(numlines):
@@ -99,14 +137,47 @@ class TextReader(object):
                 raise Exception('number of requested lines exeeds the content')
 
         #create a new textreader with the appropriate boundaries
-        textreader = TextReader(self.textfile, self.max_length, self.base_pos,
-                                self.pos)
+        textreader = TextReader(self.textfile, self.max_length, self.coder,
+                                self.base_pos, self.pos)
 
         #update the base position
         self.base_pos = self.pos
 
         return textreader
 
+    def shard(self, num_shards, shard_index):
+        '''create a textreader for one of a number of interleaved shards of
+        the lines, the file is not copied
+
+        Args:
+            num_shards: the total number of shards
+            shard_index: the index of the shard
+
+        Returns:
+            a Textreader object that reads every num_shards'th line, starting
+            at shard_index
+        '''
+
+        #find the offsets of the lines
+        offsets = []
+        with open(self.textfile) as fid:
+            fid.seek(self.base_pos)
+            while fid.tell() < self.end_pos:
+                offsets.append(fid.tell())
+                if not fid.readline():
+                    break
+
+        offsets = offsets[shard_index::num_shards]
+        if not offsets:
+            raise Exception('there are not enough lines for %d shards' %
+                            num_shards)
+
+        textreader = TextReader(self.textfile, self.max_length, self.coder,
+                                offsets[0], self.end_pos)
+        textreader.next_pos = dict(zip(offsets, offsets[1:] + offsets[:1]))
+
+        return textreader
+
     def as_dict(self):
         '''return the reader as a dictionary'''
 
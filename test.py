@@ -7,7 +7,8 @@ import tensorflow as tf
 from tensorflow.contrib.framework.python.framework import checkpoint_utils
 from nabu.neuralnetworks.classifiers import asr_lm_classifier
 from nabu.neuralnetworks.decoders import decoder_factory
-from nabu.processing import feature_reader, target_coder
+from nabu.processing import feature_reader, target_coder, packed_store,\
+    manifest
 
 
 tf.app.flags.DEFINE_string('asr_expdir', 'expdir',
@@ -61,11 +62,31 @@ def main(_):
     with open(os.path.join(featdir, 'maxlength'), 'r') as fid:
         max_length = int(fid.read())
 
-    reader = feature_reader.FeatureReader(
-        scpfile=os.path.join(featdir, 'feats.scp'),
-        cmvnfile=os.path.join(featdir, 'cmvn.scp'),
-        utt2spkfile=os.path.join(featdir, 'utt2spk'),
-        max_length=max_length)
+    #the optional frame splicing and subsampling of the inputs
+    splicer = feature_reader.splicer(feat_cfg)
+
+    #read the packed store if the features were packed from the current
+    #features
+    if (database_cfg.get('packed_features', 'False') == 'True'
+            and packed_store.usable(
+                os.path.join(featdir, 'packed'),
+                os.path.join(featdir, 'feats.scp'),
+                os.path.join(featdir, 'cmvn.scp'),
+                feature_reader.online_cmvn(feat_cfg),
+                packed_store.packed_dtype(feat_cfg))):
+        reader = packed_store.PackedFeatureReader(
+            storedir=os.path.join(featdir, 'packed'),
+            max_length=max_length,
+            splicer=splicer)
+    else:
+        reader = feature_reader.FeatureReader(
+            scpfile=os.path.join(featdir, 'feats.scp'),
+            cmvnfile=os.path.join(featdir, 'cmvn.scp'),
+            utt2spkfile=os.path.join(featdir, 'utt2spk'),
+            max_length=max_length,
+            online_cmvn=feature_reader.online_cmvn(feat_cfg),
+            splicer=splicer,
+            manifest=manifest.load(featdir))
 
     #read the feature dimension
     with open(
@@ -74,6 +95,8 @@ def main(_):
         'r') as fid:
 
         input_dim = int(fid.read())
+    if splicer is not None:
+        input_dim = splicer.dim(input_dim)
 
     #create the coder
     with open(os.path.join(database_cfg['train_dir'], 'alphabet')) as fid:
@@ -97,7 +120,8 @@ def main(_):
             input_dim=input_dim,
             max_input_length=reader.max_length,
             coder=coder,
-            expdir=FLAGS.asr_expdir)
+            expdir=FLAGS.asr_expdir,
+            input_lengths=reader.lengths)
 
 
         #create the lm saver
@@ -8,7 +8,7 @@ import tensorflow as tf
 import numpy as np
 from nabu.neuralnetworks.classifiers.asr import asr_factory
 from nabu.neuralnetworks import ops
-from nabu.processing import feature_reader
+from nabu.processing import feature_reader, packed_store
 
 
 tf.app.flags.DEFINE_string('expdir', 'expdir', 'The experiments directory')
@@ -60,11 +60,31 @@ def main(_):
     with open(os.path.join(featdir, 'maxlength'), 'r') as fid:
         max_length_feat = int(fid.read())
 
-    feat_reader = feature_reader.FeatureReader(
-        scpfile=os.path.join(featdir, 'feats.scp'),
-        cmvnfile=os.path.join(featdir, 'cmvn.scp'),
-        utt2spkfile=os.path.join(featdir, 'utt2spk'),
-        max_length=max_length_feat)
+    #the optional frame splicing and subsampling of the inputs, like in
+    #training
+    splicer = feature_reader.splicer(feat_cfg)
+
+    #read the packed store if the features were packed from the current
+    #features
+    if (database_cfg.get('packed_features', 'False') == 'True'
+            and packed_store.usable(
+                os.path.join(featdir, 'packed'),
+                os.path.join(featdir, 'feats.scp'),
+                os.path.join(featdir, 'cmvn.scp'),
+                feature_reader.online_cmvn(feat_cfg),
+                packed_store.packed_dtype(feat_cfg))):
+        feat_reader = packed_store.PackedFeatureReader(
+            storedir=os.path.join(featdir, 'packed'),
+            max_length=max_length_feat,
+            splicer=splicer)
+    else:
+        feat_reader = feature_reader.FeatureReader(
+            scpfile=os.path.join(featdir, 'feats.scp'),
+            cmvnfile=os.path.join(featdir, 'cmvn.scp'),
+            utt2spkfile=os.path.join(featdir, 'utt2spk'),
+            max_length=max_length_feat,
+            online_cmvn=feature_reader.online_cmvn(feat_cfg),
+            splicer=splicer)
 
     #create an audio sample reader if necessary
     if audio_used:
@@ -88,58 +108,41 @@ def main(_):
     # take the same one as used in training
     batch_size = int(trainer_cfg['batch_size'])
 
-    #create a ndarray of all of the features
-    _, features, _ = feat_reader.get_utt()
-    features = features.reshape(1, -1, features.shape[1])
-    features_lengths = features.shape[1]*np.ones([1], dtype=np.int32)
-    features = np.concatenate([features,
-                               np.zeros([features.shape[0],
-                                         max_length_feat-features.shape[1],
-                                         features.shape[2]])], 1)
+    #read all of the features, they are padded per batch
+    features = []
     looped = False
     while not looped:
-        _, temp, looped = feat_reader.get_utt()
-        temp = temp.reshape(1, -1, temp.shape[1])
-        features_lengths = np.concatenate(
-            [features_lengths, temp.shape[1]*np.ones([1], dtype=np.int32)], 0)
-        temp = np.concatenate(
-            [temp, np.zeros([temp.shape[0],
-                             max_length_feat-temp.shape[1], temp.shape[2]])], 1)
-        features = np.concatenate([features, temp], 0)
-
-    #create a ndarray of all of the targets
+        _, feat, looped = feat_reader.get_utt()
+        features.append(feat)
+    features_lengths = np.array([feat.shape[0] for feat in features],
+                                dtype=np.int32)
+
+    #read all of the targets
     if audio_used:
-        _, audio, _ = audio_reader.get_utt()
-        audio = audio.reshape(1, -1, audio.shape[1])
-        audio_lengths = audio.shape[1]*np.ones([1], dtype=np.int32)
-        audio = np.concatenate(
-            [audio, np.zeros([audio.shape[0],
-                              max_length_audio-audio.shape[1],
-                              audio.shape[2]])], 1)
+        audio = []
         looped = False
         while not looped:
-            _, temp, looped = audio_reader.get_utt()
-            temp = temp.reshape(1, -1, temp.shape[1])
-            audio_lengths = np.concatenate([audio_lengths,
-                                            temp.shape[1]*np.ones([1], \
-                                                dtype=np.int32)], 0)
-            temp = np.concatenate(
-                [temp, np.zeros([temp.shape[0],
-                                 max_length_audio-temp.shape[1],
-                                 temp.shape[2]])], 1)
-            audio = np.concatenate([audio, temp], 0)
+            _, samples, looped = audio_reader.get_utt()
+            audio.append(samples)
+        audio_lengths = np.array([samples.shape[0] for samples in audio],
+                                 dtype=np.int32)
 
     # store dimensions
-        max_audio_length = audio.shape[1]
+        max_audio_length = max_length_audio
 
     else:
-        audio = np.zeros([number_examples, 1, 1])
+        audio = [np.zeros([1, 1])]*number_examples
         max_audio_length = 1
-        audio_lengths = np.ones([number_examples])
+        audio_lengths = np.ones([number_examples], dtype=np.int32)
 
-    # store dimensions
-    max_feature_length = features.shape[1]
-    feature_dim = features.shape[2]
+    # store dimensions, a spliced frame is flattened when it is collated
+    feature_dim = int(np.prod(features[0].shape[1:]))
+
+    #a batch of features is padded to the smallest bucket of lengths it fits
+    #in, there is a graph for every bucket
+    input_buckets = feature_reader.length_buckets(
+        features_lengths, int(trainer_cfg.get('input_buckets', 1)),
+        feat_reader.max_length)
 
     #create a graph
     graph = tf.Graph()
@@ -154,11 +157,13 @@ def main(_):
             conf=nnet_cfg,
             output_dim=(1, outputdim))
 
-        # create placeholders for reconstruction and features
-        features_ph = tf.placeholder(
-            tf.float32,
-            shape=[batch_size, max_feature_length, feature_dim],
-            name='features')
+        # create placeholders for reconstruction and features of every bucket
+        features_ph = [
+            tf.placeholder(
+                tf.float32,
+                shape=[batch_size, length, feature_dim],
+                name='features_%d' % length)
+            for length in input_buckets]
 
         audio_ph = tf.placeholder(
             tf.int32,
@@ -171,25 +176,27 @@ def main(_):
         feature_lengths_ph = tf.placeholder(
             tf.int32, shape=[batch_size], name='feat_lenght')
 
-        # decide what to give as targets
-        if audio_used:
-            rec_ph = audio_ph
-            rec_l_ph = audio_lengths_ph
-        else:
-            rec_ph = features_ph
-            rec_l_ph = audio_lengths_ph
-
-        #create the logits for reconstructed audio samples
-        logits, logits_lengths = classifier(
-            inputs=features_ph,
-            input_seq_length=feature_lengths_ph,
-            targets=(None, rec_ph),
-            target_seq_length=(None, rec_l_ph),
-            is_training=False)
-
-        #compute the loss score
-        score = compute_loss((None, rec_ph), logits, logits_lengths,
-                             (None, rec_l_ph), audio_used)
+        score = []
+        for bucket_features_ph in features_ph:
+            # decide what to give as targets
+            if audio_used:
+                rec_ph = audio_ph
+                rec_l_ph = audio_lengths_ph
+            else:
+                rec_ph = bucket_features_ph
+                rec_l_ph = audio_lengths_ph
+
+            #create the logits for reconstructed audio samples
+            logits, logits_lengths = classifier(
+                inputs=bucket_features_ph,
+                input_seq_length=feature_lengths_ph,
+                targets=(None, rec_ph),
+                target_seq_length=(None, rec_l_ph),
+                is_training=False)
+
+            #compute the loss score
+            score.append(compute_loss((None, rec_ph), logits, logits_lengths,
+                                      (None, rec_l_ph), audio_used))
 
         saver = tf.train.Saver(tf.trainable_variables())
 
@@ -217,25 +224,21 @@ def main(_):
             if end >= number_examples:
                 end = number_examples
                 all_processed = True
-            part_features = features[start:end, :, :]
+            part_features = features[start:end]
             part_features_lengths = features_lengths[start:end]
-            part_audio = audio[start:end, :, :]
+            part_audio = audio[start:end]
             part_audio_lengths = audio_lengths[start:end]
 
-            # pad with zeros if the last batch isn't completely filled
+            # pad with empty utterances if the last batch isn't completely
+            # filled
             if all_processed:
                 elements_last_batch = end-start
                 to_add = batch_size - elements_last_batch
-                part_features = np.concatenate(
-                    [part_features,
-                     np.zeros([to_add, max_feature_length, feature_dim])], 0)
+                part_features = part_features + [features[0][:0]]*to_add
                 part_features_lengths = np.concatenate(
                     [part_features_lengths,
                      np.zeros([to_add], dtype=np.int32)], 0)
-                part_audio = np.concatenate(
-                    [part_audio,
-                     np.zeros([to_add, max_audio_length, 1], dtype=np.int32)],
-                    0)
+                part_audio = part_audio + [np.zeros([0, 1])]*to_add
                 part_audio_lengths = np.concatenate(
                     [part_audio_lengths,
                      np.zeros([to_add], dtype=np.int32)], 0)
@@ -243,11 +246,17 @@ def main(_):
             # number of elements in the current batch
             numel = end-start
 
+            # pad the features untill the length of their bucket
+            bucket = feature_reader.bucket_index(
+                input_buckets, np.max(part_features_lengths))
+
             # compute loss on this batch
             loss = sess.run(
-                score,
-                feed_dict={features_ph:part_features,
-                           audio_ph:part_audio,
+                score[bucket],
+                feed_dict={features_ph[bucket]:feature_reader.collate(
+                    part_features, input_buckets[bucket]),
+                           audio_ph:feature_reader.collate(
+                               part_audio, max_audio_length),
                            feature_lengths_ph:part_features_lengths,
                            audio_lengths_ph: part_audio_lengths})
 
@@ -0,0 +1,239 @@
+'''@file test_ark.py
+tests for the planned reads and the compressed matrices of the ArkReader'''
+
+import os
+import struct
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from nabu.processing import ark
+
+class ReadUttsAtTest(unittest.TestCase):
+    '''the utterances of a batch are read in archive order and returned in
+    the requested order'''
+
+    def setUp(self):
+        '''write a small archive'''
+
+        self.tempdir = tempfile.mkdtemp()
+        self.scp_path = os.path.join(self.tempdir, 'feats.scp')
+
+        writer = ark.ArkWriter(self.scp_path,
+                               os.path.join(self.tempdir, 'feats.ark'))
+        self.utt_mats = []
+        for i in range(6):
+            utt_mat = np.full([3 + i, 4], i, dtype=np.float32)
+            writer.write_next_utt('utt%d' % i, utt_mat)
+            self.utt_mats.append(utt_mat)
+        writer.close()
+
+        #the positions of a shuffled batch
+        self.positions = [4, 0, 5, 2, 1, 3]
+
+    def tearDown(self):
+        '''remove the archive'''
+
+        shutil.rmtree(self.tempdir)
+
+    def check_results(self, utt_mats):
+        '''the matrices come back in the requested order'''
+
+        for pos, utt_mat in zip(self.positions, utt_mats):
+            np.testing.assert_array_equal(utt_mat, self.utt_mats[pos])
+
+    def test_mmap_copies_in_offset_order(self):
+        '''in mmap mode every record is copied out of the mapping in archive
+        order'''
+
+        reader = ark.ArkReader(self.scp_path, use_mmap=True)
+        offsets = []
+        read_matrix = ark.read_matrix
+
+        def recording_read_matrix(data, offset):
+            '''record the offset of every parsed record'''
+            offsets.append(offset)
+            return read_matrix(data, offset)
+
+        ark.read_matrix = recording_read_matrix
+        try:
+            utt_mats = reader.read_utts_at(self.positions)
+        finally:
+            ark.read_matrix = read_matrix
+
+        self.assertEqual(offsets, sorted(offsets))
+        self.assertEqual(len(offsets), len(self.positions))
+
+        #the data is copied when the record is parsed, not later when the
+        #batch is used
+        for utt_mat in utt_mats:
+            self.assertTrue(utt_mat.flags.owndata)
+        self.check_results(utt_mats)
+
+    def record_reads(self, reader):
+        '''record the offset and the size of every read of a reader'''
+
+        reads = []
+        read = reader._read
+
+        def recording_read(path, offset, size):
+            '''record the offset and the size of a read'''
+            reads.append((offset, size))
+            return read(path, offset, size)
+
+        reader._read = recording_read
+
+        return reads
+
+    def test_planned_reads_in_offset_order(self):
+        '''without mmap the sizes of the records come from the index, one
+        header is read and then all the close records together'''
+
+        reader = ark.ArkReader(self.scp_path, use_mmap=False)
+        reads = self.record_reads(reader)
+        utt_mats = reader.read_utts_at(self.positions)
+
+        offsets = sorted(reader.scp_index.offsets[self.positions])
+        self.assertEqual(reads, [(offsets[0], ark.HEADER_SIZE),
+                                 (offsets[0], reads[-1][1])])
+        self.check_results(utt_mats)
+
+    def test_planned_reads_without_shapes(self):
+        '''for scp files without shapes the headers are read in archive order
+        and the close records are read together'''
+
+        reader = ark.ArkReader(self.scp_path, use_mmap=False)
+        reader.scp_index.num_frames = None
+        reader.scp_index.dims = None
+        reads = self.record_reads(reader)
+        utt_mats = reader.read_utts_at(self.positions)
+
+        #the headers are read in archive order, then all the records with a
+        #single read
+        headers = [offset for offset, size in reads[:-1]]
+        self.assertEqual(len(headers), len(self.positions))
+        self.assertEqual(headers, sorted(headers))
+        self.assertEqual(reads[-1][0], headers[0])
+        self.check_results(utt_mats)
+
+    def test_planned_reads_mixed_types(self):
+        '''a record of another type than the first one of its archive is
+        read on its own'''
+
+        ark_path = os.path.join(self.tempdir, 'feats.ark')
+        writer = ark.ArkWriter(os.path.join(self.tempdir, 'half.scp'),
+                               ark_path, dtype=np.float16)
+        utt_mat = np.full([5, 4], 7, dtype=np.float32)
+        writer.write_next_utt('utt6', utt_mat)
+        writer.close()
+        self.utt_mats.append(utt_mat)
+
+        scp_path = os.path.join(self.tempdir, 'mixed.scp')
+        scp_index = ark.scp_index.ScpIndex.concatenate(
+            [ark.scp_index.ScpIndex.read(self.scp_path),
+             ark.scp_index.ScpIndex.read(
+                 os.path.join(self.tempdir, 'half.scp'))])
+        scp_index.write(scp_path)
+
+        reader = ark.ArkReader(scp_path, use_mmap=False)
+        self.positions = [6, 1, 3]
+        self.check_results(reader.read_utts_at(self.positions))
+        self.positions = [1, 6, 3]
+        self.check_results(reader.read_utts_at(self.positions))
+
+class CompressedMatrixTest(unittest.TestCase):
+    '''the Kaldi compressed matrices are decompressed to the known values'''
+
+    def compressed(self, token, min_value, value_range, rows, cols, data):
+        '''build a compressed matrix record as it is stored in an archive'''
+
+        return ('\0B%s ' % token
+                + struct.pack('<ffii', min_value, value_range, rows, cols)
+                + data)
+
+    def check_matrix(self, record, expected):
+        '''the record is read as the expected matrix and its size and shape
+        follow from the header'''
+
+        #the record is read at an offset in a larger buffer
+        data = 'utt1 ' + record + 'utt2 '
+
+        utt_mat = ark.read_matrix(data, 5)
+        self.assertEqual(utt_mat.dtype, np.float32)
+        np.testing.assert_allclose(utt_mat, expected, rtol=1e-5, atol=1e-5)
+        self.assertEqual(ark.matrix_size(data, 5), len(record))
+        self.assertEqual(tuple(ark.matrix_shape(data, 5)),
+                         np.shape(expected))
+
+    def test_cm2(self):
+        '''two bytes per value over the global range'''
+
+        values = np.array([[0, 65535], [13107, 52428], [32768, 1]],
+                          dtype=np.uint16)
+        record = self.compressed('CM2', -1.0, 2.0, 3, 2, values.tostring())
+
+        self.check_matrix(record, -1.0 + 2.0*values/65535.0)
+
+    def test_cm3(self):
+        '''one byte per value over the global range'''
+
+        values = np.array([[0, 255, 51], [102, 153, 204]], dtype=np.uint8)
+        record = self.compressed('CM3', 10.0, 5.1, 2, 3, values.tostring())
+
+        self.check_matrix(record, [[10.0, 15.1, 11.02],
+                                   [12.04, 13.06, 14.08]])
+
+    def test_cm(self):
+        '''one byte per value, interpolated between the percentiles of its
+        column'''
+
+        #with this range the quantized percentiles are their own values
+        col_headers = np.array([[0, 64, 192, 255],
+                                [100, 200, 400, 1000]], dtype=np.uint16)
+
+        #the values are stored column by column
+        values = np.array([[0, 32, 64, 128, 192, 223, 255],
+                           [0, 32, 64, 128, 192, 223, 255]], dtype=np.uint8)
+        record = self.compressed('CM', 0.0, 65535.0, 7, 2,
+                                 col_headers.tostring() + values.tostring())
+
+        #the first column maps every byte to itself, the second one is
+        #linear within every quarter of the percentiles
+        expected = [[0.0, 100.0],
+                    [32.0, 150.0],
+                    [64.0, 200.0],
+                    [128.0, 300.0],
+                    [192.0, 400.0],
+                    [223.0, 400.0 + 600.0*31/63],
+                    [255.0, 1000.0]]
+
+        self.check_matrix(record, expected)
+
+    def test_reader(self):
+        '''the ArkReader reads compressed records with and without mmap'''
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            ark_path = os.path.join(tempdir, 'feats.ark')
+            scp_path = os.path.join(tempdir, 'feats.scp')
+            values = np.array([[0, 255], [51, 102]], dtype=np.uint8)
+            record = self.compressed('CM3', 0.0, 1.0, 2, 2,
+                                     values.tostring())
+            with open(ark_path, 'wb') as fid:
+                fid.write('utt0 ' + record + 'utt1 ' + record)
+            with open(scp_path, 'w') as fid:
+                fid.write('utt0 %s:5\nutt1 %s:%d\n'
+                          % (ark_path, ark_path, 10 + len(record)))
+
+            for use_mmap in [True, False]:
+                reader = ark.ArkReader(scp_path, use_mmap=use_mmap)
+                for utt_mat in ([reader.read_utt_data('utt1')]
+                                + reader.read_utts_at([1, 0])):
+                    np.testing.assert_allclose(utt_mat, values/255.0,
+                                               rtol=1e-5, atol=1e-5)
+                reader.close()
+        finally:
+            shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+'''@file test_sampler.py
+tests for the samplers that choose the utterances of the batches'''
+
+import unittest
+import numpy as np
+from nabu.processing import sampler
+
+class SequentialSamplerTest(unittest.TestCase):
+    '''the positions are taken in a seeded random order every epoch'''
+
+    def test_epoch_permutation(self):
+        '''every epoch is a permutation of the positions that only depends
+        on the seed and the epoch'''
+
+        positions = np.arange(10, 22)
+        epochs = []
+        for _ in range(2):
+            seq = sampler.SequentialSampler(positions, 4, seed=3)
+            epochs.append([np.concatenate([seq.next_batch()
+                                           for _ in range(3)])
+                           for _ in range(2)])
+
+        for epoch in epochs[0]:
+            np.testing.assert_array_equal(np.sort(epoch), positions)
+
+        #the same seed gives the same epochs, every epoch has its own order
+        np.testing.assert_array_equal(epochs[0], epochs[1])
+        self.assertFalse(np.array_equal(epochs[0][0], epochs[0][1]))
+        self.assertFalse(np.array_equal(
+            epochs[0][0],
+            np.concatenate([
+                sampler.SequentialSampler(positions, 4, seed=4).next_batch()
+                for _ in range(3)])))
+
+    def test_restore(self):
+        '''a sampler continues with the same batches from its position'''
+
+        seq = sampler.SequentialSampler(np.arange(10), 4, seed=5)
+        for _ in range(4):
+            seq.next_batch()
+
+        restored = sampler.SequentialSampler(np.arange(10), 4, seed=5)
+        restored.pos = seq.pos
+
+        #the batches span the end of the epochs
+        for _ in range(5):
+            np.testing.assert_array_equal(restored.next_batch(),
+                                          seq.next_batch())
+
+    def test_block_shuffle(self):
+        '''the blocks are shuffled as a whole, reproducibly from the seed'''
+
+        order = sampler.epoch_order(12, 7, 2, block_size=3)
+
+        np.testing.assert_array_equal(
+            order, sampler.epoch_order(12, 7, 2, block_size=3))
+        np.testing.assert_array_equal(np.sort(order), np.arange(12))
+
+        #every block of the order contains the utterances of a single block
+        blocks = order.reshape(4, 3)//3
+        self.assertTrue(np.all(blocks == blocks[:, :1]))
+        self.assertFalse(np.array_equal(
+            order, sampler.epoch_order(12, 7, 3, block_size=3)))
+
+        #a sampler with blocks takes the positions in that order
+        seq = sampler.SequentialSampler(np.arange(12), 6, seed=7,
+                                        block_size=3)
+        seq.pos = 24
+        np.testing.assert_array_equal(
+            np.concatenate([seq.next_batch(), seq.next_batch()]), order)
+
+class StratifiedSamplerTest(unittest.TestCase):
+    '''every batch has a fixed number of utterances of every stratum'''
+
+    def test_ratio(self):
+        '''the batches keep the ratio of labeled and unlabeled utterances and
+        every utterance of a stratum is taken once per epoch'''
+
+        labeled = np.arange(20) % 4 == 0
+        strata = sampler.StratifiedSampler(
+            [(np.where(labeled)[0], 1), (np.where(~labeled)[0], 3)], seed=1)
+
+        batches = [strata.next_batch() for _ in range(5)]
+
+        for batch in batches:
+            self.assertEqual(len(batch), 4)
+            self.assertEqual(np.sum(labeled[batch]), 1)
+
+        #the 5 labeled utterances are taken once in 5 batches
+        np.testing.assert_array_equal(
+            np.sort([batch[0] for batch in batches]), np.where(labeled)[0])
+
+class BucketSamplerTest(unittest.TestCase):
+    '''every batch is taken from a single bucket of lengths'''
+
+    def test_merge_buckets(self):
+        '''a bucket without utterances of a stratum is merged with the next
+        one and the last one with the previous one'''
+
+        buckets = [np.array([0, 1, 1, 3]), np.array([0, 2, 3])]
+
+        np.testing.assert_array_equal(
+            sampler.merge_buckets(buckets, [1, 1], 4), [0, 1, 1, 2])
+
+        buckets = [np.array([0, 1, 1, 3]), np.array([0, 2, 2])]
+
+        np.testing.assert_array_equal(
+            sampler.merge_buckets(buckets, [1, 1], 4), [0, 1, 1, 1])
+
+        #unused strata do not matter
+        np.testing.assert_array_equal(
+            sampler.merge_buckets(buckets, [1, 0], 4), [0, 1, 2, 2])
+
+    def test_single_bucket(self):
+        '''all the utterances of a batch come from one bucket, and the
+        batches of an epoch cover all the buckets'''
+
+        lengths = np.arange(40) % 20 + 1
+        labeled = np.arange(40) % 2 == 0
+        boundaries = [5, 10, 15, 20]
+        buckets = sampler.BucketSampler(
+            [(np.where(labeled)[0], 1), (np.where(~labeled)[0], 1)],
+            lengths, boundaries, seed=2)
+
+        used = set()
+        for _ in range(buckets.num_batches):
+            batch = buckets.next_batch()
+            batch_buckets = np.searchsorted(boundaries, lengths[batch])
+            self.assertEqual(len(set(batch_buckets)), 1)
+            self.assertEqual(np.sum(labeled[batch]), 1)
+            used.add(batch_buckets[0])
+
+        self.assertEqual(used, set(range(4)))
+
+class BudgetSamplerTest(unittest.TestCase):
+    '''the batches are filled up to a budget of padded frames and tokens'''
+
+    def test_token_budget_without_input_lengths(self):
+        '''a token budget does not need the input lengths'''
+
+        target_lengths = np.array([2, 2, 2, 5, 5, 1, 1, 1])
+        budget = sampler.BudgetSampler(
+            sampler.SequentialSampler(np.arange(8), 4), None,
+            target_lengths, 0, 10)
+
+        batches = [budget.next_batch() for _ in range(3)]
+
+        for batch in batches:
+            self.assertLessEqual(
+                len(batch)*np.max(target_lengths[batch]), 10)
+        np.testing.assert_array_equal(batches[0], [0, 1, 2])
+        np.testing.assert_array_equal(batches[1], [3, 4])
+
+        #the last batch of the epoch is filled with the next epoch
+        np.testing.assert_array_equal(batches[2], [5, 6, 7, 0])
+        self.assertEqual(budget.num_batches, 3)
+
+    def test_frame_budget_needs_input_lengths(self):
+        '''a frame budget can not be used without the input lengths'''
+
+        self.assertRaises(
+            Exception, sampler.BudgetSampler,
+            sampler.SequentialSampler(np.arange(8), 4), None,
+            np.ones([8]), 100)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,7 +6,8 @@ from functools import partial
 import tensorflow as tf
 from six.moves import configparser
 from nabu.distributed import create_server
-from nabu.processing import batchdispenser, feature_reader, target_coder
+from nabu.processing import batchdispenser, feature_reader, target_coder,\
+    readfiles, feature_cache, packed_store, manifest
 from nabu.neuralnetworks.classifiers.asr import asr_factory
 from nabu.neuralnetworks.trainers import trainer_factory
 from nabu.neuralnetworks.decoders import decoder_factory
@@ -101,8 +102,9 @@ def train_asr(clusterfile,
                         *samples_one_shift)-nnet_cfg['samples_per_hlfeature']
 
 
-    #create the cluster and server
-    server = create_server.create_server(
+    #create the cluster, the server of a worker is started by the trainer
+    #after the data loader workers are forked
+    cluster = create_server.create_cluster(
         clusterfile=clusterfile,
         job_name=job_name,
         task_index=task_index,
@@ -111,7 +113,7 @@ def train_asr(clusterfile,
 
     #the ps should just wait
     if job_name == 'ps':
-        server.join()
+        create_server.start_server(cluster, job_name, task_index).join()
 
     # path to where the training samples are stored
     featdir = os.path.join(database_cfg['train_dir'], feat_cfg['name'])
@@ -125,15 +127,60 @@ def train_asr(clusterfile,
     with open(featdir + '/maxlength', 'r') as fid:
         max_length = int(fid.read())
 
-    featreader = feature_reader.FeatureReader(
-        scpfile=featdir + '/feats_shuffled.scp',
-        cmvnfile=featdir + '/cmvn.scp',
-        utt2spkfile=featdir + '/utt2spk',
-        max_length=max_length)
+    #keep the normalized training features in memory if there is a budget,
+    #so the later epochs do not have to read them again. Every loader worker
+    #gets its own copy of the cache, so the budget is divided over them
+    cache_size = int(trainer_cfg.get('feature_cache_mb', 0))*1048576
+    num_caches = max(1, int(trainer_cfg.get('loader_workers', 0)))
+    if cache_size > 0:
+        featcache = feature_cache.FeatureCache(cache_size//num_caches)
+    else:
+        featcache = None
+
+    #the optional frame splicing and subsampling of the inputs
+    splicer = feature_reader.splicer(feat_cfg)
+
+    #when blocks of utterances are shuffled in memory every epoch, they are
+    #read in the order of the archives so the reads of a block are close
+    shuffle = trainer_cfg.get('shuffle', 'False') == 'True'
+    if shuffle and int(trainer_cfg.get('shuffle_block', 0)) > 0:
+        scpfile = featdir + '/feats.scp'
+    else:
+        scpfile = featdir + '/feats_shuffled.scp'
+
+    #read the packed store if the features were packed from the current
+    #features, the store is normalized when it is packed and memory mapped
+    if (database_cfg.get('packed_features', 'False') == 'True'
+            and packed_store.usable(
+                featdir + '/packed', featdir + '/feats_shuffled.scp',
+                featdir + '/cmvn.scp', feature_reader.online_cmvn(feat_cfg),
+                packed_store.packed_dtype(feat_cfg))):
+        if featcache is not None:
+            print ('WARNING: feature_cache_mb is ignored, the packed store is '
+                   'memory mapped')
+        if shuffle and int(trainer_cfg.get('shuffle_block', 0)) > 0:
+            print ('WARNING: the blocks of shuffle_block are taken in the '
+                   'order of the packed store, not of the archives')
+        featreader = packed_store.PackedFeatureReader(
+            storedir=featdir + '/packed',
+            max_length=max_length,
+            splicer=splicer)
+    else:
+        featreader = feature_reader.FeatureReader(
+            scpfile=scpfile,
+            cmvnfile=featdir + '/cmvn.scp',
+            utt2spkfile=featdir + '/utt2spk',
+            max_length=max_length,
+            online_cmvn=feature_reader.online_cmvn(feat_cfg),
+            cache=featcache,
+            splicer=splicer,
+            manifest=manifest.load(featdir))
 
     #read the feature dimension
     with open(featdir + '/dim', 'r') as fid:
         input_dim = int(fid.read())
+    if splicer is not None:
+        input_dim = splicer.dim(input_dim)
 
     #the path to the text file
     textfile = os.path.join(database_cfg['train_dir'], 'targets')
@@ -280,22 +327,32 @@ def train_asr(clusterfile,
         with open(featdir + '/maxlength', 'r') as fid:
             max_length = int(fid.read())
 
-        val_reader = feature_reader.FeatureReader(
-            scpfile=featdir + '/feats.scp',
-            cmvnfile=featdir + '/cmvn.scp',
-            utt2spkfile=featdir + '/utt2spk',
-            max_length=max_length)
+        #read the packed store if the features were packed from the
+        #current features
+        if (database_cfg.get('packed_features', 'False') == 'True'
+                and packed_store.usable(
+                    featdir + '/packed', featdir + '/feats.scp',
+                    featdir + '/cmvn.scp',
+                    feature_reader.online_cmvn(feat_cfg),
+                    packed_store.packed_dtype(feat_cfg))):
+            val_reader = packed_store.PackedFeatureReader(
+                storedir=featdir + '/packed',
+                max_length=max_length,
+                splicer=splicer)
+        else:
+            val_reader = feature_reader.FeatureReader(
+                scpfile=featdir + '/feats.scp',
+                cmvnfile=featdir + '/cmvn.scp',
+                utt2spkfile=featdir + '/utt2spk',
+                max_length=max_length,
+                online_cmvn=feature_reader.online_cmvn(feat_cfg),
+                splicer=splicer,
+                manifest=manifest.load(featdir))
 
         textfile = os.path.join(database_cfg['dev_dir'], 'targets')
 
         #read the validation text targets
-        with open(textfile) as fid:
-            lines = fid.readlines()
-
-            val_text_targets = dict()
-            for line in lines:
-                splitline = line.strip().split(' ')
-                val_text_targets[splitline[0]] = ' '.join(splitline[1:])
+        val_text_targets = readfiles.read_targets(textfile)
 
         if nonsupervised:
         #also store the reconstruction targets
@@ -315,36 +372,56 @@ def train_asr(clusterfile,
             else: #input features are used
                 for _ in range(val_reader.num_utt):
                     utt_id, feat, _ = val_reader.get_utt()
-                    val_rec_targets[utt_id] = feat
+                    #spliced features are flattened to the input dimension
+                    val_rec_targets[utt_id] = feat.reshape(feat.shape[0], -1)
         else:
-            with open(textfile) as fid:
-                lines = fid.readlines()
-
-                val_rec_targets = dict()
-                for line in lines:
-                    splitline = line.strip().split(' ')
-                    val_rec_targets[splitline[0]] = None
+            val_rec_targets = {utt_id: None for utt_id in val_text_targets}
 
         val_targets = dict()
         for utt_id in val_text_targets:
-            val_targets[utt_id] = (val_text_targets[utt_id],
-                                   val_rec_targets[utt_id])
+            val_targets[utt_id] = (
+                dispenser.target_coder.encode(val_text_targets[utt_id]),
+                val_rec_targets[utt_id])
 
     else:
         if int(trainer_cfg['valid_utt']) > 0:
             val_dispenser = dispenser.split(int(trainer_cfg['valid_utt']))
             val_reader = val_dispenser.feature_reader
-            val_targets = val_dispenser.target_dict
+            #the encoded targets are shared with the training dispenser, so a
+            #new dictionary is created for the validation utterances
+            val_targets = {utt_id: (val_dispenser.targets.get(utt_id), None)
+                           for utt_id in val_reader.utt_ids}
         else:
             val_reader = None
             val_targets = None
 
-    #encode the validation targets
-    if val_targets is not None:
-        for utt in val_targets:
-            val_targets[utt] = (dispenser.target_coder.encode(
-                val_targets[utt][0]), val_targets[utt][1])
-
+    #take the training utterances in a different order every epoch
+    if shuffle:
+        dispenser.shuffle(int(trainer_cfg.get('shuffle_seed', 0)),
+                          int(trainer_cfg.get('shuffle_block', 0)))
+
+    #take every batch from a single bucket of utterances with similar lengths,
+    #the boundaries are given or they are quantiles of the lengths. Features
+    #that were prepared without a manifest have no lengths to bucket on
+    bucketed = (trainer_cfg.get('bucket_boundaries', '')
+                or int(trainer_cfg.get('batch_buckets', 0)) > 0)
+    if bucketed and dispenser.input_lengths is None:
+        print ('WARNING: the lengths of the training utterances are not '
+               'known, the batches are not bucketed. Prepare the features '
+               'again to create a manifest')
+    elif trainer_cfg.get('bucket_boundaries', ''):
+        dispenser.set_buckets(
+            [int(b) for b in trainer_cfg['bucket_boundaries'].split(',')])
+    elif bucketed:
+        dispenser.set_buckets(feature_reader.length_buckets(
+            dispenser.input_lengths, int(trainer_cfg['batch_buckets']),
+            dispenser.max_input_length))
+
+    #fill the batches up to a budget of padded frames and target tokens
+    max_batch_frames = int(trainer_cfg.get('max_batch_frames', 0))
+    max_batch_tokens = int(trainer_cfg.get('max_batch_tokens', 0))
+    if max_batch_frames > 0 or max_batch_tokens > 0:
+        dispenser.set_budget(max_batch_frames, max_batch_tokens)
 
     #create the classifier
     if nonsupervised:
@@ -367,7 +444,8 @@ def train_asr(clusterfile,
         input_dim=input_dim,
         max_input_length=val_reader.max_length,
         coder=coder,
-        expdir=expdir)
+        expdir=expdir,
+        input_lengths=val_reader.lengths)
 
     #create the trainer
     if nonsupervised:
@@ -388,7 +466,7 @@ def train_asr(clusterfile,
         val_reader=val_reader,
         val_targets=val_targets,
         expdir=expdir,
-        server=server,
+        cluster=cluster,
         task_index=task_index)
 
     print 'starting training'
@@ -49,8 +49,9 @@ def train_lm(clusterfile,
     parsed_decoder_cfg.read(expdir + '/model/decoder.cfg')
     decoder_cfg = dict(parsed_decoder_cfg.items('decoder'))
 
-    #create the cluster and server
-    server = create_server.create_server(
+    #create the cluster, the server of a worker is started by the trainer
+    #after the data loader workers are forked
+    cluster = create_server.create_cluster(
         clusterfile=clusterfile,
         job_name=job_name,
         task_index=task_index,
@@ -64,7 +65,7 @@ def train_lm(clusterfile,
 
     #the ps should just wait
     if job_name == 'ps':
-        server.join()
+        create_server.start_server(cluster, job_name, task_index).join()
 
     #create the coder
     with open(os.path.join(database_cfg['train_dir'], 'alphabet')) as fid:
@@ -144,7 +145,7 @@ def train_lm(clusterfile,
         val_reader=val_reader,
         val_targets=val_targets,
         expdir=expdir,
-        server=server,
+        cluster=cluster,
         task_index=task_index)
 
     #train the classifier